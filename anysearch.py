@@ -4,13 +4,36 @@ OpenSearch packages (including *search-dsl).
 The concept and some parts of the code have been snatched from the famous `six`
 package.
 """
+import asyncio
+import base64
+import collections
+import contextlib
+import contextvars
+import datetime
+import fnmatch
+import functools
+import hashlib
+import heapq
+import inspect
+import itertools
+import json
 import logging
 import os
+import queue
+import random
+import re
 import subprocess
 import sys
+import threading
+import time
 import types
+import warnings
+from array import array
+from collections import abc
+from concurrent.futures import Future, ThreadPoolExecutor
 from importlib.util import spec_from_loader
-from typing import Set
+from typing import List, Set
+from urllib.parse import quote, unquote
 
 __title__ = "anysearch"
 __version__ = "0.2.2"
@@ -710,6 +733,5920 @@ _importer._add_module(search_dsl, "search_dsl")
 #             return self._name
 
 
+# **************************************************
+# **************************************************
+# ****************** Bulk helpers ******************
+# **************************************************
+# **************************************************
+
+# HTTP statuses of individual bulk items (or of the whole bulk request) that
+# are worth retrying. Everything else (mapping errors, version conflicts,
+# missing documents, etc.) is considered permanent.
+RETRYABLE_BULK_STATUSES = (429, 502, 503, 504)
+
+
+class _BulkEntry(object):
+    """A single, pre-serialized bulk action (action line + optional data)."""
+
+    __slots__ = ("op_type", "action", "data", "lines", "size")
+
+    def __init__(self, action, data, serializer):
+        self.op_type = next(iter(action))
+        self.action = action
+        self.data = data
+        self.lines = [serializer.dumps(action)]
+        if data is not None:
+            self.lines.append(serializer.dumps(data))
+        self.size = sum(len(line.encode("utf-8")) + 1 for line in self.lines)
+
+    @property
+    def key(self):
+        """(index, id) of the targeted document, `None` for actions without
+        an explicit id."""
+        meta = self.action[self.op_type]
+        if meta.get("_id") is None:
+            return None
+        return meta.get("_index"), meta["_id"]
+
+
+class BulkRetryQueue(object):
+    """Per-item back-off queue for failed bulk actions.
+
+    Every item is released once its own back-off has expired. The back-off
+    grows exponentially with the number of attempts and is jittered
+    ("full jitter") to avoid synchronised retry storms.
+    """
+
+    def __init__(
+        self,
+        initial_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        jitter: bool = True,
+    ):
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def backoff(self, attempt: int) -> float:
+        """Get the back-off (in seconds) for the given attempt.
+
+        :param attempt: Number of the retry (starting from 1).
+        :return: Back-off in seconds.
+        """
+        delay = min(
+            self.max_backoff, self.initial_backoff * 2 ** max(attempt - 1, 0)
+        )
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def push(self, item, attempt: int, now: float = None):
+        """Schedule an item for a retry.
+
+        :param item: Item to retry.
+        :param attempt: Number of the retry (starting from 1).
+        :param now: Current monotonic time.
+        """
+        if now is None:
+            now = time.monotonic()
+        heapq.heappush(
+            self._heap,
+            (now + self.backoff(attempt), next(self._counter), attempt, item),
+        )
+
+    def pop_ready(self, limit: int = None, now: float = None) -> List[tuple]:
+        """Pop items whose back-off has expired.
+
+        :param limit: Maximum number of items to pop.
+        :param now: Current monotonic time.
+        :return: List of (attempt, item) tuples.
+        """
+        if now is None:
+            now = time.monotonic()
+        ready = []
+        while self._heap and self._heap[0][0] <= now:
+            if limit is not None and len(ready) >= limit:
+                break
+            _, _, attempt, item = heapq.heappop(self._heap)
+            ready.append((attempt, item))
+        return ready
+
+    def next_ready_in(self, now: float = None) -> float:
+        """Get the number of seconds until the next item is ready.
+
+        :param now: Current monotonic time.
+        :return: Seconds to wait (0 if an item is ready, or the queue is
+            empty).
+        """
+        if not self._heap:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        return max(self._heap[0][0] - now, 0.0)
+
+
+def _is_retryable_bulk_exception(exc, retry_on_status) -> bool:
+    """Check if a whole bulk request failure can be retried."""
+    if isinstance(exc, search.ConnectionError):
+        return True
+    return getattr(exc, "status_code", None) in retry_on_status
+
+
+# Maximum number of times a bulk request is sent while rejected by a client
+# side `RateLimiter`.
+_MAX_RATE_LIMITED_SENDS = 100
+
+
+def _send_bulk(client, body, kwargs):
+    """Send a bulk request, waiting (and resending) while a client side
+    `RateLimiter` (failing fast) rejects it."""
+    for attempt in range(1, _MAX_RATE_LIMITED_SENDS + 1):
+        try:
+            return client.bulk(body=body, **kwargs)
+        except RateLimitExceeded as err:
+            if attempt == _MAX_RATE_LIMITED_SENDS:
+                raise
+            time.sleep(err.retry_after)
+
+
+def _iter_bulk_results(
+    client,
+    actions,
+    chunk_size: int = 500,
+    max_chunk_bytes: int = 100 * 1024 * 1024,
+    max_retries: int = 3,
+    initial_backoff: float = 1.0,
+    max_backoff: float = 60.0,
+    retry_on_status=RETRYABLE_BULK_STATUSES,
+    jitter: bool = True,
+    yield_ok: bool = True,
+    expand_action_callback=None,
+    **kwargs,
+):
+    """Send actions in chunks, retrying only the failed items.
+
+    Yields (ok, info, action) tuples, where `action` is the original action
+    as passed in. Results are yielded in the order they become final,
+    which is not necessarily the order of `actions`.
+
+    Writes to the same document are kept in order: a chunk never contains
+    two actions for the same (index, id), and no action is sent while an
+    earlier one for the same document waits for a retry.
+    """
+    from anysearch.search import helpers
+
+    if expand_action_callback is None:
+        expand_action_callback = helpers.expand_action
+    serializer = client.transport.serializer
+    retry_queue = BulkRetryQueue(initial_backoff, max_backoff, jitter)
+    actions = iter(actions)
+    exhausted = False
+    carry = None
+    # Documents with an action waiting in the retry queue.
+    retrying = set()
+
+    def _retry(entry, source, attempt):
+        retry_queue.push((entry, source), attempt)
+        if entry.key is not None:
+            retrying.add(entry.key)
+
+    while True:
+        # Items waiting for a retry go first, fresh actions fill up the rest
+        # of the chunk.
+        chunk = retry_queue.pop_ready(limit=chunk_size)
+        size = sum(_entry.size for _, (_entry, _) in chunk)
+        keys = {_entry.key for _, (_entry, _) in chunk}
+        retrying.difference_update(keys)
+        while len(chunk) < chunk_size:
+            if carry is None:
+                if exhausted:
+                    break
+                try:
+                    source = next(actions)
+                except StopIteration:
+                    exhausted = True
+                    break
+                action, data = expand_action_callback(source)
+                carry = (0, (_BulkEntry(action, data, serializer), source))
+            key = carry[1][0].key
+            if key is not None and (key in keys or key in retrying):
+                # An earlier write to the same document has not been
+                # finalised yet, so this one has to wait.
+                break
+            if chunk and size + carry[1][0].size > max_chunk_bytes:
+                break
+            chunk.append(carry)
+            keys.add(key)
+            size += carry[1][0].size
+            carry = None
+
+        if not chunk:
+            if not retry_queue:
+                return
+            time.sleep(retry_queue.next_ready_in())
+            continue
+
+        body = [line for _, (entry, _) in chunk for line in entry.lines]
+        try:
+            response = _send_bulk(client, body, kwargs)
+        except search.TransportError as err:
+            if not _is_retryable_bulk_exception(err, retry_on_status):
+                raise
+            for attempt, (entry, source) in chunk:
+                if attempt < max_retries:
+                    _retry(entry, source, attempt + 1)
+                    continue
+                info = {
+                    "error": str(err),
+                    "status": err.status_code,
+                    "exception": err,
+                }
+                if entry.data is not None:
+                    info["data"] = entry.data
+                yield False, {entry.op_type: info}, source
+            continue
+
+        if not response["errors"]:
+            # Nothing failed, so there is no need to look into (and with the
+            # `BulkResponseSerializer`, not even to decode) the items.
+            if yield_ok:
+                for (_, (_, source)), item in zip(chunk, response["items"]):
+                    yield True, item, source
+            continue
+
+        for (attempt, (entry, source)), item in zip(chunk, response["items"]):
+            op_type, info = next(iter(item.items()))
+            status = info.get("status", 500)
+            if 200 <= status < 300:
+                yield True, {op_type: info}, source
+            elif status in retry_on_status and attempt < max_retries:
+                _retry(entry, source, attempt + 1)
+            else:
+                if entry.data is not None:
+                    info["data"] = entry.data
+                yield False, {op_type: info}, source
+
+
+def retrying_bulk(
+    client,
+    actions,
+    chunk_size: int = 500,
+    max_chunk_bytes: int = 100 * 1024 * 1024,
+    max_retries: int = 3,
+    initial_backoff: float = 1.0,
+    max_backoff: float = 60.0,
+    retry_on_status=RETRYABLE_BULK_STATUSES,
+    jitter: bool = True,
+    yield_ok: bool = True,
+    expand_action_callback=None,
+    **kwargs,
+):
+    """Streaming bulk, which retries only the failed items.
+
+    Unlike `helpers.streaming_bulk`, a partially failed chunk is not
+    re-sent as a whole. Items failed with one of the `retry_on_status`
+    statuses are put into a per-item back-off queue and merged into the
+    following chunks, once their (jittered, exponential) back-off expires.
+    All other failures (and items which ran out of retries) are considered
+    permanent and reported in the same stream as the successful ones.
+
+    A retried item never overtakes (or gets overtaken by) a later write to
+    the same document: actions targeting the same `_id` are sent in
+    separate chunks, and a later one is held back until the earlier one has
+    succeeded or failed for good. Holding back blocks the stream behind it,
+    so streams with many writes to the same document are better coalesced
+    first (see `CoalescingBulkWriter`).
+
+    :param client: `AnySearch` client instance.
+    :param actions: Iterable of actions (same format as for
+        `helpers.streaming_bulk`).
+    :param chunk_size: Number of actions sent in a single request.
+    :param max_chunk_bytes: Maximum size of a single request in bytes.
+    :param max_retries: Maximum number of retries of a single item.
+    :param initial_backoff: Back-off (in seconds) of the first retry.
+    :param max_backoff: Maximum back-off (in seconds).
+    :param retry_on_status: Item statuses, which are worth retrying.
+    :param jitter: Whether to randomize the back-off.
+    :param yield_ok: Whether to yield successful items as well.
+    :param expand_action_callback: Callback used to expand the actions.
+    :return: Generator of (ok, info) tuples.
+    """
+    for ok, info, _ in _iter_bulk_results(
+        client,
+        actions,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        max_retries=max_retries,
+        initial_backoff=initial_backoff,
+        max_backoff=max_backoff,
+        retry_on_status=retry_on_status,
+        jitter=jitter,
+        yield_ok=yield_ok,
+        expand_action_callback=expand_action_callback,
+        **kwargs,
+    ):
+        if ok and not yield_ok:
+            continue
+        yield ok, info
+
+
+# Key of the items array of a bulk response. Everything in front of it is a
+# handful of top-level scalars (`took`, `errors`, `ingest_took`), in an order
+# which differs between the versions of Elasticsearch and OpenSearch.
+_BULK_RESPONSE_ITEMS_KEY = '"items"'
+
+
+def _loads_bulk_response_head(s):
+    """Decode the top-level fields in front of the items of a bulk response.
+
+    :param s: Response body.
+    :return: Dict of the fields (`None` if the response does not look like
+        a bulk response).
+    """
+    index = s.find(_BULK_RESPONSE_ITEMS_KEY)
+    if index == -1:
+        return None
+    head = s[:index].rstrip()
+    if not head.endswith(","):
+        return None
+    try:
+        fields = json.loads(head[:-1] + "}")
+    except ValueError:
+        return None
+    return fields if isinstance(fields, dict) else None
+
+
+class _LazyBulkItems(abc.Sequence):
+    """Items of a bulk response, decoded on first access only."""
+
+    def __init__(self, raw, serializer):
+        self._raw = raw
+        self._serializer = serializer
+        self._items = None
+
+    def _load(self):
+        if self._items is None:
+            self._items = self._serializer.loads(self._raw)["items"]
+            self._raw = None
+        return self._items
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+class BulkResponseSerializer(object):
+    """JSON serializer with a fast path for successful bulk responses.
+
+    Decoding a bulk response means building a dict for every single item,
+    which, for large chunks, is a significant share of the client CPU time.
+    Most of the time the items are not even looked at, since the top-level
+    `errors` flag is `false`. This serializer decodes the top-level fields in
+    front of the items first (in whatever order the cluster sends them,
+    `ingest_took` included) and, if nothing failed, defers decoding of the
+    items until they are accessed. All other responses are handled by the
+    wrapped serializer.
+
+    The items are decoded anyway once they are accessed, so the gain is
+    only there for callers which skip the successful items (such as
+    `retrying_bulk` with `yield_ok=False`).
+
+    Usage:
+
+        client = AnySearch(serializer=BulkResponseSerializer())
+    """
+
+    mimetype = "application/json"
+
+    def __init__(self, serializer=None):
+        if serializer is None:
+            serializer = search.JSONSerializer()
+        self.serializer = serializer
+
+    def dumps(self, data):
+        return self.serializer.dumps(data)
+
+    def loads(self, s):
+        if isinstance(s, bytes):
+            s = s.decode("utf-8")
+        head = _loads_bulk_response_head(s)
+        if head is not None and head.get("errors") is False:
+            head["items"] = _LazyBulkItems(s, self.serializer)
+            return head
+        return self.serializer.loads(s)
+
+
+# Metadata fields of bulk actions (as understood by `helpers.expand_action`).
+_BULK_META_FIELDS = (
+    "_id",
+    "_index",
+    "_if_seq_no",
+    "_if_primary_term",
+    "_parent",
+    "_percolate",
+    "_retry_on_conflict",
+    "_routing",
+    "_timestamp",
+    "_type",
+    "_version",
+    "_version_type",
+    "if_seq_no",
+    "if_primary_term",
+    "parent",
+    "pipeline",
+    "retry_on_conflict",
+    "routing",
+    "version",
+    "version_type",
+)
+
+# Metadata fields, which make the outcome of an action depend on the
+# preceding ones. Actions carrying them are never coalesced.
+_BULK_CONCURRENCY_FIELDS = frozenset(
+    (
+        "_if_seq_no",
+        "_if_primary_term",
+        "_version",
+        "_version_type",
+        "if_seq_no",
+        "if_primary_term",
+        "version",
+        "version_type",
+    )
+)
+
+
+def _split_bulk_action(action):
+    """Split a bulk action into (op_type, meta, body).
+
+    Returns None for actions which can not be coalesced (raw JSON strings,
+    updates with a non-mapping `_source`, etc.).
+    """
+    if not isinstance(action, abc.Mapping):
+        return None
+    action = dict(action)
+    op_type = action.pop("_op_type", "index")
+    meta = {_k: action.pop(_k) for _k in _BULK_META_FIELDS if _k in action}
+    if "_id" not in meta:
+        return None
+    if op_type == "delete":
+        return op_type, meta, None
+    body = action.pop("_source", action)
+    if not isinstance(body, abc.Mapping):
+        return None
+    return op_type, meta, dict(body)
+
+
+def _merge_partial_doc(source, doc):
+    """Merge a partial document the way the `update` API does.
+
+    Objects are merged recursively, everything else is replaced.
+    """
+    merged = dict(source)
+    for key, value in doc.items():
+        if isinstance(value, abc.Mapping) and isinstance(
+            merged.get(key), abc.Mapping
+        ):
+            value = _merge_partial_doc(merged[key], value)
+        merged[key] = value
+    return merged
+
+
+def _is_partial_update(body):
+    """Check if an update body is a plain partial document update."""
+    return "doc" in body and not set(body) - {"doc", "doc_as_upsert"}
+
+
+def _coalesce_bulk_actions(previous, current):
+    """Collapse two consecutive actions on the same document into one.
+
+    Both actions are given as (op_type, meta, body) tuples. Returns None if
+    the actions can't be collapsed without changing the final state.
+    """
+    prev_op, prev_meta, prev_body = previous
+    op_type, meta, body = current
+    if _BULK_CONCURRENCY_FIELDS.intersection(
+        prev_meta
+    ) or _BULK_CONCURRENCY_FIELDS.intersection(meta):
+        return None
+
+    # Full writes and deletes supersede whatever happened before.
+    if op_type in ("index", "delete"):
+        return current
+    if op_type == "create":
+        # Creating a document, which has just been deleted, succeeds.
+        if prev_op == "delete":
+            return "index", meta, body
+        return None
+
+    # Merging would drop the metadata (pipeline, retry_on_conflict, ...) of
+    # one of the actions. Neither is an update merged into a `create`: the
+    # merged `create` fails on an existing document, losing the update.
+    if op_type != "update" or not _is_partial_update(body) or meta != prev_meta:
+        return None
+    if prev_op == "index":
+        return prev_op, prev_meta, _merge_partial_doc(prev_body, body["doc"])
+    if (
+        prev_op == "update"
+        and _is_partial_update(prev_body)
+        and prev_body.get("doc_as_upsert") == body.get("doc_as_upsert")
+    ):
+        merged_body = dict(body)
+        merged_body["doc"] = _merge_partial_doc(prev_body["doc"], body["doc"])
+        return op_type, meta, merged_body
+    return None
+
+
+class CoalescingBulkWriter(object):
+    """Buffered bulk writer, collapsing repeated writes to the same document.
+
+    Actions are keyed by (index, id, routing). Within the buffering window,
+    a full write (`index`) or a `delete` supersedes the earlier actions on
+    the same document, while partial `update` documents are merged into the
+    buffered document (or into the buffered partial update). Actions, which
+    can't be collapsed without changing the final state (scripted updates,
+    optimistic concurrency control, etc.), flush the buffer first.
+
+    The buffer is flushed once it holds `max_actions` documents, once the
+    oldest buffered action is older than `max_age` seconds (checked on
+    `add` and `flush_if_due`), on `flush` and on leaving the context.
+
+    Usage:
+
+        with CoalescingBulkWriter(client, max_actions=500) as writer:
+            for action in feed:
+                writer.add(action)
+    """
+
+    def __init__(
+        self,
+        client,
+        max_actions: int = 1000,
+        max_age: float = 1.0,
+        bulk=None,
+        **bulk_kwargs,
+    ):
+        """
+        :param client: `AnySearch` client instance.
+        :param max_actions: Maximum number of buffered documents.
+        :param max_age: Maximum age (in seconds) of a buffered action.
+        :param bulk: Streaming bulk function used to send the actions.
+            Defaults to `retrying_bulk`.
+        :param bulk_kwargs: Keyword arguments passed to the `bulk` function.
+        """
+        self.client = client
+        self.max_actions = max_actions
+        self.max_age = max_age
+        self.bulk = bulk or retrying_bulk
+        self.bulk_kwargs = bulk_kwargs
+        self.bulk_kwargs.setdefault("yield_ok", False)
+        self.received = 0
+        self.sent = 0
+        self.errors = []
+        self._buffer = {}
+        self._counter = itertools.count()
+        self._oldest = None
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    @property
+    def coalesced(self) -> int:
+        """Number of actions saved by coalescing."""
+        return self.received - self.sent - len(self._buffer)
+
+    def add(self, action):
+        """Add an action to the buffer.
+
+        :param action: Action (same format as for `helpers.streaming_bulk`).
+        """
+        with self._lock:
+            self.received += 1
+            current = _split_bulk_action(action)
+            if current is None:
+                self._buffer[("", next(self._counter))] = action
+            else:
+                op_type, meta, body = current
+                key = (
+                    meta.get("_index"),
+                    meta["_id"],
+                    meta.get("_routing", meta.get("routing")),
+                )
+                previous = self._buffer.get(key)
+                if previous is not None:
+                    merged = _coalesce_bulk_actions(previous, current)
+                    if merged is None:
+                        self.flush()
+                    else:
+                        current = merged
+                self._buffer[key] = current
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._buffer) >= self.max_actions:
+                self.flush()
+            else:
+                self.flush_if_due()
+
+    def flush_if_due(self) -> list:
+        """Flush the buffer if the oldest action exceeded `max_age`.
+
+        :return: List of failures.
+        """
+        with self._lock:
+            if (
+                self._oldest is not None
+                and time.monotonic() - self._oldest >= self.max_age
+            ):
+                return self.flush()
+        return []
+
+    def flush(self) -> list:
+        """Send all buffered actions.
+
+        :return: List of failures (also collected in `errors`).
+        """
+        with self._lock:
+            if not self._buffer:
+                return []
+            actions = []
+            for value in self._buffer.values():
+                if isinstance(value, tuple):
+                    op_type, meta, body = value
+                    value = dict(meta, _op_type=op_type)
+                    if body is not None:
+                        value["_source"] = body
+                actions.append(value)
+            self._buffer = {}
+            self._oldest = None
+            self.sent += len(actions)
+            errors = [
+                info
+                for ok, info in self.bulk(
+                    self.client, actions, **self.bulk_kwargs
+                )
+                if not ok
+            ]
+            self.errors.extend(errors)
+            return errors
+
+
+# Statuses of whole bulk requests, which the cluster rejects for their
+# content (malformed, too large): resending the records won't help.
+_SPOOL_REJECTED_STATUSES = (400, 413)
+
+_SPOOL_OP_TYPES = ("index", "create", "update", "delete")
+
+
+def _is_spool_action(action) -> bool:
+    """Check if a decoded spool line is a valid bulk action line."""
+    return (
+        isinstance(action, dict)
+        and len(action) == 1
+        and next(iter(action)) in _SPOOL_OP_TYPES
+    )
+
+
+class _SpoolSegment(object):
+    """Closed segment file of a `BulkSpool`."""
+
+    __slots__ = ("path", "created", "records", "offset")
+
+    def __init__(self, path, created, records=0, offset=0):
+        self.path = path
+        self.created = created
+        self.records = records
+        self.offset = offset
+
+    @property
+    def offset_path(self):
+        return self.path[: -len(".ndjson")] + ".offset"
+
+    def read(self, limit: int = None):
+        """Read complete records starting from the current offset.
+
+        A trailing incomplete record (the process died in the middle of a
+        write) is ignored. A corrupt action line is returned as a
+        (None, line) record.
+
+        :param limit: Maximum number of records to read.
+        :return: (records, offset after the last record) tuple.
+        """
+        records = []
+        offset = self.offset
+        with open(self.path, "rb") as segment_file:
+            segment_file.seek(offset)
+            while limit is None or len(records) < limit:
+                action_line = segment_file.readline()
+                if not action_line.endswith(b"\n"):
+                    break
+                try:
+                    action = json.loads(action_line)
+                except ValueError:
+                    action = None
+                if not _is_spool_action(action):
+                    records.append(
+                        (None, action_line[:-1].decode("utf-8", "replace"))
+                    )
+                    offset = segment_file.tell()
+                    continue
+                data_line = None
+                if "delete" not in action:
+                    data_line = segment_file.readline()
+                    if not data_line.endswith(b"\n"):
+                        break
+                    data_line = data_line[:-1].decode("utf-8")
+                records.append((action, data_line))
+                offset = segment_file.tell()
+        return records, offset
+
+    def commit(self, offset: int):
+        """Durably store the offset of the first unacknowledged record."""
+        self.offset = offset
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, "w") as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(tmp_path, self.offset_path)
+
+    def read_rest(self) -> bytes:
+        """Read what follows the last complete record."""
+        with open(self.path, "rb") as segment_file:
+            segment_file.seek(self.offset)
+            return segment_file.read()
+
+    def remove(self):
+        for path in (self.path, self.offset_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class BulkSpool(object):
+    """Durable on-disk write-ahead spool for bulk actions.
+
+    Producers `put` actions, which are encoded once and, as long as fewer
+    than `max_in_flight` actions wait for the cluster, kept in memory. Once
+    the in-flight budget is exhausted, they are appended to segmented local
+    (NDJSON) files instead (and so are the following ones, until the files
+    are drained), so that producers never block on a slow cluster. Records
+    which can't be encoded are passed to the `on_failure` callback, not to
+    fail the records around them.
+
+    The spool is drained (in the background, using `start`, or explicitly,
+    using `drain`) at whatever rate the cluster accepts, using
+    `retrying_bulk` semantics, in the order the actions were put. Progress
+    is committed per chunk, so after a process restart the spool resumes
+    where it stopped (actions are delivered at least once). Items failing
+    permanently are passed to the `on_failure` callback, as are the records
+    of requests the cluster rejects as a whole (400, 413) and corrupt or
+    truncated spool records. Other transport level failures, and items
+    still rejected with a retryable status once their retries are used up,
+    leave the records in the spool to be retried later.
+
+    Appended actions are written through to the operating system, so they
+    survive a crash of the process. Unless `fsync` is enabled, a crash of
+    the machine (or a power loss) can lose recently `put` actions. Actions
+    kept in memory are written to a segment by `stop`, but are lost if the
+    process crashes; set `max_in_flight` to 0 to spool every action.
+
+    Usage:
+
+        spool = BulkSpool("/var/spool/my-app")
+        spool.start(client)
+        for action in actions:
+            spool.put(action)
+        ...
+        spool.stop()
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_max_bytes: int = 64 * 1024 * 1024,
+        segment_max_age: float = 1.0,
+        fsync: bool = False,
+        serializer=None,
+        expand_action_callback=None,
+        on_failure=None,
+        max_in_flight: int = 1000,
+    ):
+        """
+        :param directory: Directory to store the segments in.
+        :param segment_max_bytes: Size at which a segment is closed.
+        :param segment_max_age: Age (in seconds) at which a non-empty
+            segment is closed (and thus becomes available for draining).
+        :param fsync: Whether to fsync every appended action (needed for
+            the actions to survive a crash of the machine).
+        :param serializer: Serializer used to encode the actions.
+        :param expand_action_callback: Callback used to expand the actions.
+        :param on_failure: Callback called with the info of every item,
+            which failed permanently. Corrupt, truncated and invalid
+            records are reported as `spool` items. Defaults to logging it.
+        :param max_in_flight: Number of actions kept in memory (waiting to
+            be sent) before spooling to disk.
+        """
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.fsync = fsync
+        self.serializer = serializer
+        self.expand_action_callback = expand_action_callback
+        self.on_failure = on_failure or self._log_failure
+        self.max_in_flight = max_in_flight
+        self._lock = threading.RLock()
+        # In-memory records: (action, data line, time of the put) tuples.
+        self._memory = collections.deque()
+        self._counter = itertools.count()
+        self._active = None
+        self._segments = collections.deque()
+        self._depth = 0
+        self._thread = None
+        self._stop = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    @staticmethod
+    def _log_failure(info):
+        LOGGER.error("Failed to index spooled action: %s", info)
+
+    def _recover(self):
+        """Pick up the segments left over by a previous process."""
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".ndjson"):
+                continue
+            segment = _SpoolSegment(
+                os.path.join(self.directory, name),
+                created=int(name.split("-")[0]) / 1000.0,
+            )
+            if os.path.exists(segment.offset_path):
+                with open(segment.offset_path) as offset_file:
+                    segment.offset = int(offset_file.read() or 0)
+            records, _ = segment.read()
+            segment.records = sum(1 for _record in records if _record[0])
+            self._segments.append(segment)
+            self._depth += segment.records
+
+    # **************************************************
+    # ******************* Producing ********************
+    # **************************************************
+
+    def put(self, action):
+        """Append a single action to the spool.
+
+        :param action: Action (same format as for `helpers.streaming_bulk`).
+        """
+        self.put_many([action])
+
+    def put_many(self, actions):
+        """Append actions to the spool.
+
+        :param actions: Iterable of actions.
+        """
+        if self.serializer is None or self.expand_action_callback is None:
+            from anysearch.search import helpers
+
+            self.serializer = self.serializer or search.JSONSerializer()
+            self.expand_action_callback = (
+                self.expand_action_callback or helpers.expand_action
+            )
+        records = []
+        for action in actions:
+            action, data = self.expand_action_callback(action)
+            try:
+                records.append(self._encode(action, data))
+            except (TypeError, ValueError) as err:
+                self.on_failure(
+                    {
+                        "spool": {
+                            "error": "Invalid spool record: %s" % err,
+                            "data": data,
+                        }
+                    }
+                )
+        if not records:
+            return
+
+        with self._lock:
+            if (
+                self._active is None
+                and not self._segments
+                and len(self._memory) + len(records) <= self.max_in_flight
+            ):
+                now = time.time()
+                self._memory.extend(
+                    (_action, _data, now) for _action, _data, _ in records
+                )
+                return
+            self._append(
+                [_line for _, _, _lines in records for _line in _lines],
+                len(records),
+            )
+
+    def _encode(self, action, data) -> tuple:
+        """Encode a record, making sure it's a single line (two, with the
+        data) of valid JSON.
+
+        :return: (action, data line, lines) tuple.
+        """
+        lines = [self.serializer.dumps(action)]
+        if data is not None:
+            data = self.serializer.dumps(data)
+            # Pre-encoded data is passed through by the serializer.
+            json.loads(data)
+            lines.append(data)
+        if any("\n" in _line for _line in lines):
+            raise ValueError("Record spans multiple lines")
+        return action, data, lines
+
+    def _append(self, lines: list, records: int, created: float = None):
+        """Append encoded records to the active segment (or, given the
+        `created` time, to a new, closed segment, drained first)."""
+        encoded = ("\n".join(lines) + "\n").encode("utf-8")
+        with self._lock:
+            if self._active is None or created is not None:
+                timestamp = time.time() if created is None else created
+                path = os.path.join(
+                    self.directory,
+                    "%015d-%06d.ndjson"
+                    % (int(timestamp * 1000), next(self._counter)),
+                )
+                segment = _SpoolSegment(path, timestamp)
+                segment_file = open(path, "ab")
+                if created is None:
+                    self._active = (segment, segment_file)
+            else:
+                segment, segment_file = self._active
+            segment_file.write(encoded)
+            segment_file.flush()
+            if self.fsync:
+                os.fsync(segment_file.fileno())
+            segment.records += records
+            self._depth += records
+            if created is not None:
+                segment_file.close()
+                self._segments.appendleft(segment)
+            elif segment_file.tell() >= self.segment_max_bytes:
+                self._rotate()
+
+    def _spill(self):
+        """Write the in-memory records to a segment, drained before the
+        other ones."""
+        with self._lock:
+            if not self._memory:
+                return
+            lines = []
+            for action, data, _ in self._memory:
+                lines.append(self.serializer.dumps(action))
+                if data is not None:
+                    lines.append(data)
+            created = self._memory[0][2]
+            oldest = self._segments[0] if self._segments else None
+            if oldest is None and self._active is not None:
+                oldest = self._active[0]
+            if oldest is not None:
+                # Named (thus recovered) before the other segments.
+                created = min(created, oldest.created - 0.001)
+            self._append(lines, len(self._memory), created)
+            self._memory.clear()
+
+    def _rotate(self):
+        """Close the active segment and make it available for draining."""
+        with self._lock:
+            if self._active is None:
+                return
+            segment, segment_file = self._active
+            segment_file.close()
+            self._active = None
+            self._segments.append(segment)
+
+    # **************************************************
+    # ******************** Draining ********************
+    # **************************************************
+
+    def drain(self, client, chunk_size: int = 500, **kwargs) -> int:
+        """Send everything spooled so far.
+
+        :param client: `AnySearch` client instance.
+        :param chunk_size: Number of actions sent in a single request.
+        :param kwargs: Keyword arguments passed to `retrying_bulk`.
+        :return: Number of drained actions.
+        """
+        with self._lock:
+            self._rotate()
+        return self._drain(client, chunk_size=chunk_size, **kwargs)
+
+    def _drain(self, client, chunk_size: int = 500, stop=None, **kwargs) -> int:
+        drained = 0
+        retry_on_status = kwargs.get("retry_on_status", RETRYABLE_BULK_STATUSES)
+        while stop is None or not stop.is_set():
+            with self._lock:
+                # In-memory records are older than the segments.
+                records = list(itertools.islice(self._memory, chunk_size))
+            if records:
+                self._report(
+                    self._send(
+                        client,
+                        [(_action, _data) for _action, _data, _ in records],
+                        chunk_size,
+                        kwargs,
+                    ),
+                    retry_on_status,
+                )
+                drained += len(records)
+                with self._lock:
+                    for _ in records:
+                        self._memory.popleft()
+                continue
+            with self._lock:
+                if (
+                    self._active is not None
+                    and time.time() - self._active[0].created
+                    >= self.segment_max_age
+                ):
+                    self._rotate()
+                if not self._segments:
+                    break
+                segment = self._segments[0]
+            records, offset = segment.read(limit=chunk_size)
+            if records:
+                failures = [
+                    {"spool": {"error": "Corrupt spool record", "data": _data}}
+                    for _action, _data in records
+                    if _action is None
+                ]
+                records = [_record for _record in records if _record[0]]
+                failures.extend(self._send(client, records, chunk_size, kwargs))
+                self._report(failures, retry_on_status)
+                segment.commit(offset)
+                drained += len(records)
+                with self._lock:
+                    segment.records -= len(records)
+                    self._depth -= len(records)
+            else:
+                with self._lock:
+                    self._segments.popleft()
+                rest = segment.read_rest()
+                if rest:
+                    self.on_failure(
+                        {
+                            "spool": {
+                                "error": "Truncated spool record",
+                                "data": rest.decode("utf-8", "replace"),
+                            }
+                        }
+                    )
+                segment.remove()
+        return drained
+
+    def _report(self, failures: list, retry_on_status):
+        """Pass permanent failures to `on_failure`; raise (keeping the
+        records) if the cluster is unavailable or still throttling."""
+        for info in failures:
+            item = next(iter(info.values()))
+            if "exception" in item:
+                # The cluster is unavailable, keep the records.
+                raise item["exception"]
+            if item.get("status") in retry_on_status:
+                # The cluster is still throttling after the retries, keep
+                # the records (the whole chunk is resent).
+                raise search.TransportError(
+                    item["status"],
+                    "Spooled actions rejected by the cluster",
+                    info,
+                )
+        for info in failures:
+            self.on_failure(info)
+
+    @staticmethod
+    def _send(client, records, chunk_size, kwargs) -> list:
+        """Send records, returning the infos of the failed ones."""
+        if not records:
+            return []
+        try:
+            return [
+                info
+                for ok, info, _ in _iter_bulk_results(
+                    client,
+                    records,
+                    chunk_size=chunk_size,
+                    yield_ok=False,
+                    expand_action_callback=lambda _record: _record,
+                    **kwargs,
+                )
+                if not ok
+            ]
+        except search.TransportError as err:
+            status = getattr(err, "status_code", None)
+            if status not in _SPOOL_REJECTED_STATUSES:
+                raise
+            # Resent, the records would be rejected again and again.
+            return [
+                {
+                    next(iter(_action)): {
+                        "error": str(err),
+                        "status": status,
+                        "data": _data,
+                    }
+                }
+                for _action, _data in records
+            ]
+
+    def start(
+        self, client, poll_interval: float = 0.5, max_backoff=60.0, **kwargs
+    ):
+        """Start draining the spool in a background thread.
+
+        :param client: `AnySearch` client instance.
+        :param poll_interval: How often (in seconds) to look for new
+            actions, when the spool is empty.
+        :param max_backoff: Maximum back-off (in seconds) when the cluster
+            is unavailable.
+        :param kwargs: Keyword arguments passed to `retrying_bulk`.
+        """
+
+        if self._thread is not None and self._thread.is_alive():
+            raise RuntimeError("The spool is already being drained.")
+
+        def _run():
+            failures = 0
+            while not self._stop.is_set():
+                try:
+                    drained = self._drain(client, stop=self._stop, **kwargs)
+                except Exception:
+                    # Unavailable cluster, but also unreadable segments;
+                    # logged and retried, not to end the thread silently.
+                    LOGGER.exception("Failed to drain the bulk spool.")
+                    failures += 1
+                    self._stop.wait(
+                        min(max_backoff, poll_interval * 2**failures)
+                    )
+                    continue
+                failures = 0
+                if not drained:
+                    self._stop.wait(poll_interval)
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=_run, name="anysearch-bulk-spool", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: float = None):
+        """Stop the background draining.
+
+        Actions which haven't been drained yet stay in the spool (the ones
+        kept in memory are written to a segment).
+
+        :param timeout: How long to wait for the background thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                # Still sending, the in-memory records can't be spilled.
+                return
+            self._thread = None
+        self._spill()
+        self._rotate()
+
+    # **************************************************
+    # ******************** Metrics *********************
+    # **************************************************
+
+    @property
+    def depth(self) -> int:
+        """Number of actions waiting in the spool (or in memory)."""
+        return self._depth + len(self._memory)
+
+    @property
+    def oldest_age(self) -> float:
+        """Age (in seconds) of the oldest action waiting in the spool."""
+        with self._lock:
+            if self._memory:
+                created = self._memory[0][2]
+            elif self._segments:
+                created = self._segments[0].created
+            elif self._active is not None:
+                created = self._active[0].created
+            else:
+                return 0.0
+        return max(time.time() - created, 0.0)
+
+    def metrics(self) -> dict:
+        """Get the spool metrics.
+
+        :return: Dict with `depth`, `oldest_age` and `segments`.
+        """
+        with self._lock:
+            segments = len(self._segments) + (self._active is not None)
+        return {
+            "depth": self.depth,
+            "oldest_age": self.oldest_age,
+            "segments": segments,
+        }
+
+
+# **************************************************
+# **************************************************
+# ****************** Index helpers *****************
+# **************************************************
+# **************************************************
+
+# Index settings applied for the duration of a bulk load.
+BULK_LOAD_INDEX_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": 0,
+    "index.translog.flush_threshold_size": "1gb",
+}
+
+
+def _flat_index_settings(settings) -> dict:
+    """Flatten index settings into the `flat_settings` format.
+
+    Both {"refresh_interval": "-1"} and {"index": {"refresh_interval": "-1"}}
+    become {"index.refresh_interval": "-1"}.
+    """
+    flat = {}
+
+    def _flatten(prefix, value):
+        if isinstance(value, abc.Mapping):
+            for key, sub_value in value.items():
+                _flatten(f"{prefix}.{key}" if prefix else key, sub_value)
+        else:
+            flat[prefix] = value
+
+    _flatten("", settings)
+    return {
+        _key if _key.startswith("index.") else f"index.{_key}": _value
+        for _key, _value in flat.items()
+    }
+
+
+@contextlib.contextmanager
+def bulk_load_mode(
+    index,
+    profile: dict = None,
+    using=None,
+    refresh: bool = True,
+    max_num_segments: int = None,
+    wait_for_status: str = "green",
+    timeout: str = "30m",
+):
+    """Temporarily tune index settings for ingestion throughput.
+
+    Current values of the settings from the `profile` are snapshotted for
+    every concrete index behind `index` (which may be an alias or a
+    pattern), the `profile` is applied and, on leaving the context, the
+    snapshot is restored (also when an exception has been raised). Settings
+    which were not explicitly set before, are reset to their defaults. The
+    restore is attempted for every index; failures are logged and the first
+    one is raised (unless the load itself raised).
+
+    After a successful load, the index is refreshed, optionally force merged
+    and the cluster health is awaited.
+
+    Usage:
+
+        with bulk_load_mode("my-index"):
+            bulk(client, actions)
+
+    :param index: `search_dsl.Index` instance or name of the index.
+    :param profile: Settings to apply. Defaults to
+        `BULK_LOAD_INDEX_SETTINGS`.
+    :param using: Connection alias to use.
+    :param refresh: Whether to refresh the index after a successful load.
+    :param max_num_segments: If given, force merge the index after a
+        successful load down to the given number of segments.
+    :param wait_for_status: Cluster health status to wait for after a
+        successful load. Set to None to skip waiting.
+    :param timeout: How long to wait for the cluster health status.
+    :return: Snapshot of the original settings per concrete index.
+    """
+    if not isinstance(index, search_dsl.Index):
+        index = search_dsl.Index(index, using=using or "default")
+    connection = index._get_connection(using)
+    profile = _flat_index_settings(
+        BULK_LOAD_INDEX_SETTINGS if profile is None else profile
+    )
+    current = index.get_settings(using=using, flat_settings=True)
+    snapshot = {
+        _name: {_key: _data["settings"].get(_key) for _key in profile}
+        for _name, _data in current.items()
+    }
+    names = ",".join(snapshot)
+
+    loaded = False
+    try:
+        connection.indices.put_settings(index=names, body=profile)
+        yield snapshot
+        loaded = True
+    finally:
+        # Every index is restored, even if restoring another one failed.
+        errors = []
+        for name, settings in snapshot.items():
+            try:
+                connection.indices.put_settings(index=name, body=settings)
+            except Exception as err:
+                LOGGER.exception("Failed to restore the settings of %s", name)
+                errors.append(err)
+        # Not to hide the error of the load itself.
+        if errors and loaded:
+            raise errors[0]
+
+    if refresh:
+        connection.indices.refresh(index=names)
+    if max_num_segments:
+        connection.indices.forcemerge(
+            index=names, max_num_segments=max_num_segments
+        )
+    if wait_for_status:
+        connection.cluster.health(
+            index=names, wait_for_status=wait_for_status, timeout=timeout
+        )
+
+
+def _normalize_setting(value):
+    """Normalize a setting value, the way the cluster returns it."""
+    if isinstance(value, (list, tuple)):
+        return [_normalize_setting(_value) for _value in value]
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+# Mapping parameters the cluster returns as lists, even if given a value.
+_MAPPING_LIST_PARAMETERS = {"copy_to", "fields"}
+
+
+def _normalize_mapping_value(key, value):
+    """Normalize a mapping parameter value, the way the cluster returns it."""
+    if key in _MAPPING_LIST_PARAMETERS and not isinstance(
+        value, (list, tuple, dict)
+    ):
+        value = [value]
+    if isinstance(value, dict):
+        return {
+            _key: _normalize_mapping_value(_key, _value)
+            for _key, _value in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [_normalize_mapping_value(None, _value) for _value in value]
+    if isinstance(value, (bool, int, float)):
+        return _normalize_setting(value)
+    return value
+
+
+def _mapping_diff(declared: dict, existing: dict) -> dict:
+    """Return the part of the `declared` mapping missing from or differing
+    with the `existing` one (empty if there is none)."""
+    diff = {}
+    for key, value in declared.items():
+        if key in ("properties", "fields") and isinstance(value, dict):
+            current = existing.get(key, {})
+            changed = {}
+            for name, field in value.items():
+                if name not in current:
+                    changed[name] = field
+                    continue
+                field_diff = _mapping_diff(field, current[name])
+                if field_diff:
+                    # The type is needed to update `nested` fields.
+                    if "type" in field:
+                        field_diff.setdefault("type", field["type"])
+                    changed[name] = field_diff
+            if changed:
+                diff[key] = changed
+        elif key == "type":
+            # The mappings of the cluster omit the type of object fields.
+            if existing.get(key, "object") != value:
+                diff[key] = value
+        elif key not in existing or _normalize_mapping_value(
+            key, existing[key]
+        ) != _normalize_mapping_value(key, value):
+            diff[key] = value
+    return diff
+
+
+def _index_fingerprint(body: dict) -> str:
+    return hashlib.sha1(
+        json.dumps(body, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def bootstrap_indices(
+    indices, using=None, cache_path: str = None, force: bool = False
+) -> dict:
+    """Create or update indices, sending only what changed.
+
+    The settings and mappings of all the indices are fetched in a single
+    request and diffed against the declared definitions; missing indices are
+    created, changed settings and the new or changed parts of the mappings
+    are put, unchanged indices are left alone. An analysis configuration
+    differing from the one of an existing index (open or closed) raises
+    `IllegalOperation`; change it with `Index.save` on the closed index.
+    Conflicting mapping changes fail on the cluster. Aliases of existing
+    indices aren't updated.
+
+    With a `cache_path`, a fingerprint of every synced definition is kept in
+    a local (JSON) file. Indices whose definition didn't change since are
+    skipped, without any request. The cache doesn't notice changes made on
+    the cluster by others (such as deleted indices); use `force` then.
+
+    Usage:
+
+        bootstrap_indices([Article, Comment], cache_path=".index-cache")
+
+    :param indices: `Document` subclasses and `search_dsl.Index` instances.
+        Definitions of the same index are merged.
+    :param using: Connection alias to use.
+    :param cache_path: Path of the fingerprint cache file.
+    :param force: Whether to ignore the fingerprint cache.
+    :return: Dict of "cached", "unchanged", "created" or "updated" per
+        index name.
+    """
+    definitions = collections.OrderedDict()
+    for index in indices:
+        if isinstance(index, type):
+            index = index._index
+        if index._name in definitions:
+            merged = definitions[index._name]
+            merged.settings(**index._settings)
+            for doc_type in index._doc_types:
+                merged.document(doc_type)
+        else:
+            definitions[index._name] = index.clone()
+
+    bodies = {_name: _index.to_dict() for _name, _index in definitions.items()}
+    fingerprints = {
+        _name: _index_fingerprint(_body) for _name, _body in bodies.items()
+    }
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    result = collections.OrderedDict(
+        (_name, "cached")
+        for _name in definitions
+        if not force and cache.get(_name) == fingerprints[_name]
+    )
+    names = [_name for _name in definitions if _name not in result]
+    if not names:
+        return result
+
+    connection = search_dsl.connections.get_connection(
+        using or definitions[names[0]]._using
+    )
+    current = connection.indices.get(
+        index=",".join(names), ignore_unavailable=True, flat_settings=True
+    )
+    for name in names:
+        state = current.get(name)
+        if state is None:
+            # Declared by an alias name.
+            state = next(
+                (
+                    _state
+                    for _state in current.values()
+                    if name in _state.get("aliases", {})
+                ),
+                None,
+            )
+        body = bodies[name]
+        if state is None:
+            connection.indices.create(index=name, body=body)
+            result[name] = "created"
+            cache[name] = fingerprints[name]
+            continue
+
+        declared = _flat_index_settings(body.get("settings", {}))
+        existing = state.get("settings", {})
+        changed = {
+            _key: _value
+            for _key, _value in declared.items()
+            if _normalize_setting(_value) != existing.get(_key)
+        }
+        if any(_key.startswith("index.analysis.") for _key in changed):
+            raise search_dsl.IllegalOperation(
+                "You cannot update analysis configuration on an open index, "
+                "you need to close index %s first." % name
+            )
+        mapping = _mapping_diff(
+            body.get("mappings", {}), state.get("mappings", {})
+        )
+        if changed:
+            connection.indices.put_settings(index=name, body=changed)
+        if mapping:
+            connection.indices.put_mapping(index=name, body=mapping)
+        result[name] = "updated" if changed or mapping else "unchanged"
+        cache[name] = fingerprints[name]
+
+    if cache_path:
+        _write_json_atomic(cache_path, cache)
+    return result
+
+
+# **************************************************
+# **************************************************
+# ****************** Search helpers ****************
+# **************************************************
+# **************************************************
+
+
+def _client_backend(client) -> str:
+    """Detect the backend of a client instance.
+
+    Falls back to the detected search backend for clients of unknown
+    classes (mocks, wrappers, etc.).
+    """
+    module = type(client).__module__ or ""
+    if module.startswith("opensearchpy"):
+        return OPENSEARCH
+    if module.startswith("elasticsearch"):
+        return ELASTICSEARCH
+    return SEARCH_BACKEND
+
+
+def _index_path(index) -> str:
+    """Build the (quoted) index part of a URL."""
+    if not isinstance(index, str):
+        index = ",".join(index)
+    return quote(index, safe=",*")
+
+
+def open_point_in_time(client, index, keep_alive: str = "5m") -> str:
+    """Open a point in time.
+
+    Uses `POST /<index>/_pit` on Elasticsearch and
+    `POST /<index>/_search/point_in_time` on OpenSearch.
+
+    :param client: `AnySearch` client instance.
+    :param index: Index name (or a list of names).
+    :param keep_alive: How long to keep the point in time alive.
+    :return: Point in time id.
+    """
+    if _client_backend(client) == OPENSEARCH:
+        response = client.transport.perform_request(
+            "POST",
+            f"/{_index_path(index)}/_search/point_in_time",
+            params={"keep_alive": keep_alive},
+        )
+        return response["pit_id"]
+    response = client.transport.perform_request(
+        "POST", f"/{_index_path(index)}/_pit", params={"keep_alive": keep_alive}
+    )
+    return response["id"]
+
+
+def close_point_in_time(client, pit_id: str):
+    """Close a point in time.
+
+    :param client: `AnySearch` client instance.
+    :param pit_id: Point in time id.
+    """
+    if _client_backend(client) == OPENSEARCH:
+        return client.transport.perform_request(
+            "DELETE", "/_search/point_in_time", body={"pit_id": [pit_id]}
+        )
+    return client.transport.perform_request(
+        "DELETE", "/_pit", body={"id": pit_id}
+    )
+
+
+def _point_in_time_tiebreaker(client) -> dict:
+    """Sort, which makes the hits of a point in time search unique."""
+    if _client_backend(client) == OPENSEARCH:
+        return {"_id": "asc"}
+    return {"_shard_doc": "asc"}
+
+
+def _scan_slice(
+    client,
+    index,
+    query: dict,
+    slice_id: int,
+    slices: int,
+    size: int = 1000,
+    keep_alive: str = "5m",
+    pit_id: str = None,
+    sort: list = None,
+    search_after: list = None,
+    slice_field: str = None,
+    **kwargs,
+):
+    """Scan a single slice, yielding pages (lists) of hits.
+
+    With a `pit_id`, the slice is paginated using `search_after` (and can be
+    resumed from a given `search_after`), otherwise a sliced scroll is used.
+    """
+    body = dict(query)
+    body["size"] = size
+    if slices > 1:
+        body["slice"] = {"id": slice_id, "max": slices}
+        if slice_field:
+            body["slice"]["field"] = slice_field
+
+    if pit_id is None:
+        body.setdefault("sort", ["_doc"])
+        response = client.search(
+            index=index, body=body, scroll=keep_alive, **kwargs
+        )
+        scroll_id = response.get("_scroll_id")
+        try:
+            while response["hits"]["hits"]:
+                yield response["hits"]["hits"]
+                response = client.scroll(
+                    body={"scroll_id": scroll_id, "scroll": keep_alive}
+                )
+                scroll_id = response.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id:
+                client.clear_scroll(
+                    body={"scroll_id": [scroll_id]}, ignore=(404,)
+                )
+        return
+
+    body["sort"] = list(sort or []) + [_point_in_time_tiebreaker(client)]
+    while True:
+        body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+        if search_after is not None:
+            body["search_after"] = search_after
+        response = client.search(body=body, **kwargs)
+        pit_id = response.get("pit_id", pit_id)
+        hits = response["hits"]["hits"]
+        if not hits:
+            return
+        yield hits
+        search_after = hits[-1]["sort"]
+
+
+class _ScanWorkerError(object):
+    """Wraps an exception raised in a scan worker."""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _put_until_stopped(work_queue, item, stop):
+    """Put an item into a bounded queue, unless the consumer has stopped."""
+    while not stop.is_set():
+        try:
+            work_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _open_scan_point_in_time(
+    client, index, keep_alive: str, method: str = "auto"
+):
+    """Open the point in time of a sliced scan, if it should use one (see
+    `parallel_scan`).
+
+    :return: Point in time id, or None to use a sliced scroll.
+    """
+    if method != "pit" and (
+        method != "auto" or _client_backend(client) != ELASTICSEARCH
+    ):
+        return None
+    try:
+        return open_point_in_time(client, index, keep_alive)
+    except search.TransportError:
+        if method == "pit":
+            raise
+        LOGGER.info("Point in time not supported, using sliced scroll.")
+    return None
+
+
+def parallel_scan(
+    client,
+    index,
+    query=None,
+    slices: int = 4,
+    size: int = 1000,
+    keep_alive: str = "5m",
+    method: str = "auto",
+    preserve_order: bool = False,
+    max_workers: int = None,
+    prefetch: int = 2,
+    **kwargs,
+):
+    """Scan an index in parallel slices, merged into a single iterator.
+
+    The index is split into `slices` slices, each scanned in a thread of its
+    own, either using a sliced point in time (paginated with
+    `search_after`) or a sliced scroll. The differences between the point in
+    time APIs of Elasticsearch and OpenSearch are hidden. With
+    `method="auto"`, point in time is used on Elasticsearch and sliced
+    scroll on OpenSearch (not all OpenSearch versions support slicing a
+    point in time); if the point in time can't be opened, sliced scroll is
+    used instead. Contexts (point in time, scrolls) are always released,
+    also when the iteration is abandoned.
+
+    :param client: `AnySearch` client instance.
+    :param index: Index name (or a list of names).
+    :param query: Query body (dict or `search_dsl.Search`).
+    :param slices: Number of slices.
+    :param size: Number of hits per page.
+    :param keep_alive: How long to keep the contexts alive between pages.
+    :param method: "pit", "scroll" or "auto".
+    :param preserve_order: If True, hits are yielded slice by slice, in the
+        sort order within each slice. Otherwise, pages are yielded as soon
+        as any slice fetches them.
+    :param max_workers: Number of threads. Defaults to `slices`.
+    :param prefetch: Number of pages buffered per slice.
+    :param kwargs: Keyword arguments passed to the `search` calls.
+    :return: Generator of hits (raw dicts).
+    """
+    if hasattr(query, "to_dict"):
+        query = query.to_dict()
+    query = dict(query or {})
+    sort = query.pop("sort", None)
+
+    pit_id = _open_scan_point_in_time(client, index, keep_alive, method)
+    if pit_id is None and sort is not None:
+        query["sort"] = sort
+
+    stop = threading.Event()
+    if preserve_order:
+        queues = [queue.Queue(maxsize=prefetch) for _ in range(slices)]
+    else:
+        queues = [queue.Queue(maxsize=prefetch * slices)] * slices
+
+    def _worker(slice_id):
+        work_queue = queues[slice_id]
+        pages = _scan_slice(
+            client,
+            index,
+            query,
+            slice_id,
+            slices,
+            size=size,
+            keep_alive=keep_alive,
+            pit_id=pit_id,
+            sort=sort,
+            **kwargs,
+        )
+        try:
+            with contextlib.closing(pages):
+                for page in pages:
+                    if stop.is_set():
+                        return
+                    _put_until_stopped(work_queue, page, stop)
+        except Exception as err:
+            _put_until_stopped(work_queue, _ScanWorkerError(err), stop)
+        finally:
+            _put_until_stopped(work_queue, None, stop)
+
+    executor = ThreadPoolExecutor(
+        max_workers=max_workers or slices,
+        thread_name_prefix="anysearch-scan",
+    )
+    try:
+        for slice_id in range(slices):
+            executor.submit(_worker, slice_id)
+        pending = slices
+        slice_id = 0
+        while pending:
+            page = queues[slice_id].get()
+            if page is None:
+                pending -= 1
+                if preserve_order:
+                    slice_id += 1
+                continue
+            if isinstance(page, _ScanWorkerError):
+                raise page.exception
+            for hit in page:
+                yield hit
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+        if pit_id is not None:
+            try:
+                close_point_in_time(client, pit_id)
+            except search.TransportError:
+                LOGGER.warning("Failed to close point in time %s", pit_id)
+
+
+def _sort_field(sort_item) -> str:
+    """Get the field name of a sort definition."""
+    if isinstance(sort_item, abc.Mapping):
+        return next(iter(sort_item))
+    return sort_item.lstrip("-")
+
+
+class SearchPaginator(object):
+    """Paginate a `search_dsl.Search` without the deep pagination penalty.
+
+    Iterating over the paginator walks the result set using
+    `search_after`, so every page costs the same, no matter how deep it is.
+    Random access (`page`) uses `from`/`size` while within the
+    `max_result_window` and switches to `search_after` (starting from the
+    closest page already seen) beyond it.
+
+    A tiebreaker sort is added if the search's sort doesn't end with one.
+    With `consistent=True`, a point in time is kept open, so that all pages
+    come from the same view of the index; close the paginator (or use it as
+    a context manager) to release it.
+
+    The default tiebreaker is `_id` on OpenSearch. Elasticsearch 8 doesn't
+    allow sorting on `_id`, so, unless a `tiebreaker` (a unique field with
+    doc values) is given, `search_after` pages are fetched from a point in
+    time sorted by `_shard_doc` on Elasticsearch, as with `consistent=True`;
+    `from`/`size` pages are then sorted without a tiebreaker. Close the
+    paginator in this case as well.
+
+    Usage:
+
+        with SearchPaginator(search.sort("-created"), page_size=100) as pages:
+            for response in pages:
+                for hit in response:
+                    ...
+    """
+
+    def __init__(
+        self,
+        search,
+        page_size: int = 100,
+        consistent: bool = False,
+        keep_alive: str = "1m",
+        max_result_window: int = 10000,
+        tiebreaker=None,
+    ):
+        """
+        :param search: `search_dsl.Search` instance.
+        :param page_size: Number of hits per page.
+        :param consistent: Whether to keep a point in time open.
+        :param keep_alive: How long to keep the point in time alive between
+            pages.
+        :param max_result_window: The `index.max_result_window` setting.
+        :param tiebreaker: Sort on a unique field, used as a tiebreaker.
+            Defaults to `_shard_doc` (Elasticsearch, with a point in time) or
+            `_id` (OpenSearch).
+        """
+        self.search = search
+        self.page_size = page_size
+        self.consistent = consistent
+        self.keep_alive = keep_alive
+        self.max_result_window = max_result_window
+        self.tiebreaker = tiebreaker
+        self.pit_id = None
+        self._cursors = {0: None}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _get_connection(self):
+        return search_dsl.connections.get_connection(self.search._using)
+
+    def _uses_point_in_time(self) -> bool:
+        """Whether `search_after` pages are fetched from a point in time."""
+        return self.consistent or (
+            self.tiebreaker is None
+            and _client_backend(self._get_connection()) == ELASTICSEARCH
+        )
+
+    def _sort(self, point_in_time: bool = True) -> list:
+        sort = list(self.search.to_dict().get("sort", [])) or [
+            {"_score": "desc"}
+        ]
+        tiebreaker = self.tiebreaker
+        if tiebreaker is None:
+            if not point_in_time and self._uses_point_in_time():
+                # `_shard_doc` can only be sorted on in a point in time.
+                return sort
+            tiebreaker = _point_in_time_tiebreaker(self._get_connection())
+        if _sort_field(sort[-1]) != _sort_field(tiebreaker):
+            sort.append(tiebreaker)
+        return sort
+
+    def _execute(self, request):
+        if self._uses_point_in_time():
+            if self.pit_id is None:
+                self.pit_id = open_point_in_time(
+                    self._get_connection(),
+                    self.search._index or "_all",
+                    self.keep_alive,
+                )
+            request = request.index().extra(
+                pit={"id": self.pit_id, "keep_alive": self.keep_alive}
+            )
+        response = request.execute()
+        self.pit_id = getattr(response, "pit_id", self.pit_id)
+        return response
+
+    def _fetch(self, number: int):
+        """Fetch the page with the given (0-based) number using
+        `search_after`, starting from the closest known cursor."""
+        start = max(_n for _n in self._cursors if _n <= number)
+        request = self.search.sort(*self._sort()).extra(
+            from_=0, size=self.page_size
+        )
+        for current in range(start, number + 1):
+            search_after = self._cursors[current]
+            if search_after is not None:
+                request = request.extra(search_after=search_after)
+            response = self._execute(request)
+            hits = response.hits
+            if hits:
+                self._cursors[current + 1] = list(hits[-1].meta.sort)
+            elif current < number:
+                return response
+        return response
+
+    def page(self, number: int):
+        """Get a page.
+
+        :param number: Page number (starting from 1).
+        :return: `Response` of the page.
+        """
+        start, stop = (number - 1) * self.page_size, number * self.page_size
+        if not self.consistent and stop <= self.max_result_window:
+            request = self.search.sort(*self._sort(point_in_time=False))
+            response = request[start:stop].execute()
+            if response.hits and not self._uses_point_in_time():
+                # The sort values are cursors of the `search_after` pages
+                # only if they are sorted the same way.
+                self._cursors[number] = list(response.hits[-1].meta.sort)
+            return response
+        return self._fetch(number - 1)
+
+    def __iter__(self):
+        number = 0
+        while True:
+            response = self._fetch(number)
+            if not response.hits:
+                return
+            yield response
+            if len(response.hits) < self.page_size:
+                return
+            number += 1
+
+    def hits(self):
+        """Iterate over all hits of all pages."""
+        for response in self:
+            for hit in response:
+                yield hit
+
+    def close(self):
+        """Release the point in time (if any)."""
+        if self.pit_id is not None:
+            try:
+                close_point_in_time(self._get_connection(), self.pit_id)
+            except search.TransportError:
+                LOGGER.warning("Failed to close point in time %s", self.pit_id)
+            self.pit_id = None
+
+
+# **************************************************
+# **************************************************
+# ****************** Reindex ***********************
+# **************************************************
+# **************************************************
+
+
+def _write_json_atomic(path: str, data):
+    """Durably (over)write a JSON file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as json_file:
+        json.dump(data, json_file)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(tmp_path, path)
+
+
+class ReindexProgress(object):
+    """Progress of a `Reindexer` run."""
+
+    def __init__(self, total: int = None, done: int = 0):
+        self.total = total
+        self.done = done
+        self.failed = 0
+        self.started = time.monotonic()
+        self._initial = done
+        self._lock = threading.Lock()
+
+    def add(self, done: int, failed: int = 0):
+        with self._lock:
+            self.done += done
+            self.failed += failed
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since the start of the run."""
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self) -> float:
+        """Throughput (documents per second) of the current run."""
+        elapsed = self.elapsed
+        if not elapsed:
+            return 0.0
+        return (self.done - self._initial) / elapsed
+
+    @property
+    def eta(self):
+        """Estimated number of seconds left (None if unknown)."""
+        rate = self.rate
+        if self.total is None or not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def __repr__(self):
+        return (
+            f"<ReindexProgress done={self.done} total={self.total} "
+            f"failed={self.failed} rate={self.rate:.1f}/s eta={self.eta}>"
+        )
+
+
+class Reindexer(object):
+    """Reindex data from one cluster into another, in parallel slices.
+
+    The source and the target can be clusters of different backends (for
+    instance, Elasticsearch to OpenSearch); only the APIs common to both are
+    used. The source index is read in `slices` parallel slices (sliced point
+    in time, paginated with `search_after`, or sliced scroll, as chosen by
+    `parallel_scan`), every page is transformed and written into the target
+    using `retrying_bulk` by the same worker, so reads and writes happen in
+    parallel.
+
+    With a `checkpoint_path`, the position of every slice is checkpointed
+    after each written page, so an interrupted run can be resumed by running
+    a `Reindexer` with the same parameters again. A slice isn't checkpointed
+    past a page with failed documents, so a resumed run writes them again.
+    Resuming requires the source index not to change in the meantime and a
+    stable `sort`. By default, a point in time is sorted by its tiebreaker
+    only (`_shard_doc` on Elasticsearch, which, unlike `_id`, can be sorted
+    on by Elasticsearch 8 as well). Scrolls (which can't be resumed from a
+    position) read the checkpointed documents again, skipping them; they
+    are sorted by `_id` on OpenSearch and by `_doc` on Elasticsearch, whose
+    order is only stable as long as the same shard copies are read, so
+    pass a `sort` on a unique field to resume a scroll reliably. For slice
+    membership to be stable as well, set `slice_field` to a numeric field
+    with doc values.
+
+    Usage:
+
+        reindexer = Reindexer(
+            source_client, target_client, "products", "products",
+            checkpoint_path="products.checkpoint",
+            progress_callback=print,
+        )
+        progress = reindexer.run()
+    """
+
+    def __init__(
+        self,
+        source,
+        target,
+        source_index,
+        target_index: str,
+        query=None,
+        slices: int = 4,
+        chunk_size: int = 500,
+        sort: list = None,
+        slice_field: str = None,
+        transform=None,
+        checkpoint_path: str = None,
+        progress_callback=None,
+        progress_interval: float = 5.0,
+        keep_alive: str = "5m",
+        **bulk_kwargs,
+    ):
+        """
+        :param source: Source cluster client.
+        :param target: Target cluster client.
+        :param source_index: Source index name (or a list of names).
+        :param target_index: Target index name.
+        :param query: Query body (dict or `search_dsl.Search`) limiting the
+            documents to reindex.
+        :param slices: Number of parallel slices.
+        :param chunk_size: Number of documents read and written at once.
+        :param sort: Stable sort of the documents. Defaults to the point in
+            time tiebreaker or, for scrolls, to `_id` (OpenSearch) or `_doc`
+            (Elasticsearch).
+        :param slice_field: Numeric field to slice on.
+        :param transform: Callable taking the bulk action (dict with
+            `_index`, `_id`, `_source`, etc.) of every document and
+            returning the action to send (or None to skip the document).
+        :param checkpoint_path: Path of the checkpoint file.
+        :param progress_callback: Callable, which is periodically called
+            with the `ReindexProgress`.
+        :param progress_interval: Minimum interval (in seconds) between
+            progress callbacks.
+        :param keep_alive: How long to keep the point in time alive between
+            pages.
+        :param bulk_kwargs: Keyword arguments passed to `retrying_bulk`.
+        """
+        if hasattr(query, "to_dict"):
+            query = query.to_dict()
+        self.source = source
+        self.target = target
+        self.source_index = source_index
+        self.target_index = target_index
+        self.query = dict(query or {})
+        self.slices = slices
+        self.chunk_size = chunk_size
+        self.sort = sort
+        self.slice_field = slice_field
+        self.transform = transform
+        self.checkpoint_path = checkpoint_path
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+        self.keep_alive = keep_alive
+        self.bulk_kwargs = bulk_kwargs
+        self.bulk_kwargs.setdefault("yield_ok", False)
+        self.progress = None
+        self._checkpoint = None
+        self._lock = threading.Lock()
+        self._last_report = 0.0
+
+    def _load_checkpoint(self) -> dict:
+        checkpoint = {
+            "source_index": self.source_index,
+            "target_index": self.target_index,
+            "slices": self.slices,
+            "done": 0,
+            "positions": {},
+        }
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as checkpoint_file:
+                stored = json.load(checkpoint_file)
+            for key in ("source_index", "target_index", "slices"):
+                if stored[key] != checkpoint[key]:
+                    raise ValueError(
+                        f"Checkpoint {self.checkpoint_path} doesn't match "
+                        f"the reindex parameters ({key})."
+                    )
+            checkpoint = stored
+        return checkpoint
+
+    def _save_checkpoint(self, slice_id: int, position, done: int):
+        with self._lock:
+            self._checkpoint["positions"][str(slice_id)] = position
+            self._checkpoint["done"] += done
+            if self.checkpoint_path:
+                _write_json_atomic(self.checkpoint_path, self._checkpoint)
+
+    def _report(self, force: bool = False):
+        if not self.progress_callback:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report < self.progress_interval:
+                return
+            self._last_report = now
+        self.progress_callback(self.progress)
+
+    def _action(self, hit) -> dict:
+        action = {
+            "_index": self.target_index,
+            "_id": hit["_id"],
+            "_source": hit.get("_source", {}),
+        }
+        if "_routing" in hit:
+            action["_routing"] = hit["_routing"]
+        if self.transform is not None:
+            action = self.transform(action)
+        return action
+
+    def _sort(self, pit_id: str) -> list:
+        if self.sort is not None:
+            return self.sort
+        if pit_id is not None:
+            # `_scan_slice` appends the point in time tiebreaker.
+            return []
+        if _client_backend(self.source) == OPENSEARCH:
+            return [{"_id": "asc"}]
+        # Elasticsearch 8 doesn't allow sorting on `_id` by default.
+        return ["_doc"]
+
+    def _reindex_slice(self, slice_id: int, pit_id: str):
+        position = self._checkpoint["positions"].get(str(slice_id))
+        if position is True:
+            return
+        # The position is the `search_after` of a point in time, the number
+        # of read documents of a scroll.
+        expected = list if pit_id is not None else int
+        if position is not None and not isinstance(position, expected):
+            raise ValueError(
+                f"Checkpoint {self.checkpoint_path} doesn't match the scan "
+                f"method of the source."
+            )
+        query = self.query
+        offset = skip = 0
+        sort = self._sort(pit_id)
+        if pit_id is None:
+            query = dict(query, sort=sort)
+            offset = skip = position or 0
+            position = None
+        pages = _scan_slice(
+            self.source,
+            self.source_index,
+            query,
+            slice_id,
+            self.slices,
+            size=self.chunk_size,
+            keep_alive=self.keep_alive,
+            pit_id=pit_id,
+            sort=sort,
+            search_after=position,
+            slice_field=self.slice_field,
+        )
+        acknowledged = True
+        with contextlib.closing(pages):
+            for page in pages:
+                if skip:
+                    skipped, page = page[:skip], page[skip:]
+                    skip -= len(skipped)
+                    if not page:
+                        continue
+                offset += len(page)
+                actions = [
+                    _action
+                    for _action in map(self._action, page)
+                    if _action is not None
+                ]
+                failed = 0
+                for ok, info in retrying_bulk(
+                    self.target,
+                    actions,
+                    chunk_size=self.chunk_size,
+                    **self.bulk_kwargs,
+                ):
+                    if not ok:
+                        failed += 1
+                        LOGGER.error("Failed to reindex document: %s", info)
+                self.progress.add(len(page), failed)
+                acknowledged = acknowledged and not failed
+                if acknowledged:
+                    self._save_checkpoint(
+                        slice_id,
+                        page[-1]["sort"] if pit_id is not None else offset,
+                        len(page),
+                    )
+                self._report()
+        if acknowledged:
+            self._save_checkpoint(slice_id, True, 0)
+
+    def run(self) -> ReindexProgress:
+        """Run (or resume) the reindex.
+
+        :return: Final progress.
+        """
+        self._checkpoint = self._load_checkpoint()
+        count_body = None
+        if "query" in self.query:
+            count_body = {"query": self.query["query"]}
+        response = self.source.count(index=self.source_index, body=count_body)
+        self.progress = ReindexProgress(
+            response["count"], self._checkpoint["done"]
+        )
+        pit_id = _open_scan_point_in_time(
+            self.source, self.source_index, self.keep_alive
+        )
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.slices, thread_name_prefix="anysearch-reindex"
+            ) as executor:
+                futures = [
+                    executor.submit(self._reindex_slice, _slice_id, pit_id)
+                    for _slice_id in range(self.slices)
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            try:
+                if pit_id is not None:
+                    close_point_in_time(self.source, pit_id)
+            except search.TransportError:
+                LOGGER.warning("Failed to close point in time %s", pit_id)
+        self._report(force=True)
+        return self.progress
+
+
+# **************************************************
+# **************************************************
+# ****************** Columnar export ***************
+# **************************************************
+# **************************************************
+
+# `array.array` type codes for the (numpy style) dtypes, used when numpy
+# isn't installed (or not wanted).
+_ARRAY_TYPECODES = {
+    "f8": "d",
+    "float64": "d",
+    "f4": "f",
+    "float32": "f",
+    "i8": "q",
+    "int64": "q",
+    "i4": "i",
+    "int32": "i",
+    "bool": "b",
+}
+
+
+def _import_numpy():
+    """Import numpy, if installed."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _column_getter(path: str, root: str = None):
+    """Build a function getting the value of a (dotted) field path.
+
+    Paths starting with an underscore (`_id`, `_index`, `_score`, etc.) are
+    read from the hit itself, `fields.<name>` paths from the (docvalue/
+    stored) `fields` of the hit, everything else from the `root` (`_source`
+    for hits, nothing for aggregation buckets).
+    """
+    if root and path.startswith("_"):
+        return lambda _item: _item.get(path)
+    if root and path.startswith("fields."):
+        name = path.split(".", 1)[1]
+
+        def _get_field(item):
+            values = item.get("fields", {}).get(name)
+            return values[0] if values else None
+
+        return _get_field
+
+    keys = path.split(".")
+
+    def _get(item):
+        value = item.get(root, {}) if root else item
+        for key in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    if len(keys) == 1 and root:
+        key = keys[0]
+        return lambda _item: _item.get(root, {}).get(key)
+    return _get
+
+
+class _Column(object):
+    """Column growing in chunks.
+
+    Values are collected into a (short) list and moved into a preallocated
+    output buffer (numpy array or `array.array`) once per chunk, so that the
+    conversion happens in bulk, in C.
+    """
+
+    def __init__(self, dtype, numpy, chunk_size, size_hint=None):
+        self.numpy = numpy
+        self.chunk_size = chunk_size
+        self.pending = []
+        if numpy is not None:
+            self.dtype = numpy.dtype(dtype)
+            missing = {"f": numpy.nan, "c": numpy.nan, "M": None, "O": None}
+            self.missing = (
+                missing[self.dtype.kind]
+                if self.dtype.kind in missing
+                else self.dtype.type(0)
+            )
+            self.data = numpy.empty(size_hint or chunk_size, dtype=self.dtype)
+            self.size = 0
+        else:
+            self.typecode = _ARRAY_TYPECODES.get(str(dtype))
+            self.missing = {"d": float("nan"), "f": float("nan")}.get(
+                self.typecode, 0 if self.typecode else None
+            )
+            self.data = array(self.typecode) if self.typecode else []
+
+    def flush(self):
+        values = self.pending
+        if not values:
+            return
+        self.pending = []
+        if self.numpy is not None and self.dtype.kind == "M":
+            values = dates_to_datetime64(
+                values, self.numpy.datetime_data(self.dtype)[0]
+            )
+        elif None in values and self.missing is not None:
+            values = [self.missing if _v is None else _v for _v in values]
+        if self.numpy is None:
+            self.data.extend(values)
+            return
+        end = self.size + len(values)
+        if end > len(self.data):
+            # Grown geometrically, so that the copying stays linear.
+            grown = self.numpy.empty(
+                max(end, 2 * len(self.data)), dtype=self.dtype
+            )
+            grown[: self.size] = self.data[: self.size]
+            self.data = grown
+        start = self.size
+        if self.dtype.kind == "O":
+            # Element wise, so that list values aren't broadcast.
+            for offset, value in enumerate(values, start):
+                self.data[offset] = value
+        else:
+            self.data[start:end] = values
+        self.size = end
+
+    def result(self):
+        self.flush()
+        if self.numpy is None:
+            return self.data
+        return self.data[: self.size]
+
+
+def _to_columns(items, fields, dtypes, root, chunk_size, use_numpy, size_hint):
+    numpy = _import_numpy() if use_numpy is not False else None
+    if use_numpy and numpy is None:
+        raise ImportError("numpy is required for `use_numpy=True`.")
+    dtypes = dtypes or {}
+    getters = [_column_getter(_field, root) for _field in fields]
+    columns = [
+        _Column(dtypes.get(_field, "O"), numpy, chunk_size, size_hint)
+        for _field in fields
+    ]
+    pairs = list(zip(getters, columns))
+    count = 0
+    for item in items:
+        for getter, column in pairs:
+            column.pending.append(getter(item))
+        count += 1
+        if count == chunk_size:
+            count = 0
+            for column in columns:
+                column.flush()
+    return {_field: _col.result() for _field, _col in zip(fields, columns)}
+
+
+def hits_to_columns(
+    hits,
+    fields,
+    dtypes: dict = None,
+    chunk_size: int = 65536,
+    use_numpy: bool = None,
+    size_hint: int = None,
+) -> dict:
+    """Decode raw hits straight into columns.
+
+    No per-hit wrapper objects (`Hit`, `AttrDict`) are created; values are
+    read from the raw hits and moved into the output arrays in chunks.
+
+    :param hits: Iterable of raw hits (dicts), for instance from
+        `parallel_scan` or `helpers.scan`.
+    :param fields: Field paths. Dotted paths are read from `_source`,
+        `fields.<name>` from the docvalue/stored fields and `_id`, `_index`,
+        `_score`, etc. from the hit itself.
+    :param dtypes: Numpy dtypes (such as "f8", "i8", "bool") per field.
+        Fields without a dtype become object arrays (lists without numpy).
+        Date fields can be given a `datetime64` dtype (such as
+        "datetime64[ms]", see `dates_to_datetime64`). Missing values become
+        NaN (floats), NaT (dates), 0 (integers, `False` for booleans) or
+        None. Zeros filled in can't be told apart from real ones, so give
+        fields, which may be missing, a float dtype.
+    :param chunk_size: Number of hits converted at once.
+    :param use_numpy: Whether to produce numpy arrays. Defaults to using
+        numpy if installed, otherwise `array.array` (for numeric dtypes) and
+        lists are produced.
+    :param size_hint: Expected number of hits, used for preallocation.
+    :return: Dict of columns per field.
+    """
+    return _to_columns(
+        hits, fields, dtypes, "_source", chunk_size, use_numpy, size_hint
+    )
+
+
+def buckets_to_columns(
+    buckets,
+    fields,
+    dtypes: dict = None,
+    chunk_size: int = 65536,
+    use_numpy: bool = None,
+) -> dict:
+    """Decode aggregation buckets straight into columns.
+
+    :param buckets: Buckets of a bucket aggregation (raw dicts or
+        `AttrDict` instances), for instance
+        `response.aggregations.per_day.buckets`.
+    :param fields: Dotted paths within a bucket, such as "key",
+        "doc_count" or "avg_price.value".
+    :param dtypes: Numpy dtypes per field (see `hits_to_columns`).
+    :param chunk_size: Number of buckets converted at once.
+    :param use_numpy: Whether to produce numpy arrays.
+    :return: Dict of columns per field.
+    """
+    buckets = (
+        _bucket.to_dict() if hasattr(_bucket, "to_dict") else _bucket
+        for _bucket in buckets
+    )
+    return _to_columns(
+        buckets, fields, dtypes, None, chunk_size, use_numpy, None
+    )
+
+
+def search_to_columns(
+    search,
+    fields,
+    dtypes: dict = None,
+    slices: int = 1,
+    chunk_size: int = 65536,
+    use_numpy: bool = None,
+    **kwargs,
+) -> dict:
+    """Export the hits of a `search_dsl.Search` into columns.
+
+    Only the requested `_source` fields are fetched. The hits are scanned
+    (in parallel, with `slices` > 1) and decoded with `hits_to_columns`.
+
+    :param search: `search_dsl.Search` instance.
+    :param fields: Field paths (see `hits_to_columns`).
+    :param dtypes: Numpy dtypes per field (see `hits_to_columns`).
+    :param slices: Number of parallel slices (see `parallel_scan`).
+    :param chunk_size: Number of hits converted at once.
+    :param use_numpy: Whether to produce numpy arrays.
+    :param kwargs: Keyword arguments passed to `parallel_scan`.
+    :return: Dict of columns per field.
+    """
+    source = [
+        _field
+        for _field in fields
+        if not _field.startswith("_") and not _field.startswith("fields.")
+    ]
+    search = search.source(source or False)
+    hits = parallel_scan(
+        search_dsl.connections.get_connection(search._using),
+        search._index or "_all",
+        search,
+        slices=slices,
+        **kwargs,
+    )
+    return hits_to_columns(hits, fields, dtypes, chunk_size, use_numpy)
+
+
+def columns_to_dataframe(columns: dict):
+    """Turn columns into a `pandas.DataFrame` (pandas is required)."""
+    import pandas
+
+    return pandas.DataFrame(columns, copy=False)
+
+
+def columns_to_arrow(columns: dict):
+    """Turn columns into a `pyarrow.Table` (pyarrow is required)."""
+    import pyarrow
+
+    return pyarrow.table(
+        {
+            _name: list(_col) if isinstance(_col, array) else _col
+            for _name, _col in columns.items()
+        }
+    )
+
+
+# **************************************************
+# **************************************************
+# ******************* Hit records ******************
+# **************************************************
+# **************************************************
+
+# Hit keys having a slot of their own in `HitRecordMeta` (the rest goes to
+# `HitRecordMeta._extra`).
+_HIT_RECORD_META_KEYS = {
+    "_id": "id",
+    "_index": "index",
+    "_score": "score",
+    "_routing": "routing",
+    "sort": "sort",
+}
+_HIT_RECORD_META_EXCLUDE = ("_source", "fields")
+_HIT_RECORD_CLASSES = {}
+
+
+def _wrap_record_value(value):
+    """Wrap (lazily, on access) nested objects for attribute access."""
+    if isinstance(value, dict):
+        return search_dsl.AttrDict(value)
+    if isinstance(value, list):
+        return search_dsl.AttrList(value)
+    return value
+
+
+class HitRecordMeta(object):
+    """Slotted counterpart of the `meta` of a `Hit`.
+
+    The common keys (`id`, `index`, `score`, `routing`, `sort`) have slots
+    of their own, the others (`highlight`, `inner_hits`, `version`, etc.)
+    are kept in a dict, created only if there are any.
+    """
+
+    __slots__ = ("id", "index", "score", "routing", "sort", "_extra")
+
+    def __init__(self, hit: dict):
+        self.id = self.index = self.score = self.routing = self.sort = None
+        extra = None
+        for key, value in hit.items():
+            name = _HIT_RECORD_META_KEYS.get(key)
+            if name is not None:
+                setattr(self, name, value)
+            elif key not in _HIT_RECORD_META_EXCLUDE:
+                if extra is None:
+                    extra = {}
+                extra[key[1:] if key.startswith("_") else key] = value
+        self._extra = extra
+
+    def __getattr__(self, name):
+        extra = object.__getattribute__(self, "_extra")
+        if extra is None or name not in extra:
+            raise AttributeError(name)
+        return _wrap_record_value(extra[name])
+
+    def __contains__(self, name):
+        return getattr(self, name, None) is not None
+
+    def to_dict(self) -> dict:
+        data = {
+            _name: getattr(self, _name)
+            for _name in _HIT_RECORD_META_KEYS.values()
+            if getattr(self, _name) is not None
+        }
+        data.update(self._extra or {})
+        return data
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.to_dict())
+
+
+class HitRecord(object):
+    """Compact, slotted representation of a hit.
+
+    Subclasses are generated (with `hit_record_class`) per `Document`
+    subclass or per `_source` projection, having a slot per (top-level)
+    field. Values are kept as decoded; nested objects and lists are wrapped
+    in `AttrDict`/`AttrList` only when accessed, so the attribute access is
+    compatible with `Hit`. Fields not known to the class are kept in a dict
+    (created only if there are any). Known fields missing in the hit are
+    `None`, like the fields of a `Document`.
+
+    Usage:
+
+        Record = hit_record_class(["title", "author"])
+        records = [Record.from_hit(_hit) for _hit in hits]
+        records[0].title
+        records[0].meta.id
+    """
+
+    __slots__ = ("meta", "_extra")
+    _fields = {}
+
+    @classmethod
+    def from_hit(cls, hit: dict) -> "HitRecord":
+        """Build a record from a raw hit.
+
+        :param hit: Raw hit (dict), as returned by the search APIs.
+        """
+        record = cls.__new__(cls)
+        record.meta = HitRecordMeta(hit)
+        fields = cls._fields
+        extra = None
+        data = hit.get("_source") or {}
+        if "fields" in hit:
+            data = dict(data, **hit["fields"])
+        for key, value in data.items():
+            slot = fields.get(key)
+            if slot is not None:
+                setattr(record, slot, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        record._extra = extra
+        return record
+
+    def __getattr__(self, name):
+        # Only called for names not found otherwise: fields not known to the
+        # class and unset slots (read with a default by the properties).
+        if name.startswith("__"):
+            raise AttributeError(name)
+        extra = object.__getattribute__(self, "_extra")
+        if extra is None or name not in extra:
+            raise AttributeError(
+                "{!r} object has no attribute {!r}".format(
+                    self.__class__.__name__, name
+                )
+            )
+        return _wrap_record_value(extra[name])
+
+    def __getitem__(self, name):
+        # Fields only, never the attributes (`meta`, `to_dict`, etc.).
+        slot = self._fields.get(name)
+        if slot is not None:
+            try:
+                return _wrap_record_value(getattr(self, slot))
+            except AttributeError:
+                raise KeyError(name)
+        extra = self._extra
+        if extra is None or name not in extra:
+            raise KeyError(name)
+        return _wrap_record_value(extra[name])
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __eq__(self, other):
+        if not isinstance(other, HitRecord):
+            return NotImplemented
+        return (
+            self.to_dict() == other.to_dict()
+            and self.meta.to_dict() == other.meta.to_dict()
+        )
+
+    def to_dict(self) -> dict:
+        """Return the (`_source`) data of the hit."""
+        data = {}
+        for name, slot in self._fields.items():
+            value = getattr(self, slot, None)
+            if value is not None:
+                data[name] = value
+        data.update(self._extra or {})
+        return data
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.to_dict())
+
+
+def _record_property(slot: str) -> property:
+    def _get(self):
+        return _wrap_record_value(getattr(self, slot, None))
+
+    def _set(self, value):
+        setattr(self, slot, value)
+
+    return property(_get, _set)
+
+
+def hit_record_class(source, name: str = None) -> type:
+    """Generate (or get a cached) `HitRecord` subclass.
+
+    :param source: `Document` subclass (the fields of its mapping are used)
+        or an iterable of (possibly dotted) `_source` field paths; the
+        top-level names are used.
+    :param name: Name of the class. Defaults to the name of the document
+        class, suffixed with "Record".
+    :return: `HitRecord` subclass.
+    """
+    if isinstance(source, type):
+        fields = tuple(source._doc_type.mapping)
+        key = source
+        name = name or source.__name__ + "Record"
+    else:
+        fields = tuple(
+            collections.OrderedDict.fromkeys(
+                _path.split(".", 1)[0] for _path in source
+            )
+        )
+        key = fields
+        name = name or "HitRecord"
+    if (key, name) in _HIT_RECORD_CLASSES:
+        return _HIT_RECORD_CLASSES[(key, name)]
+
+    # Fields clashing with the attributes of `HitRecord` (or not being
+    # identifiers) are kept as extra data, available via `__getitem__`.
+    fields = [
+        _field
+        for _field in fields
+        if _field.isidentifier() and not hasattr(HitRecord, _field)
+    ]
+    slots = {_field: "_f_" + _field for _field in fields}
+    namespace = {
+        "__slots__": tuple(slots.values()),
+        "_fields": slots,
+    }
+    for field, slot in slots.items():
+        namespace[field] = _record_property(slot)
+    record_class = type(name, (HitRecord,), namespace)
+    _HIT_RECORD_CLASSES[(key, name)] = record_class
+    return record_class
+
+
+def to_records(hits, record_class: type = None) -> list:
+    """Turn hits into `HitRecord` instances.
+
+    :param hits: Raw hits (dicts) or a `Response`; the `Hit` instances of a
+        response aren't created.
+    :param record_class: `HitRecord` subclass (see `hit_record_class`).
+        Defaults to a class without fields (all data is kept as extra data).
+    :return: List of records.
+    """
+    if hasattr(hits, "to_dict") and not isinstance(hits, dict):
+        hits = hits.to_dict()["hits"]["hits"]
+    from_hit = (record_class or HitRecord).from_hit
+    return [from_hit(_hit) for _hit in hits]
+
+
+def execute_records(search, record_class: type = None) -> list:
+    """Execute a `search_dsl.Search`, returning `HitRecord` instances.
+
+    :param search: `search_dsl.Search` instance.
+    :param record_class: `HitRecord` subclass. Defaults to one generated
+        for the `_source` projection (`search.source(...)`) of the search,
+        or, without a projection, for the document class of the search.
+    :return: List of records.
+    """
+    if record_class is None:
+        source = search._source
+        if isinstance(source, dict):
+            source = source.get("includes")
+        if isinstance(source, str):
+            source = [source]
+        if source:
+            record_class = hit_record_class(source)
+        elif len(search._doc_type) == 1 and isinstance(
+            search._doc_type[0], type
+        ):
+            record_class = hit_record_class(search._doc_type[0])
+    return to_records(search.execute(), record_class)
+
+
+# **************************************************
+# **************************************************
+# ****************** Lazy documents ****************
+# **************************************************
+# **************************************************
+
+
+class LazyDocumentMixin(object):
+    """Mixin deferring the deserialization of `Document` fields.
+
+    Documents built from search responses (or `get`/`mget`) keep the raw
+    `_source` values; a field is deserialized (`Date`, `Object`, `Nested`,
+    etc.) on its first access and cached. Serialization (`to_dict`, `save`,
+    `update`, pickling), validation (`full_clean`) and comparison
+    deserialize the remaining fields first, so the behaviour is the same as
+    that of an eager document. Put it before `Document` in the bases.
+
+    Usage:
+
+        class Article(LazyDocumentMixin, Document):
+            title = Text()
+            published = Date()
+
+        for article in Article.search().execute():
+            article.title  # `published` is never deserialized
+    """
+
+    # Names of the fields still holding raw values. A class attribute, so
+    # that the (instance) attribute isn't stored as a field by `AttrDict`.
+    _lazy_fields_ = frozenset()
+
+    def _from_dict(self, data):
+        get_field = self._ObjectBase__get_field
+        pending = set()
+        for key, value in data.items():
+            field = get_field(key)
+            if field and field._coerce:
+                pending.add(key)
+                self._d_[key] = value
+            else:
+                setattr(self, key, value)
+        self._lazy_fields_ = pending
+
+    def _deserialize_lazy_field(self, name: str):
+        self._lazy_fields_.discard(name)
+        if name in self._d_:
+            field = self._ObjectBase__get_field(name)
+            self._d_[name] = field.deserialize(self._d_[name])
+
+    def _deserialize_lazy_fields(self):
+        for name in list(self._lazy_fields_):
+            self._deserialize_lazy_field(name)
+
+    def __getattr__(self, name):
+        if name in self._lazy_fields_:
+            self._deserialize_lazy_field(name)
+        return super(LazyDocumentMixin, self).__getattr__(name)
+
+    def __getitem__(self, key):
+        if key in self._lazy_fields_:
+            self._deserialize_lazy_field(key)
+        return super(LazyDocumentMixin, self).__getitem__(key)
+
+    def __setattr__(self, name, value):
+        if name in self._lazy_fields_:
+            self._lazy_fields_.discard(name)
+        super(LazyDocumentMixin, self).__setattr__(name, value)
+
+    def __delattr__(self, name):
+        if name in self._lazy_fields_:
+            self._lazy_fields_.discard(name)
+        super(LazyDocumentMixin, self).__delattr__(name)
+
+    def __eq__(self, other):
+        for document in (self, other):
+            if isinstance(document, LazyDocumentMixin):
+                document._deserialize_lazy_fields()
+        return super(LazyDocumentMixin, self).__eq__(other)
+
+    def to_dict(self, *args, **kwargs):
+        self._deserialize_lazy_fields()
+        return super(LazyDocumentMixin, self).to_dict(*args, **kwargs)
+
+    def full_clean(self):
+        self._deserialize_lazy_fields()
+        super(LazyDocumentMixin, self).full_clean()
+
+
+# **************************************************
+# **************************************************
+# ****************** Date parsing ******************
+# **************************************************
+# **************************************************
+
+# Strict ISO 8601 (as produced by the search engines and `isoformat()`):
+# a date, optionally followed by a time, optionally followed by "Z" or an
+# UTC offset. Anything else is left to `dateutil`.
+_ISO_DATETIME_RE = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d)"
+    r"(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,9}))?)?"
+    r"(Z|[+-]\d\d(?::?\d\d)?)?)?\Z"
+)
+_EPOCH = datetime.datetime(1970, 1, 1)
+_DATE_OFFSET_TZINFOS = {}
+
+
+def _offset_tzinfo(offset: str):
+    """Return the `tzinfo` `dateutil` would use for an UTC offset.
+
+    Zero offsets become `tzlocal()` or `tzutc()`, depending on the local
+    time zone, others `tzoffset(None, seconds)`. The answer is taken from
+    `dateutil` itself, once per offset. `None` is returned (meaning that
+    the values have to be parsed by `dateutil`) for `tzlocal()` with
+    daylight saving time, where the result depends on the date.
+    """
+    try:
+        return _DATE_OFFSET_TZINFOS[offset]
+    except KeyError:
+        pass
+    from dateutil import parser, tz
+
+    tzinfo = parser.parse("2000-01-01T00:00:00" + offset).tzinfo
+    if isinstance(tzinfo, tz.tzlocal) and tzinfo._hasdst:
+        tzinfo = None
+    _DATE_OFFSET_TZINFOS[offset] = tzinfo
+    return tzinfo
+
+
+def parse_date(value: str) -> datetime.datetime:
+    """Parse a date string, like `dateutil.parser.parse` does.
+
+    Strict ISO 8601 strings (with or without "Z" or an UTC offset) are
+    parsed without `dateutil`, giving identical results. Other strings are
+    parsed by `dateutil`.
+
+    :param value: Date string.
+    :return: `datetime.datetime` instance.
+    """
+    match = _ISO_DATETIME_RE.match(value)
+    if match is not None:
+        groups = match.groups()
+        fraction, offset = groups[6], groups[7]
+        tzinfo = _offset_tzinfo(offset) if offset else None
+        if tzinfo is not None or not offset:
+            try:
+                return datetime.datetime(
+                    int(groups[0]),
+                    int(groups[1]),
+                    int(groups[2]),
+                    int(groups[3] or 0),
+                    int(groups[4] or 0),
+                    int(groups[5] or 0),
+                    # `dateutil` truncates to microseconds.
+                    int(fraction[:6].ljust(6, "0")) if fraction else 0,
+                    tzinfo,
+                )
+            except ValueError:
+                pass
+    from dateutil import parser
+
+    return parser.parse(value)
+
+
+# Shared memo cache of `parse_date`, used by the columnar export.
+_cached_parse_date = functools.lru_cache(maxsize=4096)(parse_date)
+
+
+def dates_to_datetime64(values, unit: str = "ms", parse=_cached_parse_date):
+    """Convert dates into a numpy `datetime64` array (numpy is required).
+
+    The strings are parsed with (a cached) `parse_date` and the conversion
+    into the array happens at once, in numpy. Aware dates are converted to
+    UTC; naive dates and integers (epoch_millis) are taken as UTC, as the
+    search engines do.
+
+    :param values: Date strings, integers (epoch_millis), `datetime`
+        instances or `None` (becoming `NaT`).
+    :param unit: Unit of the `datetime64` array.
+    :param parse: Function parsing the strings.
+    :return: numpy array.
+    """
+    import numpy
+
+    utc = datetime.timezone.utc
+    dates = []
+    for value in values:
+        if isinstance(value, str):
+            value = parse(value)
+        elif isinstance(value, int) and not isinstance(value, bool):
+            value = _EPOCH + datetime.timedelta(milliseconds=value)
+        if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+            value = value.astimezone(utc).replace(tzinfo=None)
+        dates.append(value)
+    return numpy.array(dates, dtype="datetime64[{}]".format(unit))
+
+
+def fast_date_field(cache_size: int = None, **kwargs):
+    """Create a `search_dsl.Date` field deserializing with `parse_date`.
+
+    Values are deserialized exactly like the `search_dsl.Date` field does,
+    but strict ISO 8601 strings are parsed without `dateutil`.
+
+    Usage:
+
+        class Event(Document):
+            timestamp = fast_date_field(cache_size=10000)
+
+    :param cache_size: Size of the (per field) memo cache of the parsed
+        values, for documents having many repeated timestamps. No cache by
+        default.
+    :param kwargs: Keyword arguments of `search_dsl.Date`.
+    :return: Field instance.
+    """
+    global _FastDate
+
+    if _FastDate is None:
+
+        class FastDate(search_dsl.Date):
+            """`Date` field parsing strict ISO 8601 strings fast."""
+
+            _parse = staticmethod(parse_date)
+
+            def _deserialize(self, data):
+                if isinstance(data, str):
+                    try:
+                        data = self._parse(data)
+                    except Exception as err:
+                        raise search_dsl.ValidationException(
+                            "Could not parse date from the value (%r)" % data,
+                            err,
+                        )
+                return super(FastDate, self)._deserialize(data)
+
+        _FastDate = FastDate
+
+    field = _FastDate(**kwargs)
+    if cache_size:
+        field._parse = functools.lru_cache(maxsize=cache_size)(parse_date)
+    return field
+
+
+# Created on the first call of `fast_date_field`, not to import the backend
+# when importing this module.
+_FastDate = None
+
+
+# **************************************************
+# **************************************************
+# **************** Prepared searches ***************
+# **************************************************
+# **************************************************
+
+
+class Param(object):
+    """Named placeholder of a value in a prepared search.
+
+    Usage:
+
+        Search().filter("term", user=Param("user"))
+    """
+
+    __slots__ = ("name",)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self):
+        return "Param({!r})".format(self.name)
+
+
+def _split_search_body(search, default) -> tuple:
+    """Serialize a search (to JSON), splitting it at the `Param` values.
+
+    :param search: `search_dsl.Search` instance.
+    :param default: `default` function of the JSON serializer.
+    :return: Tuple of the static chunks of the body and of the names of the
+        placeholders between them.
+    """
+    # Placeholders are serialized as (unique) marker strings first.
+    marker = "@@anysearch-param-{}-".format(os.urandom(8).hex())
+
+    def _default(value):
+        if isinstance(value, Param):
+            return marker + value.name + "@@"
+        return default(value)
+
+    body = json.dumps(
+        search.to_dict(),
+        default=_default,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    parts = re.split('"{}(.*?)@@"'.format(re.escape(marker)), body)
+    return parts[::2], parts[1::2]
+
+
+def _msearch_item_result(request, raw: dict):
+    """Turn an item of a multi search response into a response (of the
+    `request` search) or a `search.TransportError` instance."""
+    if "error" in raw:
+        error = raw["error"]
+        return search.TransportError(
+            raw.get("status", "N/A"),
+            error.get("type") if isinstance(error, dict) else error,
+            raw,
+        )
+    return request._response_class(request, raw)
+
+
+def _check_params(expected: set, params: dict):
+    """Check that exactly the `expected` parameters are given."""
+    missing = expected.difference(params)
+    if missing:
+        raise ValueError(
+            "Missing parameters: {}".format(", ".join(sorted(missing)))
+        )
+    unknown = set(params).difference(expected)
+    if unknown:
+        raise ValueError(
+            "Unknown parameters: {}".format(", ".join(sorted(unknown)))
+        )
+
+
+class PreparedSearch(object):
+    """`search_dsl.Search` compiled once into a pre-serialized body.
+
+    The search (with `Param` placeholders in place of the values changing
+    per call) is serialized once; the body is split at the placeholders.
+    Binding parameters only serializes the parameter values and joins them
+    with the prepared chunks, no DSL objects are built.
+
+    Usage:
+
+        prepared = PreparedSearch(
+            Search(index="orders")
+            .filter("term", customer=Param("customer"))
+            .filter("range", created={"gte": Param("since")})
+            .sort("-created")
+        )
+        response = prepared.execute(customer="c1", since="now-1d")
+    """
+
+    def __init__(self, search):
+        """
+        :param search: `search_dsl.Search` instance with `Param`
+            placeholders.
+        """
+        self.search = search
+        self._default = search_dsl.connections.get_connection(
+            search._using
+        ).transport.serializer.default
+        #: Static chunks of the body, between the placeholders, and names of
+        #: the placeholders, in order of appearance.
+        self.chunks, self.names = _split_search_body(search, self._default)
+        self.params = set(self.names)
+
+    def render(self, **params) -> str:
+        """Build the (JSON) body for the given parameter values."""
+        _check_params(self.params, params)
+        values = {
+            _name: json.dumps(
+                _value,
+                default=self._default,
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+            for _name, _value in params.items()
+        }
+        chunks = self.chunks
+        parts = [chunks[0]]
+        for name, chunk in zip(self.names, itertools.islice(chunks, 1, None)):
+            parts.append(values[name])
+            parts.append(chunk)
+        return "".join(parts)
+
+    def execute(self, **params):
+        """Execute the search with the given parameter values.
+
+        :return: `search_dsl` response instance (as `Search.execute`
+            returns).
+        """
+        search = self.search
+        client = search_dsl.connections.get_connection(search._using)
+        raw = client.search(
+            index=search._index, body=self.render(**params), **search._params
+        )
+        return search._response_class(search, raw)
+
+
+class SearchTemplate(object):
+    """`search_dsl.Search` stored as a mustache search template.
+
+    The search (with `Param` placeholders, see `PreparedSearch`) is turned
+    into a mustache template, rendering each parameter with `toJson`, and
+    stored on the cluster under a versioned id (the name suffixed with a
+    hash of the template source), so that changed definitions never clash
+    with the ones used by running (older) code. Calls send only the id and
+    the parameters (`_search/template`, `_msearch/template`). The template
+    is registered on first use, and registered again (once per call) if the
+    cluster doesn't know it (anymore).
+
+    The parameters are not detected from the values of the search: nothing
+    tells the values changing per call from the constant ones, and making
+    every value a parameter would turn the constants (such as `size` or
+    field boosts) into required parameters. Mark the values to pass per
+    call with `Param` placeholders instead.
+
+    Usage:
+
+        template = SearchTemplate(
+            Search(index="orders").filter("term", customer=Param("customer")),
+            "orders-by-customer",
+        )
+        response = template.execute(customer="c1")
+        responses = template.msearch([{"customer": "c1"}, {"customer": "c2"}])
+    """
+
+    def __init__(self, search, name: str):
+        """
+        :param search: `search_dsl.Search` instance with `Param`
+            placeholders.
+        :param name: Name of the template; the id is the name suffixed with
+            the version.
+        """
+        self.search = search
+        chunks, names = _split_search_body(
+            search, self._get_connection().transport.serializer.default
+        )
+        parts = [chunks[0]]
+        for param, chunk in zip(names, itertools.islice(chunks, 1, None)):
+            parts.append("{{#toJson}}%s{{/toJson}}" % param)
+            parts.append(chunk)
+        #: Mustache source of the template.
+        self.source = "".join(parts)
+        self.params = set(names)
+        version = hashlib.sha1(self.source.encode("utf-8")).hexdigest()[:12]
+        #: Versioned id of the stored template.
+        self.template_id = "{}-{}".format(name, version)
+        self.registered = False
+
+    def _get_connection(self):
+        return search_dsl.connections.get_connection(self.search._using)
+
+    def register(self):
+        """Store the template on the cluster."""
+        self._get_connection().put_script(
+            id=self.template_id,
+            body={"script": {"lang": "mustache", "source": self.source}},
+        )
+        self.registered = True
+
+    def _call(self, method, **kwargs):
+        """Call the client, (re-)registering the template if needed."""
+        if not self.registered:
+            self.register()
+        try:
+            return method(**kwargs)
+        except search.NotFoundError as err:
+            # Only a missing template is worth registering again (and not,
+            # for instance, a missing index).
+            if err.error != "resource_not_found_exception":
+                raise
+            LOGGER.info("Search template %s is missing", self.template_id)
+        self.register()
+        return method(**kwargs)
+
+    def execute(self, **params):
+        """Execute the template with the given parameter values.
+
+        :return: `search_dsl` response instance.
+        """
+        _check_params(self.params, params)
+        request = self.search
+        raw = self._call(
+            self._get_connection().search_template,
+            index=request._index,
+            body={"id": self.template_id, "params": params},
+            **request._params,
+        )
+        return request._response_class(request, raw)
+
+    def msearch(self, params_list) -> list:
+        """Execute the template once per set of parameter values, in one
+        `_msearch/template` request.
+
+        Failed searches are returned as `search.TransportError` instances,
+        in place of the responses.
+
+        :param params_list: Iterable of dicts of parameter values.
+        :return: List of `search_dsl` response instances (or errors).
+        """
+        body = []
+        header = {"index": self.search._index} if self.search._index else {}
+        for params in params_list:
+            _check_params(self.params, params)
+            body.append(header)
+            body.append({"id": self.template_id, "params": params})
+        if not body:
+            return []
+        responses = self._call(self._msearch, body=body, **self.search._params)
+        return [
+            _msearch_item_result(self.search, _response)
+            for _response in responses
+        ]
+
+    def _msearch(self, body, **kwargs):
+        responses = self._get_connection().msearch_template(
+            body=body, **kwargs
+        )["responses"]
+        if any(
+            isinstance(_response.get("error"), dict)
+            and _response["error"].get("type") == "resource_not_found_exception"
+            for _response in responses
+        ):
+            raise search.NotFoundError(
+                404, "resource_not_found_exception", responses
+            )
+        return responses
+
+
+# **************************************************
+# **************************************************
+# **************** Search batching *****************
+# **************************************************
+# **************************************************
+
+
+def _multi_search_body(searches) -> list:
+    """Build the `_msearch` body (with `search_dsl.MultiSearch`)."""
+    multi_search = search_dsl.MultiSearch()
+    for request in searches:
+        multi_search = multi_search.add(request)
+    return multi_search.to_dict()
+
+
+def _multi_search(client, searches) -> list:
+    """Execute searches in one `_msearch` request.
+
+    :return: List of responses or `search.TransportError` instances (per
+        search, in order).
+    """
+    responses = client.msearch(body=_multi_search_body(searches))["responses"]
+    return [
+        _msearch_item_result(_request, _response)
+        for _request, _response in zip(searches, responses)
+    ]
+
+
+class BatchedResponse(object):
+    """Response of a search executed in a `SearchBatch`.
+
+    Behaves like the response; the first access sends all the searches
+    pending in the batch. Failed searches raise their error on access.
+    """
+
+    __slots__ = ("_batch", "_result", "_done")
+
+    def __init__(self, batch: "SearchBatch"):
+        self._batch = batch
+        self._result = None
+        self._done = False
+
+    def _set(self, result):
+        self._result = result
+        self._done = True
+
+    def result(self):
+        """Return the response (sending the batch if needed)."""
+        if not self._done:
+            self._batch.flush()
+        if isinstance(self._result, Exception):
+            raise self._result
+        return self._result
+
+    def __getattr__(self, name):
+        return getattr(self.result(), name)
+
+    def __iter__(self):
+        return iter(self.result())
+
+    def __len__(self):
+        return len(self.result())
+
+    def __getitem__(self, key):
+        return self.result()[key]
+
+    def __bool__(self):
+        return bool(self.result())
+
+
+# Batch collecting the `search_dsl.Search.execute` calls of the current
+# context (see `SearchBatch(collect=True)`).
+_SEARCH_BATCH = contextvars.ContextVar("anysearch_search_batch", default=None)
+_SEARCH_BATCH_HOOK_LOCK = threading.Lock()
+# [original `Search.execute`, number of collecting batches entered]
+_SEARCH_BATCH_HOOK = [None, 0]
+
+
+def _install_search_batch_hook():
+    """Make `search_dsl.Search.execute` join the `SearchBatch` collecting in
+    the current context, until `_uninstall_search_batch_hook` is called as
+    many times as this function."""
+    with _SEARCH_BATCH_HOOK_LOCK:
+        _SEARCH_BATCH_HOOK[1] += 1
+        if _SEARCH_BATCH_HOOK[1] > 1:
+            return
+        execute = search_dsl.Search.execute
+
+        @functools.wraps(execute)
+        def _execute(self, ignore_cache=False):
+            batch = _SEARCH_BATCH.get()
+            if batch is None or ignore_cache or hasattr(self, "_response"):
+                return execute(self, ignore_cache)
+            return batch.add(self)
+
+        _SEARCH_BATCH_HOOK[0] = execute
+        search_dsl.Search.execute = _execute
+
+
+def _uninstall_search_batch_hook():
+    """Restore the original `search_dsl.Search.execute` once the last
+    collecting batch has exited."""
+    with _SEARCH_BATCH_HOOK_LOCK:
+        _SEARCH_BATCH_HOOK[1] -= 1
+        if _SEARCH_BATCH_HOOK[1]:
+            return
+        execute, _SEARCH_BATCH_HOOK[0] = _SEARCH_BATCH_HOOK[0], None
+        if getattr(search_dsl.Search.execute, "__wrapped__", None) is execute:
+            search_dsl.Search.execute = execute
+
+
+class SearchBatch(object):
+    """Collect searches, sending them in a single `_msearch` request.
+
+    Searches are added with `batch.add(search)`: a `BatchedResponse` is
+    returned right away, the searches are sent (one `_msearch` per
+    connection) when the result of any of them is first accessed, when
+    `max_size` searches are pending or when leaving the context.
+
+    Errors are deferred as well: a failed search (and any transport error
+    of the `_msearch` request) raises on the first access to its
+    `BatchedResponse`, not where the search was added.
+
+    If the context exits with an exception, the pending searches are not
+    sent: their `BatchedResponse` raise a `RuntimeError` instead.
+
+    With `collect=True`, `Search.execute()` calls (of `search_dsl.Search`
+    and its subclasses) made within the context join the batch too, so
+    call sites don't change. This monkey-patches `search_dsl.Search.execute`
+    on the class, for the whole process, while any collecting batch is
+    entered (it's restored when the last one exits). The calls made outside
+    of a collecting context (in other threads or asyncio tasks) go through
+    the wrapper to the original method, unchanged. Prefer `batch.add` where
+    patching a shared class isn't acceptable.
+
+    Usage:
+
+        with SearchBatch() as batch:
+            products = batch.add(Search(index="products").query(...))
+            reviews = batch.add(Search(index="reviews").query(...))
+        for hit in products:  # sent both searches, in one request
+            ...
+    """
+
+    def __init__(self, max_size: int = 100, collect: bool = False):
+        """
+        :param max_size: Maximum number of searches in a request.
+        :param collect: Whether to collect the `Search.execute()` calls made
+            within the context (patching `search_dsl.Search.execute`
+            process-wide while entered).
+        """
+        self.max_size = max_size
+        self.collect = collect
+        self._pending = []
+        self._tokens = []
+
+    def add(self, request) -> BatchedResponse:
+        """Add a `search_dsl.Search` to the batch.
+
+        :param request: `search_dsl.Search` instance.
+        :return: `BatchedResponse` instance.
+        """
+        response = BatchedResponse(self)
+        self._pending.append((request, response))
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        return response
+
+    # Same name as `AsyncSearchBatch.execute`.
+    execute = add
+
+    def flush(self):
+        """Send the pending searches."""
+        pending, self._pending = self._pending, []
+        groups = collections.OrderedDict()
+        for request, response in pending:
+            groups.setdefault(request._using, []).append((request, response))
+        for using, items in groups.items():
+            try:
+                results = _multi_search(
+                    search_dsl.connections.get_connection(using),
+                    [_request for _request, _ in items],
+                )
+            except Exception as err:
+                # Such as an unknown connection alias: every search of the
+                # group fails with the error.
+                results = [err] * len(items)
+            for (_, response), result in zip(items, results):
+                response._set(result)
+
+    def __enter__(self):
+        if self.collect:
+            _install_search_batch_hook()
+            self._tokens.append(_SEARCH_BATCH.set(self))
+        return self
+
+    def cancel(self):
+        """Drop the pending searches, without sending them. Their
+        `BatchedResponse` raise a `RuntimeError`."""
+        pending, self._pending = self._pending, []
+        for _, response in pending:
+            response._set(
+                RuntimeError("The search batch was cancelled before sending.")
+            )
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.collect:
+            _SEARCH_BATCH.reset(self._tokens.pop())
+            _uninstall_search_batch_hook()
+        if exc_type is None:
+            self.flush()
+        else:
+            self.cancel()
+
+
+def _is_async_client(client) -> bool:
+    """Check if a client is an async one (`AsyncElasticsearch`, etc.)."""
+    transport = getattr(client, "transport", None)
+    return asyncio.iscoroutinefunction(
+        getattr(transport, "perform_request", None)
+    )
+
+
+async def _call_client(client, method, **kwargs):
+    """Call a client method from a coroutine.
+
+    The API methods of the async clients are regular functions (wrapped by
+    `query_params`) returning awaitables, so the result is awaited whenever
+    it's awaitable. Methods of regular clients run in the default executor,
+    not to block the loop.
+    """
+    if _is_async_client(client):
+        result = method(**kwargs)
+    else:
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(method, **kwargs)
+        )
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+class AsyncSearchBatch(object):
+    """Collect the searches executed (concurrently) within a short time
+    window, sending them in a single `_msearch` request.
+
+    With an async client (`AsyncElasticsearch`/`AsyncOpenSearch`) the
+    request is awaited, with a regular one it runs in the default executor
+    of the loop.
+
+    Usage:
+
+        batch = AsyncSearchBatch(client=async_client)
+        products, reviews = await asyncio.gather(
+            batch.execute(Search(index="products").query(...)),
+            batch.execute(Search(index="reviews").query(...)),
+        )
+    """
+
+    def __init__(self, client=None, window: float = 0.002, max_size: int = 100):
+        """
+        :param client: Client to use. Defaults to the connection of every
+            search (sending one request per connection).
+        :param window: Seconds to wait for more searches, after the first
+            one.
+        :param max_size: Maximum number of searches in a request.
+        """
+        self.client = client
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def execute(self, request):
+        """Execute a `search_dsl.Search` as part of a batch.
+
+        :param request: `search_dsl.Search` instance.
+        :return: Response.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((request, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            task = asyncio.ensure_future(self._send(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, pending):
+        groups = collections.OrderedDict()
+        for request, future in pending:
+            using = None if self.client is not None else request._using
+            groups.setdefault(using, []).append((request, future))
+        await asyncio.gather(
+            *(
+                self._send_group(_using, _items)
+                for _using, _items in groups.items()
+            )
+        )
+
+    async def _send_group(self, using, pending):
+        try:
+            client = self.client
+            if client is None:
+                client = search_dsl.connections.get_connection(using)
+            body = _multi_search_body([_request for _request, _ in pending])
+            raw = await _call_client(client, client.msearch, body=body)
+        except Exception as err:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for (request, future), response in zip(pending, raw["responses"]):
+            if future.done():
+                continue
+            result = _msearch_item_result(request, response)
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def flush(self):
+        """Send the pending searches and wait for all requests."""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.flush()
+
+
+# **************************************************
+# **************************************************
+# **************** Document loading ****************
+# **************************************************
+# **************************************************
+
+
+def _document_from_hit(doc_class, hit: dict):
+    """Build a document from a hit (as both DSL flavours do)."""
+    from_hit = getattr(doc_class, "from_es", None)
+    if from_hit is None:
+        from_hit = doc_class.from_opensearch
+    return from_hit(hit)
+
+
+def _mget_results(doc_class, response: dict) -> list:
+    """Turn an `_mget` response into a list of documents, `None` (not
+    found) or `search.TransportError` instances (per id, in order)."""
+    results = []
+    for doc in response["docs"]:
+        if "error" in doc:
+            error = doc["error"]
+            results.append(
+                search.TransportError(
+                    "N/A",
+                    error.get("type") if isinstance(error, dict) else error,
+                    doc,
+                )
+            )
+        elif doc.get("found"):
+            results.append(_document_from_hit(doc_class, doc))
+        else:
+            results.append(None)
+    return results
+
+
+class _BaseDocumentLoader(object):
+    """Shared state of the document loaders.
+
+    Requested documents are kept (as futures) per document class, index and
+    id, which deduplicates the requests and makes the loader an identity
+    cache: the same id always gives the same document instance. Use one
+    loader per (web) request.
+    """
+
+    def __init__(self, using: str = None, max_batch_size: int = 1000):
+        self.using = using
+        self.max_batch_size = max_batch_size
+        self._cache = {}
+        # Pending ids (with their futures) per document class and index.
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, doc_class, id_, index):
+        return doc_class, doc_class._default_index(index), str(id_)
+
+    def _batches(self) -> list:
+        """Take the pending ids, split in batches of `max_batch_size`."""
+        pending, self._pending = self._pending, collections.OrderedDict()
+        batches = []
+        for (doc_class, index), items in pending.items():
+            for start in range(0, len(items), self.max_batch_size):
+                stop = start + self.max_batch_size
+                batches.append((doc_class, index, items[start:stop]))
+        return batches
+
+    def _resolve(self, doc_class, index, items, results):
+        """Set the results of the futures. The failed ids are evicted from
+        the cache (unless already replaced), so that loading them again
+        sends a new request."""
+        with self._lock:
+            for (id_, future), result in zip(items, results):
+                key = doc_class, index, id_
+                if isinstance(result, Exception):
+                    if self._cache.get(key) is future:
+                        del self._cache[key]
+        for (_, future), result in zip(items, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def clear(self):
+        """Forget all loaded documents."""
+        with self._lock:
+            self._cache.clear()
+
+    def prime(self, document, index: str = None):
+        """Add an already loaded document to the cache."""
+        key = self._key(type(document), document.meta.id, index)
+        future = self._create_future()
+        future.set_result(document)
+        with self._lock:
+            self._cache[key] = future
+
+
+class _LoaderFuture(Future):
+    """Future dispatching the pending requests of its loader, if needed,
+    when the result is requested."""
+
+    loader = None
+
+    def result(self, timeout=None):
+        if not self.done() and self.loader is not None:
+            self.loader.dispatch()
+        return super(_LoaderFuture, self).result(timeout)
+
+
+class DocumentLoader(_BaseDocumentLoader):
+    """Batch and deduplicate `Document.get` calls into `_mget` requests.
+
+    `load` returns a future; all the ids requested before the result of
+    any of them is needed are fetched with one `_mget` per document class
+    and index. In threaded code, `get` waits `window` seconds for the other
+    threads to request their documents, before sending them.
+
+    Usage:
+
+        loader = DocumentLoader()
+        futures = [loader.load(Author, _id) for _id in author_ids]
+        authors = [_future.result() for _future in futures]  # one `_mget`
+        author = loader.get(Author, author_ids[0])  # cached, no request
+    """
+
+    def __init__(
+        self,
+        using: str = None,
+        max_batch_size: int = 1000,
+        window: float = 0.0,
+    ):
+        """
+        :param using: Connection alias. Defaults to that of the document
+            class.
+        :param max_batch_size: Maximum number of ids in a request.
+        :param window: Seconds `get` waits for other threads to request
+            their documents.
+        """
+        super(DocumentLoader, self).__init__(using, max_batch_size)
+        self.window = window
+
+    @staticmethod
+    def _create_future():
+        return _LoaderFuture()
+
+    def load(self, doc_class, id_, index: str = None):
+        """Request a document.
+
+        :param doc_class: `Document` subclass.
+        :param id_: Id of the document.
+        :param index: Index. Defaults to that of the document class.
+        :return: Future of the document (`None` if not found).
+        """
+        key = self._key(doc_class, id_, index)
+        with self._lock:
+            future = self._cache.get(key)
+            if future is None:
+                future = self._cache[key] = self._create_future()
+                future.loader = self
+                self._pending.setdefault(key[:2], []).append((key[2], future))
+        return future
+
+    def load_many(self, doc_class, ids, index: str = None) -> list:
+        """Get documents (in order, `None` for the ones not found)."""
+        futures = [self.load(doc_class, _id, index) for _id in ids]
+        return [_future.result() for _future in futures]
+
+    def get(self, doc_class, id_, index: str = None):
+        """Get a document (`None` if not found)."""
+        future = self.load(doc_class, id_, index)
+        if not future.done() and self.window:
+            time.sleep(self.window)
+        return future.result()
+
+    def dispatch(self):
+        """Send the pending requests."""
+        with self._lock:
+            batches = self._batches()
+        for doc_class, index, items in batches:
+            client = doc_class._get_connection(self.using)
+            try:
+                response = client.mget(
+                    index=index, body={"ids": [_id for _id, _ in items]}
+                )
+                results = _mget_results(doc_class, response)
+            except Exception as err:
+                results = [err] * len(items)
+            self._resolve(doc_class, index, items, results)
+
+
+class AsyncDocumentLoader(_BaseDocumentLoader):
+    """asyncio counterpart of `DocumentLoader`.
+
+    The ids requested within the same loop iteration (or `window`) are
+    fetched with one `_mget` per document class and index. With an async
+    client the request is awaited, with a regular one it runs in the
+    default executor of the loop.
+
+    Usage:
+
+        async with AsyncDocumentLoader(client=async_client) as loader:
+            authors = await asyncio.gather(
+                *(loader.get(Author, _id) for _id in author_ids)
+            )
+    """
+
+    def __init__(
+        self,
+        client=None,
+        using: str = None,
+        max_batch_size: int = 1000,
+        window: float = 0.0,
+    ):
+        """
+        :param client: Client to use. Defaults to the connection of the
+            document class.
+        :param using: Connection alias (without `client`).
+        :param max_batch_size: Maximum number of ids in a request.
+        :param window: Seconds to wait for more requests, after the first
+            one. By default, the requests of the current loop iteration are
+            sent together.
+        """
+        super(AsyncDocumentLoader, self).__init__(using, max_batch_size)
+        self.client = client
+        self.window = window
+        self._scheduled = False
+        self._tasks = set()
+
+    @staticmethod
+    def _create_future():
+        return asyncio.get_running_loop().create_future()
+
+    async def get(self, doc_class, id_, index: str = None):
+        """Get a document (`None` if not found)."""
+        key = self._key(doc_class, id_, index)
+        future = self._cache.get(key)
+        if future is None:
+            future = self._cache[key] = self._create_future()
+            self._pending.setdefault(key[:2], []).append((key[2], future))
+            if not self._scheduled:
+                self._scheduled = True
+                loop = asyncio.get_running_loop()
+                if self.window:
+                    loop.call_later(self.window, self._dispatch)
+                else:
+                    loop.call_soon(self._dispatch)
+        # Shielded, not to cancel the request of other callers.
+        return await asyncio.shield(future)
+
+    async def get_many(self, doc_class, ids, index: str = None) -> list:
+        """Get documents (in order, `None` for the ones not found)."""
+        return list(
+            await asyncio.gather(
+                *(self.get(doc_class, _id, index) for _id in ids)
+            )
+        )
+
+    def _dispatch(self):
+        self._scheduled = False
+        for doc_class, index, items in self._batches():
+            task = asyncio.ensure_future(self._send(doc_class, index, items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """Send the pending requests and wait for all requests."""
+        self._dispatch()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _send(self, doc_class, index, items):
+        client = self.client or doc_class._get_connection(self.using)
+        try:
+            response = await _call_client(
+                client,
+                client.mget,
+                index=index,
+                body={"ids": [_id for _id, _ in items]},
+            )
+            results = _mget_results(doc_class, response)
+        except Exception as err:
+            results = [err] * len(items)
+        self._resolve(doc_class, index, items, results)
+
+
+# **************************************************
+# **************************************************
+# ***************** Document session ***************
+# **************************************************
+# **************************************************
+
+# Meta fields of the document updated from the bulk results, as
+# `Document.save` does.
+_SESSION_META_FIELDS = ("id", "index", "version", "seq_no", "primary_term")
+
+
+class DocumentSession(object):
+    """Unit of work queuing saves, updates and deletes of `Document`
+    instances, sent as `_bulk` requests.
+
+    Operations on the same document collapse: repeated saves become one
+    (the document is serialized when flushed, so the last state wins), an
+    update after a save is part of the save, updates merge, a delete
+    replaces a pending save and vice versa. The pending operations are sent
+    on `commit`, when `max_actions` are pending and when leaving the
+    context (unless it's left with an exception, which discards them).
+
+    The results are mapped back to the documents: the `id`, `version`,
+    `seq_no` and `primary_term` of the meta are set, as `Document.save`
+    does; failures are collected in `errors` as (document, info) tuples and
+    `commit` raises a `BulkIndexError` for them. If a flush raises (an
+    invalid document, an unavailable cluster), the operations not sent
+    stay pending.
+
+    Usage:
+
+        with DocumentSession(refresh="wait_for") as session:
+            for article in articles:
+                article.views += 1
+                session.save(article)
+            session.delete(obsolete)
+    """
+
+    def __init__(
+        self,
+        using: str = None,
+        max_actions: int = 500,
+        refresh=None,
+        raise_on_error: bool = True,
+        **bulk_kwargs,
+    ):
+        """
+        :param using: Connection alias. Defaults to that of every document
+            (sending one request per connection).
+        :param max_actions: Number of pending operations triggering a flush.
+        :param refresh: Refresh policy ("true", "wait_for") of the commit.
+            Intermediate flushes don't refresh.
+        :param raise_on_error: Whether `commit` raises a `BulkIndexError`
+            for failed operations.
+        :param bulk_kwargs: Keyword arguments passed to `retrying_bulk`
+            (such as `chunk_size` or `max_retries`).
+        """
+        self.using = using
+        self.max_actions = max_actions
+        self.refresh = refresh
+        self.raise_on_error = raise_on_error
+        self.bulk_kwargs = bulk_kwargs
+        self.errors = []
+        # Pending operations: key -> [op_type, document, index, options]
+        self._pending = collections.OrderedDict()
+
+    def _key(self, document, index):
+        _id = getattr(document.meta, "id", None)
+        if _id is None:
+            return id(document)
+        return document._get_index(index), _id
+
+    def _queue(self, op_type: str, document, index, options: dict):
+        key = self._key(document, index)
+        current = self._pending.get(key)
+        if current is not None and op_type == "update":
+            if current[0] == "delete":
+                # Run in order, the update fails on the deleted document;
+                # replacing the delete would keep (and update) it instead.
+                self.flush()
+                current = None
+            elif current[0] == "index":
+                # Already set on the document, thus part of the save.
+                return
+            elif current[0] == "update":
+                current[3]["doc"].update(options["doc"])
+                return
+        if current is not None:
+            del self._pending[key]
+        self._pending[key] = [op_type, document, index, options]
+        if len(self._pending) >= self.max_actions:
+            self.flush()
+
+    def save(self, document, index: str = None, validate: bool = True):
+        """Queue indexing a document.
+
+        :param document: `Document` instance.
+        :param index: Index. Defaults to that of the document.
+        :param validate: Whether to validate the document (when flushed).
+        """
+        self._queue("index", document, index, {"validate": validate})
+
+    def update(self, document, index: str = None, **fields):
+        """Queue a partial update of a document; the fields are set on the
+        document right away, as `Document.update` does."""
+        for name, value in fields.items():
+            setattr(document, name, value)
+        self._queue("update", document, index, {"doc": fields})
+
+    def delete(self, document, index: str = None):
+        """Queue deleting a document."""
+        self._queue("delete", document, index, {})
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _action(self, op_type, document, index, options) -> dict:
+        if op_type == "index":
+            if options["validate"]:
+                document.full_clean()
+            action = document.to_dict(include_meta=True)
+        else:
+            action = {
+                "_id": document.meta.id,
+                "_index": document._get_index(index),
+            }
+            if "routing" in document.meta:
+                action["routing"] = document.meta.routing
+            if op_type == "update":
+                values = document.to_dict(skip_empty=False)
+                fields = options["doc"]
+                action["doc"] = {_name: values.get(_name) for _name in fields}
+        action["_op_type"] = op_type
+        if index is not None:
+            action["_index"] = document._get_index(index)
+        return action
+
+    def flush(self, refresh=None):
+        """Send the pending operations.
+
+        :param refresh: Refresh policy of the request.
+        """
+        documents = {}
+        # Actions per connection, the documents can be bound to different
+        # ones. All of them are built (and validated) before anything is
+        # sent, so an invalid document leaves the operations pending.
+        groups = collections.OrderedDict()
+        for key, operation in self._pending.items():
+            action = self._action(*operation)
+            documents[id(action)] = (key, operation[1])
+            client = operation[1]._get_connection(self.using)
+            groups.setdefault(id(client), (client, []))[1].append(action)
+        pending, self._pending = self._pending, collections.OrderedDict()
+        kwargs = dict(self.bulk_kwargs)
+        if refresh is not None:
+            kwargs["refresh"] = refresh
+        done = set()
+        try:
+            for client, actions in groups.values():
+                for ok, info, action in _iter_bulk_results(
+                    client, actions, **kwargs
+                ):
+                    key, document = documents[id(action)]
+                    if not ok:
+                        error = next(iter(info.values()))
+                        if "exception" in error:
+                            # The cluster is unavailable.
+                            raise error["exception"]
+                        done.add(key)
+                        self.errors.append((document, info))
+                        continue
+                    done.add(key)
+                    result = next(iter(info.values()))
+                    for name in _SESSION_META_FIELDS:
+                        if "_" + name in result:
+                            setattr(document.meta, name, result["_" + name])
+        except Exception:
+            # The operations without a result stay pending.
+            unsent = collections.OrderedDict(
+                (_key, _operation)
+                for _key, _operation in pending.items()
+                if _key not in done
+            )
+            unsent.update(self._pending)
+            self._pending = unsent
+            raise
+
+    def commit(self):
+        """Send the pending operations (refreshing as configured) and raise
+        a `BulkIndexError` if any operation of the session failed."""
+        self.flush(refresh=self.refresh)
+        if self.errors and self.raise_on_error:
+            from anysearch.search import helpers
+
+            errors, self.errors = self.errors, []
+            raise helpers.BulkIndexError(
+                "%i document(s) failed." % len(errors),
+                [_info for _, _info in errors],
+            )
+
+    def rollback(self):
+        """Discard the pending operations."""
+        self._pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+
+# **************************************************
+# **************************************************
+# ****************** Query analysis ****************
+# **************************************************
+# **************************************************
+
+QUERY_ISSUE_INFO = "info"
+QUERY_ISSUE_WARNING = "warning"
+QUERY_ISSUE_ERROR = "error"
+_QUERY_ISSUE_SEVERITIES = (
+    QUERY_ISSUE_INFO,
+    QUERY_ISSUE_WARNING,
+    QUERY_ISSUE_ERROR,
+)
+
+#: Finding of `analyze_search`: severity, code (such as "leading_wildcard"),
+#: path (within the search body), message and suggested rewrite.
+QueryIssue = collections.namedtuple(
+    "QueryIssue", ["severity", "code", "path", "message", "suggestion"]
+)
+
+# Default bucket count assumed for (nested) bucket aggregations without a
+# size.
+_DEFAULT_AGG_BUCKETS = {"terms": 10, "significant_terms": 10}
+_BUCKET_AGGS = (
+    "terms",
+    "significant_terms",
+    "histogram",
+    "date_histogram",
+    "range",
+    "date_range",
+    "geohash_grid",
+    "composite",
+    "multi_terms",
+)
+
+
+class QueryCostWarning(UserWarning):
+    """Warning issued by `guard_search` for expensive searches."""
+
+
+class ExpensiveQueryError(ValueError):
+    """Raised by `guard_search` for expensive searches."""
+
+    def __init__(self, issues: list):
+        self.issues = issues
+        super(ExpensiveQueryError, self).__init__(
+            "; ".join(_issue.message for _issue in issues)
+        )
+
+
+def _mapping_field_types(mapping: dict) -> dict:
+    """Flatten a mapping into a dict of field types per (dotted) path."""
+    types_ = {}
+
+    def _walk(properties, prefix):
+        for name, field in properties.items():
+            path = prefix + name
+            types_[path] = field.get("type", "object")
+            _walk(field.get("properties", {}), path + ".")
+            _walk(field.get("fields", {}), path + ".")
+
+    _walk(mapping.get("properties", {}), "")
+    return types_
+
+
+def _search_mapping(request, mapping) -> dict:
+    """Get the mapping (as a dict) to analyze a search with."""
+    if mapping is None:
+        merged = {}
+        for doc_type in getattr(request, "_doc_type", []):
+            if hasattr(doc_type, "_doc_type"):
+                properties = doc_type._doc_type.mapping.to_dict()
+                merged.update(properties.get("properties", {}))
+        return {"properties": merged}
+    if isinstance(mapping, type):
+        mapping = mapping._doc_type.mapping
+    if hasattr(mapping, "to_dict"):
+        mapping = mapping.to_dict()
+        if "mappings" in mapping:
+            mapping = mapping["mappings"]
+    return mapping
+
+
+class _SearchAnalyzer(object):
+    """Walks a search body, collecting `QueryIssue` instances."""
+
+    def __init__(self, field_types, max_from, max_terms, max_buckets):
+        self.field_types = field_types
+        self.max_from = max_from
+        self.max_terms = max_terms
+        self.max_buckets = max_buckets
+        self.issues = []
+
+    def add(self, severity, code, path, message, suggestion):
+        self.issues.append(
+            QueryIssue(severity, code, path, message, suggestion)
+        )
+
+    def keyword_field(self, field: str):
+        """Return a keyword (sub) field of a text field, if mapped."""
+        for path, type_ in self.field_types.items():
+            if path.startswith(field + ".") and type_ == "keyword":
+                return path
+        return None
+
+    def text_field_suggestion(self, field: str) -> str:
+        keyword = self.keyword_field(field)
+        if keyword:
+            return "use the keyword sub-field {!r}".format(keyword)
+        return "add a keyword sub-field to {!r} and use it".format(field)
+
+    def analyze(self, body: dict):
+        if "query" in body:
+            self.query(body["query"], "query")
+        if "post_filter" in body:
+            self.query(body["post_filter"], "post_filter")
+        end = body.get("from", 0) + body.get("size", 10)
+        if end > self.max_from:
+            self.add(
+                QUERY_ISSUE_WARNING,
+                "deep_pagination",
+                "from",
+                "from + size is {} (above {})".format(end, self.max_from),
+                "paginate with search_after (see SearchPaginator)",
+            )
+        sort = body.get("sort", [])
+        for position, clause in enumerate(
+            sort if isinstance(sort, list) else [sort]
+        ):
+            field = clause if isinstance(clause, str) else next(iter(clause))
+            if self.field_types.get(field) == "text":
+                self.add(
+                    QUERY_ISSUE_ERROR,
+                    "sort_on_text",
+                    "sort.{}".format(position),
+                    "sorting on the text field {!r}".format(field),
+                    self.text_field_suggestion(field),
+                )
+        for key in ("aggs", "aggregations"):
+            if key in body:
+                self.aggs(body[key], key, 1)
+
+    def query(self, node, path: str):
+        if isinstance(node, list):
+            for position, item in enumerate(node):
+                self.query(item, "{}.{}".format(path, position))
+            return
+        if not isinstance(node, dict):
+            return
+        for name, value in node.items():
+            sub_path = "{}.{}".format(path, name)
+            if name in ("wildcard", "regexp") and isinstance(value, dict):
+                self.pattern_query(name, value, sub_path)
+            elif name == "query_string" and isinstance(value, dict):
+                query = value.get("query", "")
+                if re.search(r"(^|[\s(:])[*?]", query):
+                    self.add(
+                        QUERY_ISSUE_WARNING,
+                        "leading_wildcard",
+                        sub_path,
+                        "query_string with a leading wildcard",
+                        "set allow_leading_wildcard to false or use a "
+                        "dedicated (wildcard/ngram) field",
+                    )
+            elif name == "script_score" or (
+                # The script query (not the script of another query).
+                name == "script"
+                and isinstance(value, dict)
+                and "script" in value
+            ):
+                self.add(
+                    QUERY_ISSUE_WARNING,
+                    "script_query",
+                    sub_path,
+                    "script evaluated per matching document",
+                    "index the computed value and query that instead",
+                )
+            elif name == "terms" and isinstance(value, dict):
+                for field, terms in value.items():
+                    if isinstance(terms, list) and len(terms) > self.max_terms:
+                        self.add(
+                            QUERY_ISSUE_WARNING,
+                            "large_terms",
+                            sub_path,
+                            "terms query on {!r} with {} terms".format(
+                                field, len(terms)
+                            ),
+                            "use a terms lookup or split the search",
+                        )
+            self.query(value, sub_path)
+
+    def pattern_query(self, name: str, value: dict, path: str):
+        for field, pattern in value.items():
+            if isinstance(pattern, dict):
+                pattern = pattern.get("value", pattern.get(name, ""))
+            if not isinstance(pattern, str):
+                continue
+            leading = (
+                pattern[:1] in ("*", "?")
+                if name == "wildcard"
+                else pattern.startswith((".*", ".+", ".?"))
+            )
+            if leading:
+                self.add(
+                    QUERY_ISSUE_ERROR,
+                    "leading_wildcard",
+                    path,
+                    "{} query on {!r} ({} field) starting with {!r}".format(
+                        name,
+                        field,
+                        self.field_types.get(field, "unmapped"),
+                        pattern[:2],
+                    ),
+                    "index the field with a reverse or ngram analyzer, or "
+                    "as a `wildcard` field",
+                )
+
+    def aggs(self, aggs: dict, path: str, buckets: int):
+        for name, agg in aggs.items():
+            agg_path = "{}.{}".format(path, name)
+            agg_buckets = 1
+            for agg_type, params in agg.items():
+                if agg_type not in _BUCKET_AGGS:
+                    continue
+                field = params.get("field")
+                if field and self.field_types.get(field) == "text":
+                    self.add(
+                        QUERY_ISSUE_ERROR,
+                        "agg_on_text",
+                        agg_path,
+                        "{} aggregation on the text field {!r}".format(
+                            agg_type, field
+                        ),
+                        self.text_field_suggestion(field),
+                    )
+                size = params.get("size")
+                if agg_type == "terms" and size is None:
+                    self.add(
+                        QUERY_ISSUE_INFO,
+                        "terms_agg_without_size",
+                        agg_path,
+                        "terms aggregation on {!r} without size (returns "
+                        "the top 10 buckets only)".format(field),
+                        "set size, or use a composite aggregation to page "
+                        "through all buckets",
+                    )
+                elif size and size > self.max_buckets:
+                    self.add(
+                        QUERY_ISSUE_WARNING,
+                        "large_agg_size",
+                        agg_path,
+                        "{} aggregation with size {}".format(agg_type, size),
+                        "page through the buckets with a composite "
+                        "aggregation",
+                    )
+                agg_buckets = max(
+                    agg_buckets, size or _DEFAULT_AGG_BUCKETS.get(agg_type, 1)
+                )
+            total = buckets * agg_buckets
+            if total > self.max_buckets:
+                self.add(
+                    QUERY_ISSUE_WARNING,
+                    "bucket_explosion",
+                    agg_path,
+                    "nested aggregations may create {} buckets".format(total),
+                    "use a composite aggregation, or collect_mode "
+                    "breadth_first, or reduce the sizes",
+                )
+            for key in ("aggs", "aggregations"):
+                if key in agg:
+                    self.aggs(agg[key], "{}.{}".format(agg_path, key), total)
+
+
+def analyze_search(
+    request,
+    mapping=None,
+    max_from: int = 1000,
+    max_terms: int = 1024,
+    max_buckets: int = 10000,
+) -> list:
+    """Find expensive patterns in a search, without executing it.
+
+    Flags leading wildcards/regexps, script queries, deep pagination, large
+    `terms` lists, sorting and aggregating on `text` fields, `terms`
+    aggregations without a size, large aggregation sizes and nested
+    aggregations multiplying the number of buckets.
+
+    :param request: `search_dsl.Search` instance or search body (dict).
+    :param mapping: Mapping to check the fields against: a `Document`
+        subclass, a `search_dsl.Mapping` or `search_dsl.Index` instance or a
+        mapping dict. Defaults to the mapping of the documents of the
+        search.
+    :param max_from: Maximum `from` + `size`.
+    :param max_terms: Maximum number of terms of a `terms` query.
+    :param max_buckets: Maximum (estimated) number of buckets.
+    :return: List of `QueryIssue` instances, most severe first.
+    """
+    body = request if isinstance(request, dict) else request.to_dict()
+    analyzer = _SearchAnalyzer(
+        _mapping_field_types(_search_mapping(request, mapping) or {}),
+        max_from,
+        max_terms,
+        max_buckets,
+    )
+    analyzer.analyze(body)
+    return sorted(
+        analyzer.issues,
+        key=lambda _issue: -_QUERY_ISSUE_SEVERITIES.index(_issue.severity),
+    )
+
+
+def guard_search(
+    request, mode: str = "warn", min_severity: str = "warning", **kwargs
+):
+    """Check a search with `analyze_search` before executing it.
+
+    Usage:
+
+        response = guard_search(search, mode="raise").execute()
+
+    :param request: `search_dsl.Search` instance.
+    :param mode: "warn" to issue a `QueryCostWarning`, "raise" to raise an
+        `ExpensiveQueryError`.
+    :param min_severity: Minimum severity of the issues to act on.
+    :param kwargs: Keyword arguments passed to `analyze_search`.
+    :return: The search (unchanged).
+    """
+    level = _QUERY_ISSUE_SEVERITIES.index(min_severity)
+    issues = [
+        _issue
+        for _issue in analyze_search(request, **kwargs)
+        if _QUERY_ISSUE_SEVERITIES.index(_issue.severity) >= level
+    ]
+    if issues:
+        if mode == "raise":
+            raise ExpensiveQueryError(issues)
+        for issue in issues:
+            warnings.warn(
+                "{} at {}: {} ({})".format(
+                    issue.code, issue.path, issue.message, issue.suggestion
+                ),
+                QueryCostWarning,
+                stacklevel=2,
+            )
+    return request
+
+
+# **************************************************
+# **************************************************
+# ****************** Read profiles *****************
+# **************************************************
+# **************************************************
+
+
+class ReadProfile(object):
+    """Projection of the documents read by a search.
+
+    Translates into `_source` includes/excludes, `docvalue_fields` and
+    `stored_fields` of a search.
+    """
+
+    def __init__(
+        self,
+        includes: List[str] = None,
+        excludes: List[str] = None,
+        docvalue_fields: List[str] = None,
+        stored_fields: List[str] = None,
+    ):
+        """
+        :param includes: `_source` fields to include (all by default).
+        :param excludes: `_source` fields to exclude.
+        :param docvalue_fields: Fields to read from the doc values instead.
+        :param stored_fields: Stored fields to read instead.
+        """
+        self.includes = list(includes or [])
+        self.excludes = list(excludes or [])
+        self.docvalue_fields = list(docvalue_fields or [])
+        self.stored_fields = list(stored_fields or [])
+
+    def apply(self, request):
+        """Apply the profile to a `search_dsl.Search`."""
+        if self.includes or self.excludes:
+            source = {"includes": self.includes, "excludes": self.excludes}
+            request = request.source(
+                **{_key: _value for _key, _value in source.items() if _value}
+            )
+        elif self.docvalue_fields or self.stored_fields:
+            request = request.source(False)
+        if self.docvalue_fields:
+            request = request.extra(docvalue_fields=self.docvalue_fields)
+        if self.stored_fields:
+            request = request.extra(stored_fields=self.stored_fields)
+        return request
+
+    def loads(self, field: str) -> bool:
+        """Whether the (top-level) field is read.
+
+        Patterns (e.g. `ti*`) are matched as by the cluster; a field is read
+        if any of its sub-fields (e.g. `author.name`) is.
+        """
+        if any(
+            fnmatch.fnmatchcase(field, _pattern)
+            for _pattern in self.docvalue_fields + self.stored_fields
+        ):
+            return True
+        if any(fnmatch.fnmatchcase(field, _path) for _path in self.excludes):
+            return False
+        if self.includes:
+            return any(
+                fnmatch.fnmatchcase(field, _path)
+                or fnmatch.fnmatchcase(field, _path.split(".", 1)[0])
+                for _path in self.includes
+            )
+        # Without includes, the `_source` is read only if there are no doc
+        # value and stored fields.
+        return not (self.docvalue_fields or self.stored_fields)
+
+    def __repr__(self):
+        return "ReadProfile(includes={!r}, excludes={!r})".format(
+            self.includes, self.excludes
+        )
+
+
+_READ_PROFILE_CLASSES = {}
+# Keyword arguments of `Document.update` which aren't fields to update.
+_DOCUMENT_UPDATE_OPTIONS = {
+    "using",
+    "index",
+    "detect_noop",
+    "doc_as_upsert",
+    "refresh",
+    "retry_on_conflict",
+    "script",
+    "script_id",
+    "scripted_upsert",
+    "upsert",
+    "return_doc_meta",
+    "if_seq_no",
+    "if_primary_term",
+}
+
+
+class ReadProfileMixin(object):
+    """Mixin adding named read profiles (see `ReadProfile`) to a `Document`.
+
+    `profile_search` returns a search reading the documents with the given
+    profile. Its hits are instances of a (generated, cached) subclass of the
+    document knowing the profile: the values of `docvalue_fields` and
+    `stored_fields` are set as regular field values, accessing a field the
+    profile doesn't read raises an `AttributeError` (instead of silently
+    returning an empty value) and saving such a partial document (which
+    would overwrite the unread fields) raises a `ValueError`. Partial
+    updates (`update` with fields) work.
+
+    Usage:
+
+        class Page(ReadProfileMixin, Document):
+            title = Text()
+            html = Text()
+            embedding = DenseVector(dims=768)
+            published = Date()
+
+            read_profiles = {
+                "list": ReadProfile(
+                    includes=["title"], docvalue_fields=["published"]
+                ),
+            }
+
+        for page in Page.profile_search("list").query(...):
+            page.title, page.published
+    """
+
+    #: Read profiles per name.
+    read_profiles = {}
+    # Name of the profile the documents are read with.
+    _read_profile_ = None
+
+    @classmethod
+    def profile_class(cls, name: str) -> type:
+        """Get the subclass of the document for a read profile."""
+        if name not in cls.read_profiles:
+            raise KeyError("Unknown read profile {!r}".format(name))
+        key = (cls, name)
+        if key not in _READ_PROFILE_CLASSES:
+            profiled = type(
+                "{}[{}]".format(cls.__name__, name),
+                (cls,),
+                {"_read_profile_": name, "__module__": cls.__module__},
+            )
+            # Not to be used by (the searches of) the index itself.
+            if profiled in cls._index._doc_types:
+                cls._index._doc_types.remove(profiled)
+            _READ_PROFILE_CLASSES[key] = profiled
+        return _READ_PROFILE_CLASSES[key]
+
+    @classmethod
+    def profile_search(cls, name: str, using=None, index=None):
+        """Return a `search_dsl.Search` reading with a profile."""
+        profiled = cls.profile_class(name)
+        return cls.read_profiles[name].apply(profiled.search(using, index))
+
+    @classmethod
+    def _profile_hit(cls, hit: dict) -> dict:
+        if cls._read_profile_ is None or "fields" not in hit:
+            return hit
+        profile = cls.read_profiles[cls._read_profile_]
+        hit = dict(hit)
+        fields = dict(hit.pop("fields"))
+        source = dict(hit.get("_source") or {})
+        mapping = cls._doc_type.mapping
+        for name in profile.docvalue_fields + profile.stored_fields:
+            if name in fields:
+                values = fields.pop(name)
+                multi = name in mapping and mapping[name]._multi
+                source[name] = values if multi else values[0]
+        hit["_source"] = source
+        if fields:
+            hit["fields"] = fields
+        return hit
+
+    @classmethod
+    def from_es(cls, hit):
+        return super(ReadProfileMixin, cls).from_es(cls._profile_hit(hit))
+
+    @classmethod
+    def from_opensearch(cls, hit):
+        return super(ReadProfileMixin, cls).from_opensearch(
+            cls._profile_hit(hit)
+        )
+
+    def __getattr__(self, name):
+        profile = type(self)._read_profile_
+        if (
+            profile is not None
+            and name in self._doc_type.mapping
+            and not self.read_profiles[profile].loads(name)
+        ):
+            raise AttributeError(
+                "{!r} is not read by the {!r} read profile".format(
+                    name, profile
+                )
+            )
+        return super(ReadProfileMixin, self).__getattr__(name)
+
+    def save(self, *args, **kwargs):
+        if type(self)._read_profile_ is not None:
+            raise ValueError(
+                "Cannot save a document read with the {!r} read profile "
+                "(it's partial), use update instead.".format(
+                    type(self)._read_profile_
+                )
+            )
+        return super(ReadProfileMixin, self).save(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        if (
+            type(self)._read_profile_ is not None
+            and not kwargs.get("script")
+            and not kwargs.get("script_id")
+            and not set(kwargs).difference(_DOCUMENT_UPDATE_OPTIONS)
+        ):
+            raise ValueError(
+                "Cannot update a document read with the {!r} read profile "
+                "without fields (it's partial).".format(
+                    type(self)._read_profile_
+                )
+            )
+        return super(ReadProfileMixin, self).update(*args, **kwargs)
+
+
+# **************************************************
+# **************************************************
+# ****************** Vector search *****************
+# **************************************************
+# **************************************************
+
+
+# Backend names of the vector spaces (similarities) per (generic) name.
+_VECTOR_SPACES = {
+    "l2": {ELASTICSEARCH: "l2_norm", OPENSEARCH: "l2"},
+    "cosine": {ELASTICSEARCH: "cosine", OPENSEARCH: "cosinesimil"},
+    "dot_product": {ELASTICSEARCH: "dot_product", OPENSEARCH: "innerproduct"},
+    "inner_product": {
+        ELASTICSEARCH: "max_inner_product",
+        OPENSEARCH: "innerproduct",
+    },
+    "l1": {OPENSEARCH: "l1"},
+    "linf": {OPENSEARCH: "linf"},
+}
+
+
+def _inner_product_distance(numpy, scores):
+    # score = 1 / (1 - dot) for negative products, dot + 1 otherwise.
+    with numpy.errstate(divide="ignore"):
+        return -numpy.where(scores >= 1, scores - 1, 1 - 1 / scores)
+
+
+# Conversion of the scores into distances per backend space name (inverting
+# the score formulas of the engines; inner products give negated products).
+_SCORE_DISTANCES = {
+    "l2_norm": lambda numpy, s: numpy.sqrt(numpy.maximum(1 / s - 1, 0)),
+    "l2": lambda numpy, s: numpy.sqrt(numpy.maximum(1 / s - 1, 0)),
+    "l1": lambda numpy, s: 1 / s - 1,
+    "linf": lambda numpy, s: 1 / s - 1,
+    "cosine": lambda numpy, s: 2 - 2 * s,
+    "cosinesimil": lambda numpy, s: 2 - s,
+    "dot_product": lambda numpy, s: 1 - 2 * s,
+    "max_inner_product": _inner_product_distance,
+    "innerproduct": _inner_product_distance,
+}
+
+
+def _vector_space(space: str, backend: str) -> str:
+    """Get the backend name of a vector space."""
+    if space in _VECTOR_SPACES:
+        if backend not in _VECTOR_SPACES[space]:
+            raise ValueError(
+                "The {!r} space isn't supported by {}.".format(space, backend)
+            )
+        return _VECTOR_SPACES[space][backend]
+    if space in _SCORE_DISTANCES:
+        return space
+    raise ValueError("Unknown vector space: {!r}".format(space))
+
+
+def vector_field(dims: int, space: str = "l2", **kwargs):
+    """Create an indexed vector field for k-NN searches (see `knn_search`).
+
+    A `search_dsl.DenseVector` field on Elasticsearch, a `knn_vector` field
+    (of the k-NN plugin) on OpenSearch.
+
+    Usage:
+
+        class Page(Document):
+            embedding = vector_field(768, space="cosine")
+
+    :param dims: Number of dimensions.
+    :param space: Vector space (`"l2"`, `"cosine"`, `"dot_product"`,
+        `"inner_product"` or, on OpenSearch, `"l1"` and `"linf"`) or its
+        backend name.
+    :param kwargs: Other parameters of the field (e.g. `method` on
+        OpenSearch).
+    :return: Field instance.
+    """
+    global _KnnVector
+
+    space = _vector_space(space, SEARCH_BACKEND)
+    if IS_ELASTICSEARCH:
+        kwargs.setdefault("index", True)
+        kwargs.setdefault("similarity", space)
+        return search_dsl.DenseVector(dims=dims, **kwargs)
+
+    if _KnnVector is None:
+
+        class KnnVector(search_dsl.Float):
+            """`knn_vector` field of the OpenSearch k-NN plugin."""
+
+            name = "knn_vector"
+
+            def __init__(self, dimension, **kwargs):
+                kwargs["multi"] = True
+                super(KnnVector, self).__init__(dimension=dimension, **kwargs)
+
+        _KnnVector = KnnVector
+
+    kwargs.setdefault("method", {"name": "hnsw", "space_type": space})
+    return _KnnVector(dims, **kwargs)
+
+
+# Created on the first call of `vector_field` on OpenSearch, not to import
+# the backend when importing this module.
+_KnnVector = None
+
+
+VectorSearchResult = collections.namedtuple(
+    "VectorSearchResult", ["ids", "scores", "distances"]
+)
+VectorSearchResult.__doc__ = """Result of `knn_search`.
+
+Arrays of shape `(queries, k)`: `ids` (objects, `None` where less than `k`
+hits were found), `scores` (floats, NaN for the missing hits) and
+`distances` (floats, computed from the scores).
+"""
+
+
+def _float32_decimals(numpy, matrix) -> tuple:
+    """Decompose float32 values into decimal mantissas and exponents.
+
+    Nine significant digits (trailing zeros removed) always round-trip
+    float32 values; the digits are computed in bulk, in integer arithmetic.
+
+    :return: Tuple of int64 arrays (mantissas, exponents).
+    """
+    values = matrix.astype(numpy.float64)
+    magnitudes = numpy.abs(values)
+    magnitudes[magnitudes == 0] = 1
+    exponents = numpy.floor(numpy.log10(magnitudes)).astype(numpy.int64) - 8
+    powers = 10.0 ** numpy.arange(-60, 61)
+    mantissas = numpy.rint(values * powers[60 - exponents]).astype(numpy.int64)
+    flat_mantissas = mantissas.reshape(-1)
+    flat_exponents = exponents.reshape(-1)
+    trailing = numpy.flatnonzero(flat_mantissas % 10 == 0)
+    while trailing.size:
+        flat_mantissas[trailing] //= 10
+        flat_exponents[trailing] += 1
+        trailing = trailing[
+            (flat_mantissas[trailing] % 10 == 0)
+            & (flat_mantissas[trailing] != 0)
+        ]
+    flat_exponents[flat_mantissas == 0] = 0
+    return mantissas, exponents
+
+
+def _vector_json_rows(numpy, matrix, encoding: str = "json") -> list:
+    """Encode the rows of a vector matrix as JSON values (strings)."""
+    if encoding == "base64":
+        big_endian = matrix.astype(">f4")
+        return [
+            '"' + base64.b64encode(_row.tobytes()).decode("ascii") + '"'
+            for _row in big_endian
+        ]
+    rows, dims = matrix.shape
+    if matrix.dtype.kind in "iu":
+        template = "[" + ",".join(["%d"] * dims) + "]"
+        return [template % tuple(_row) for _row in matrix.tolist()]
+    # A single "%de%d" template per row, filled with interleaved mantissas
+    # and exponents, formats a whole row in one (C) call.
+    mantissas, exponents = _float32_decimals(numpy, matrix)
+    pairs = numpy.empty((rows, dims * 2), dtype=numpy.int64)
+    pairs[:, 0::2] = mantissas
+    pairs[:, 1::2] = exponents
+    template = "[" + ",".join(["%de%d"] * dims) + "]"
+    return [template % tuple(_row) for _row in pairs.tolist()]
+
+
+def _knn_body_chunks(backend, field, k, num_candidates, filter_):
+    """Serialize the k-NN search body, split at the query vector."""
+    marker = "@@vector@@"
+    if backend == OPENSEARCH:
+        query = {"k": k, "vector": marker}
+        if filter_:
+            query["filter"] = filter_
+        body = {"size": k, "_source": False, "query": {"knn": {field: query}}}
+    else:
+        knn = {
+            "field": field,
+            "k": k,
+            "num_candidates": num_candidates,
+            "query_vector": marker,
+        }
+        if filter_:
+            knn["filter"] = filter_
+        body = {"size": k, "_source": False, "knn": knn}
+    prefix, suffix = json.dumps(body, separators=(",", ":")).split(
+        '"{}"'.format(marker)
+    )
+    return prefix, suffix
+
+
+def knn_search(
+    client,
+    index,
+    field: str,
+    vectors,
+    k: int = 10,
+    space: str = "l2",
+    num_candidates: int = None,
+    filter=None,
+    batch_size: int = 100,
+) -> VectorSearchResult:
+    """Run k-NN searches for a matrix of query vectors.
+
+    Emits the syntax of the backend of the client (top level `knn` on
+    Elasticsearch, `knn` query on OpenSearch) and sends the searches in
+    `_msearch` requests of `batch_size` searches. The vectors are formatted
+    in bulk (as decimal mantissas and exponents), not float by float.
+
+    Usage:
+
+        result = knn_search(client, "pages", "embedding", embeddings, k=5)
+        result.ids[0], result.distances[0]
+
+    :param client: `AnySearch` client instance.
+    :param index: Index name (or a list of names).
+    :param field: Vector field (see `vector_field`).
+    :param vectors: Query vectors (matrix, or a single vector).
+    :param k: Number of nearest neighbors per query.
+    :param space: Vector space of the field (see `vector_field`), used to
+        compute the distances from the scores.
+    :param num_candidates: Number of candidates per shard (Elasticsearch
+        only), `1.5 * k` by default.
+    :param filter: Filter query (dict or `search_dsl.Query`).
+    :param batch_size: Maximum number of searches per `_msearch` request.
+    :return: `VectorSearchResult` instance.
+    """
+    numpy = _import_numpy()
+    if numpy is None:
+        raise ImportError("numpy is required for `knn_search`.")
+    backend = _client_backend(client)
+    space = _vector_space(space, backend)
+    matrix = numpy.asarray(vectors, dtype=numpy.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    if matrix.ndim != 2:
+        raise ValueError("Expected a matrix of vectors.")
+    if not numpy.isfinite(matrix).all():
+        raise ValueError("Vectors can't contain NaN or infinite values.")
+    if hasattr(filter, "to_dict"):
+        filter = filter.to_dict()
+    if num_candidates is None:
+        num_candidates = min(max(k * 3 // 2, k), 10000)
+    prefix, suffix = _knn_body_chunks(backend, field, k, num_candidates, filter)
+    header = json.dumps(
+        {"index": index if isinstance(index, str) else ",".join(index)}
+    )
+
+    count = matrix.shape[0]
+    ids = numpy.full((count, k), None, dtype=object)
+    scores = numpy.full((count, k), numpy.nan)
+    for start in range(0, count, batch_size):
+        stop = start + batch_size
+        lines = []
+        for row in _vector_json_rows(numpy, matrix[start:stop]):
+            lines.append(header)
+            lines.append(prefix + row + suffix)
+        lines.append("")
+        responses = client.msearch(body="\n".join(lines))["responses"]
+        for offset, raw in enumerate(responses):
+            if "error" in raw:
+                raise _msearch_item_result(None, raw)
+            for position, hit in enumerate(raw["hits"]["hits"][:k]):
+                ids[start + offset, position] = hit["_id"]
+                scores[start + offset, position] = hit["_score"]
+    return VectorSearchResult(
+        ids, scores, _SCORE_DISTANCES[space](numpy, scores)
+    )
+
+
+def vector_actions(
+    index: str,
+    field: str,
+    vectors,
+    ids=None,
+    metadata=None,
+    op_type: str = "index",
+    encoding: str = "json",
+    chunk_size: int = 1000,
+):
+    """Generate bulk actions indexing a matrix of vectors.
+
+    The `_source` of the actions is pre-serialized JSON (the serializers
+    pass strings through), with the vectors formatted in bulk, in chunks of
+    `chunk_size` rows, instead of float by float. The actions work with any
+    bulk helper (`helpers.bulk`, `retrying_bulk`, `BulkSpool`, etc.).
+
+    Usage:
+
+        for ok, info in retrying_bulk(
+            client,
+            vector_actions("pages", "embedding", embeddings, ids=ids),
+        ):
+            ...
+
+    :param index: Index name.
+    :param field: Vector field (see `vector_field`).
+    :param vectors: Matrix of vectors (float, or integer for byte vectors).
+    :param ids: Document ids (per row). Generated by the cluster if omitted.
+    :param metadata: Other fields of the documents (dict per row).
+    :param op_type: Bulk operation (`"index"` or `"create"`).
+    :param encoding: `"json"` (arrays of numbers, with the float32
+        precision) or `"base64"` (big-endian float32, as supported by
+        Elasticsearch 8.14+ for `dense_vector` fields; less than half the
+        size and no float formatting at all).
+    :param chunk_size: Number of vectors formatted at once.
+    :return: Generator of actions.
+    """
+    numpy = _import_numpy()
+    if numpy is None:
+        raise ImportError("numpy is required for `vector_actions`.")
+    matrix = numpy.asarray(vectors)
+    if matrix.ndim != 2:
+        raise ValueError("Expected a matrix of vectors.")
+    if matrix.dtype.kind not in "iu":
+        matrix = matrix.astype(numpy.float32)
+        if not numpy.isfinite(matrix).all():
+            raise ValueError("Vectors can't contain NaN or infinite values.")
+    elif encoding == "base64":
+        raise ValueError("The base64 encoding is for float vectors only.")
+    if encoding not in ("json", "base64"):
+        raise ValueError("Unknown vector encoding: {!r}".format(encoding))
+    if encoding == "base64" and IS_OPENSEARCH:
+        raise ValueError("OpenSearch doesn't support base64 vectors.")
+    ids = iter(ids) if ids is not None else itertools.repeat(None)
+    metadata = (
+        iter(metadata) if metadata is not None else itertools.repeat(None)
+    )
+
+    serializer = search.JSONSerializer()
+    prefix = "{" + json.dumps(field) + ":"
+    for start in range(0, matrix.shape[0], chunk_size):
+        stop = start + chunk_size
+        for row in _vector_json_rows(numpy, matrix[start:stop], encoding):
+            fields = next(metadata)
+            source = prefix + row
+            if fields:
+                source += "," + serializer.dumps(fields)[1:]
+            else:
+                source += "}"
+            action = {"_op_type": op_type, "_index": index, "_source": source}
+            _id = next(ids)
+            if _id is not None:
+                action["_id"] = _id
+            yield action
+
+
+def bulk_vectors(
+    client,
+    index: str,
+    field: str,
+    vectors,
+    ids=None,
+    metadata=None,
+    encoding: str = "json",
+    **kwargs,
+):
+    """Index a matrix of vectors with `retrying_bulk`.
+
+    :param client: `AnySearch` client instance.
+    :param index: Index name.
+    :param field: Vector field.
+    :param vectors: Matrix of vectors.
+    :param ids: Document ids (per row).
+    :param metadata: Other fields of the documents (dict per row).
+    :param encoding: Vector encoding (see `vector_actions`).
+    :param kwargs: Keyword arguments of `retrying_bulk`.
+    :return: Generator of (ok, info) tuples.
+    """
+    return retrying_bulk(
+        client,
+        vector_actions(
+            index, field, vectors, ids=ids, metadata=metadata, encoding=encoding
+        ),
+        **kwargs,
+    )
+
+
+# **************************************************
+# **************************************************
+# ***************** By-query tasks *****************
+# **************************************************
+# **************************************************
+
+
+# Counters of the status of update/delete by query tasks (summed over the
+# slices by the engines).
+_BY_QUERY_COUNTERS = (
+    "total",
+    "updated",
+    "created",
+    "deleted",
+    "batches",
+    "version_conflicts",
+    "noops",
+)
+
+
+class ByQueryProgress(object):
+    """Progress of a `ByQueryTask`, as reported by the task API."""
+
+    def __init__(self, info: dict):
+        """
+        :param info: Task info (response of `GET _tasks/<task_id>`).
+        """
+        task = info.get("task", {})
+        status = dict(task.get("status") or {})
+        if info.get("response"):
+            status.update(info["response"])
+        self.completed = bool(info.get("completed"))
+        for counter in _BY_QUERY_COUNTERS:
+            setattr(self, counter, status.get(counter, 0))
+        self.requests_per_second = status.get("requests_per_second")
+        self.throttled_millis = status.get("throttled_millis", 0)
+        self.failures = status.get("failures", [])
+        self.canceled = status.get("canceled")
+        # Slices finished (and cleaned up) early are reported as nulls.
+        self.slices = [_slice for _slice in status.get("slices", []) if _slice]
+        self.elapsed = task.get("running_time_in_nanos", 0) / 1e9
+
+    @property
+    def done(self) -> int:
+        """Number of processed documents."""
+        return (
+            self.updated
+            + self.created
+            + self.deleted
+            + self.noops
+            + self.version_conflicts
+        )
+
+    @property
+    def rate(self) -> float:
+        """Throughput (documents per second)."""
+        if not self.elapsed:
+            return 0.0
+        return self.done / self.elapsed
+
+    @property
+    def eta(self):
+        """Estimated number of seconds left (None if unknown)."""
+        rate = self.rate
+        if not self.total or not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def __repr__(self):
+        return (
+            f"<ByQueryProgress done={self.done} total={self.total} "
+            f"slices={len(self.slices)} rate={self.rate:.1f}/s "
+            f"eta={self.eta} completed={self.completed}>"
+        )
+
+
+class ByQueryTask(object):
+    """Update or delete by query, run as a (sliced) background task.
+
+    The operation is submitted with `wait_for_completion=false`, split into
+    `slices` slices (`"auto"`: one per shard) by the engine. `wait` polls
+    the task API with an exponential back-off, reporting the progress
+    summed over the slices. The task can be rethrottled while running and
+    is cancelled when `wait` times out. Only the REST APIs common to both
+    backends are used.
+
+    Usage:
+
+        task = ByQueryTask.update(
+            UpdateByQuery(index="orders")
+            .filter("term", status="pending")
+            .script(source="ctx._source.status = 'expired'"),
+            requests_per_second=500,
+            progress_callback=print,
+        )
+        task.start()
+        task.rethrottle(None)  # Unthrottle.
+        progress = task.wait(timeout=3600)
+    """
+
+    def __init__(
+        self,
+        client,
+        index,
+        body: dict = None,
+        operation: str = "update",
+        slices="auto",
+        requests_per_second: float = None,
+        conflicts: str = "proceed",
+        initial_poll_interval: float = 0.5,
+        max_poll_interval: float = 10.0,
+        progress_callback=None,
+        **params,
+    ):
+        """
+        :param client: `AnySearch` client instance.
+        :param index: Index name (or a list of names).
+        :param body: Request body (query, script, etc.).
+        :param operation: `"update"` or `"delete"`.
+        :param slices: Number of slices, or `"auto"`.
+        :param requests_per_second: Throttle (None for no throttling).
+        :param conflicts: What to do on version conflicts (`"proceed"` or
+            `"abort"`).
+        :param initial_poll_interval: First interval (in seconds) between
+            task status requests.
+        :param max_poll_interval: Maximum interval between task status
+            requests.
+        :param progress_callback: Callable, which is called with the
+            `ByQueryProgress` after every status request.
+        :param params: Other (query string) parameters of the request.
+        """
+        if operation not in ("update", "delete"):
+            raise ValueError(f"Unknown by query operation: {operation!r}")
+        self.client = client
+        self.index = index
+        self.body = body or {}
+        self.operation = operation
+        self.params = dict(params, slices=slices, conflicts=conflicts)
+        self.requests_per_second = requests_per_second
+        self.initial_poll_interval = initial_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.progress_callback = progress_callback
+        self.task_id = None
+        self.progress = None
+
+    @classmethod
+    def update(cls, update_by_query, **kwargs) -> "ByQueryTask":
+        """Create a task from a `search_dsl.UpdateByQuery`.
+
+        :param update_by_query: `search_dsl.UpdateByQuery` instance.
+        :param kwargs: Keyword arguments of `ByQueryTask`.
+        """
+        kwargs = dict(update_by_query._params, **kwargs)
+        return cls(
+            search_dsl.connections.get_connection(update_by_query._using),
+            update_by_query._index,
+            update_by_query.to_dict(),
+            operation="update",
+            **kwargs,
+        )
+
+    @classmethod
+    def delete(cls, request, **kwargs) -> "ByQueryTask":
+        """Create a delete by query task from the query of a search.
+
+        :param request: `search_dsl.Search` instance.
+        :param kwargs: Keyword arguments of `ByQueryTask`.
+        """
+        body = {}
+        if request.query:
+            body["query"] = request.query.to_dict()
+        return cls(
+            search_dsl.connections.get_connection(request._using),
+            request._index,
+            body,
+            operation="delete",
+            **kwargs,
+        )
+
+    def _request(self, method: str, path: str, params=None, body=None):
+        return self.client.transport.perform_request(
+            method, path, params=params, body=body
+        )
+
+    def start(self) -> str:
+        """Submit the operation.
+
+        :return: Task id.
+        """
+        params = dict(self.params, wait_for_completion="false")
+        params["requests_per_second"] = self.requests_per_second or -1
+        response = self._request(
+            "POST",
+            f"/{_index_path(self.index or '_all')}/_{self.operation}_by_query",
+            params=params,
+            body=self.body,
+        )
+        self.task_id = response["task"]
+        return self.task_id
+
+    def poll(self) -> ByQueryProgress:
+        """Get the current progress of the task.
+
+        :return: `ByQueryProgress` instance.
+        """
+        info = self._request("GET", f"/_tasks/{self.task_id}")
+        if info.get("error"):
+            error = info["error"]
+            raise search.TransportError(
+                "N/A", error.get("type", "task_error"), info
+            )
+        self.progress = ByQueryProgress(info)
+        if self.progress_callback:
+            self.progress_callback(self.progress)
+        return self.progress
+
+    def wait(self, timeout: float = None) -> ByQueryProgress:
+        """Wait for the task to complete.
+
+        :param timeout: Maximum number of seconds to wait; the task is
+            cancelled (and `TimeoutError` raised) once it is exceeded.
+        :return: Final `ByQueryProgress`.
+        """
+        if self.task_id is None:
+            self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = self.initial_poll_interval
+        while not self.poll().completed:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.cancel()
+                    raise TimeoutError(
+                        f"Task {self.task_id} didn't complete in {timeout}s "
+                        f"and was cancelled."
+                    )
+                interval = min(interval, remaining)
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+        return self.progress
+
+    def run(self, timeout: float = None) -> ByQueryProgress:
+        """Submit the operation and wait for it to complete (see `wait`)."""
+        self.start()
+        return self.wait(timeout)
+
+    def rethrottle(self, requests_per_second: float = None):
+        """Change the throttle of the running task (and all its slices).
+
+        :param requests_per_second: New throttle (None for no throttling).
+        """
+        self.requests_per_second = requests_per_second
+        return self._request(
+            "POST",
+            f"/_{self.operation}_by_query/{self.task_id}/_rethrottle",
+            params={"requests_per_second": requests_per_second or -1},
+        )
+
+    def cancel(self):
+        """Cancel the task (and all its slices)."""
+        return self._request("POST", f"/_tasks/{self.task_id}/_cancel")
+
+
+# **************************************************
+# **************************************************
+# **************** Traffic classes *****************
+# **************************************************
+# **************************************************
+
+
+class TrafficClass(object):
+    """Settings of the connections of a class of traffic.
+
+    See `TrafficClasses`.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 10,
+        timeout: float = 10,
+        max_retries: int = 3,
+        retry_on_timeout: bool = False,
+        max_concurrency: int = None,
+        hosts=None,
+        selector_class=None,
+        rate_limiter: "RateLimiter" = None,
+        **kwargs,
+    ):
+        """
+        :param maxsize: Number of (kept alive) connections per node.
+        :param timeout: Default request timeout (in seconds).
+        :param max_retries: Maximum number of retries of a request.
+        :param retry_on_timeout: Whether to retry timed out requests.
+        :param max_concurrency: Maximum number of requests in flight (for
+            all the threads together); requests over the limit wait for a
+            free slot. No limit by default.
+        :param hosts: Nodes to send the requests to. All the nodes (of
+            `TrafficClasses`) by default.
+        :param selector_class: `search.ConnectionSelector` subclass,
+            selecting the node of every request.
+        :param rate_limiter: `RateLimiter` installed into the client.
+        :param kwargs: Other keyword arguments of the client (e.g.
+            `http_compress`).
+        """
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_on_timeout = retry_on_timeout
+        self.max_concurrency = max_concurrency
+        self.hosts = hosts
+        self.selector_class = selector_class
+        self.rate_limiter = rate_limiter
+        self.kwargs = kwargs
+
+    def client_kwargs(self) -> dict:
+        """Get the keyword arguments of the client of the class."""
+        kwargs = dict(
+            self.kwargs,
+            maxsize=self.maxsize,
+            timeout=self.timeout,
+            max_retries=self.max_retries,
+            retry_on_timeout=self.retry_on_timeout,
+        )
+        if self.selector_class is not None:
+            kwargs["selector_class"] = self.selector_class
+        if self.hosts is not None:
+            kwargs["hosts"] = self.hosts
+        return kwargs
+
+
+def _limited_transport_class():
+    """Get the `search.Transport` subclass limiting concurrent requests."""
+    global _LimitedTransport
+
+    if _LimitedTransport is None:
+
+        class LimitedTransport(search.Transport):
+            """Transport with a limit of the requests in flight."""
+
+            semaphore = None
+
+            def perform_request(self, *args, **kwargs):
+                if self.semaphore is None:
+                    return super(LimitedTransport, self).perform_request(
+                        *args, **kwargs
+                    )
+                with self.semaphore:
+                    return super(LimitedTransport, self).perform_request(
+                        *args, **kwargs
+                    )
+
+        _LimitedTransport = LimitedTransport
+    return _LimitedTransport
+
+
+# Created on the first use, not to import the backend when importing this
+# module.
+_LimitedTransport = None
+
+
+class TrafficClasses(object):
+    """Separate clients (and connection pools) per class of traffic.
+
+    Every traffic class gets a client of its own: its own `Transport`,
+    `ConnectionPool` and HTTP connections, with its own pool size, timeouts,
+    retries and node selection. Requests of one class never wait for a
+    connection (or behind a large body on a socket) used by another class.
+    A `max_concurrency` limit keeps batch traffic from saturating the
+    cluster.
+
+    Usage:
+
+        traffic = TrafficClasses(
+            ["https://search:9200"],
+            {
+                "interactive": TrafficClass(maxsize=25, timeout=2),
+                "batch": TrafficClass(
+                    maxsize=4, timeout=120, max_concurrency=4,
+                    http_compress=True,
+                ),
+            },
+            http_auth=("user", "secret"),
+        )
+        traffic.register()
+        Page.search(using="interactive")
+        retrying_bulk(traffic["batch"], actions)
+    """
+
+    def __init__(self, hosts=None, classes: dict = None, **client_kwargs):
+        """
+        :param hosts: Nodes of the cluster (as for the client).
+        :param classes: `TrafficClass` instances per name.
+        :param client_kwargs: Keyword arguments of all the clients.
+        """
+        self.hosts = hosts
+        self.classes = dict(classes or {})
+        self.client_kwargs = client_kwargs
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str):
+        return self.client(name)
+
+    def __iter__(self):
+        return iter(self.classes)
+
+    def client(self, name: str):
+        """Get the client of a traffic class (created on the first use).
+
+        :param name: Traffic class name.
+        :return: `AnySearch` client instance.
+        """
+        with self._lock:
+            if name not in self._clients:
+                traffic_class = self.classes[name]
+                kwargs = dict(self.client_kwargs, hosts=self.hosts)
+                kwargs.update(traffic_class.client_kwargs())
+                if traffic_class.max_concurrency:
+                    kwargs["transport_class"] = _limited_transport_class()
+                client = search.AnySearch(**kwargs)
+                if traffic_class.max_concurrency:
+                    client.transport.semaphore = threading.BoundedSemaphore(
+                        traffic_class.max_concurrency
+                    )
+                if traffic_class.rate_limiter is not None:
+                    traffic_class.rate_limiter.install(client)
+                self._clients[name] = client
+            return self._clients[name]
+
+    def register(self, names=None):
+        """Register the clients as `search_dsl` connections (aliases being
+        the traffic class names), to be used as `using`.
+
+        :param names: Traffic classes to register. All by default.
+        """
+        for name in names or self.classes:
+            search_dsl.connections.add_connection(name, self.client(name))
+
+    def close(self):
+        """Close the connections of all the clients."""
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.transport.close()
+
+
+# **************************************************
+# **************************************************
+# ***************** Rate limiting ******************
+# **************************************************
+# **************************************************
+
+
+class RateLimitExceeded(Exception):
+    """Raised by a (fail fast) `RateLimiter` instead of waiting.
+
+    The bulk helpers wait `retry_after` seconds and resend the chunk.
+    """
+
+    def __init__(self, limit: "RateLimit", retry_after: float):
+        super(RateLimitExceeded, self).__init__(
+            f"Rate limit {limit.pattern}:{limit.operation} exceeded, "
+            f"retry after {retry_after:.3f}s."
+        )
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """Token bucket, refilled with `rate` tokens per second up to `burst`.
+
+    Tokens can be reserved ahead (the balance going negative), the caller
+    waiting for the returned delay: requests are paced smoothly, in the
+    order they came. A full bucket admits any request, even one taking more
+    tokens than `burst`.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        """
+        :param rate: Tokens per second.
+        :param burst: Capacity of the bucket. Defaults to `rate` (one
+            second worth of tokens).
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def delay(self, tokens: float, now: float = None) -> float:
+        """Get the number of seconds until the tokens are available."""
+        self._refill(time.monotonic() if now is None else now)
+        return max(min(tokens, self.burst) - self.tokens, 0.0) / self.rate
+
+    def take(self, tokens: float, now: float = None):
+        """Take (reserve) the tokens."""
+        self._refill(time.monotonic() if now is None else now)
+        self.tokens -= tokens
+
+
+class RateLimit(object):
+    """Rate limit of the requests of an operation on matching indices.
+
+    Operations are `"search"` (`_search`, `_msearch`, `_count`, templates;
+    a token per search), `"scroll"` (a token per scroll request), `"bulk"`
+    (a token per byte of the body, accounted to the indices of the actions)
+    and `"other"` (a token per request), or `"*"` for all of them.
+    """
+
+    def __init__(
+        self,
+        pattern: str,
+        operation: str,
+        rate: float,
+        burst: float = None,
+    ):
+        """
+        :param pattern: Index name pattern (`fnmatch` style, e.g. `logs-*`).
+        :param operation: Operation (see above).
+        :param rate: Tokens per second.
+        :param burst: Capacity of the bucket (see `TokenBucket`).
+        """
+        self.pattern = pattern
+        self.operation = operation
+        self.bucket = TokenBucket(rate, burst)
+        self.requests = 0
+        self.tokens = 0
+        self.delayed = 0
+        self.waited = 0.0
+        self.rejected = 0
+
+    def tokens_for(self, operation: str, tokens_per_index: dict) -> float:
+        """Get the tokens a request takes from the bucket (0 if the limit
+        doesn't apply)."""
+        if self.operation not in ("*", operation):
+            return 0
+        return sum(
+            _tokens
+            for _index, _tokens in tokens_per_index.items()
+            if fnmatch.fnmatchcase(_index, self.pattern)
+        )
+
+
+# Path parts of the search requests.
+_SEARCH_PATH_PARTS = {"_search", "_msearch", "_count", "_search_template"}
+
+_BULK_ACTION_RE = re.compile(r'\s*\{\s*"(\w+)"')
+_BULK_INDEX_RE = re.compile(r'"_index"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+
+def _body_lines(body) -> list:
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    if isinstance(body, str):
+        return body.split("\n")
+    return list(body or [])
+
+
+def _line_bytes(line) -> int:
+    """Get the (UTF-8 encoded) size of a body line."""
+    if isinstance(line, bytes):
+        return len(line)
+    return len(line.encode("utf-8"))
+
+
+def _bulk_index_bytes(body, default_index: str) -> dict:
+    """Get the size (in bytes) of the actions of a bulk body per index."""
+    sizes = collections.Counter()
+    lines = iter(_body_lines(body))
+    for line in lines:
+        if not line:
+            continue
+        size = _line_bytes(line) + 1
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        match = _BULK_INDEX_RE.search(line)
+        index = match.group(1) if match else default_index
+        action = _BULK_ACTION_RE.match(line)
+        if action is None or action.group(1) != "delete":
+            size += _line_bytes(next(lines, "")) + 1
+        sizes[index] += size
+    return sizes
+
+
+def _msearch_index_counts(body, default_index: str) -> dict:
+    """Get the number of searches of a multi search body per index."""
+    counts = collections.Counter()
+    lines = [_line for _line in _body_lines(body) if _line]
+    for header in lines[::2]:
+        if not isinstance(header, dict):
+            header = json.loads(header)
+        indices = header.get("index") or default_index
+        if isinstance(indices, str):
+            indices = indices.split(",")
+        for index in indices:
+            counts[index] += 1
+    return counts
+
+
+def _request_tokens(method: str, url: str, body) -> tuple:
+    """Classify a request.
+
+    :return: Tuple of the operation and of the tokens per index.
+    """
+    parts = url.split("?", 1)[0].strip("/").split("/")
+    index = ""
+    if parts and parts[0] and not parts[0].startswith("_"):
+        index = unquote(parts[0])
+    if "_search" in parts and "scroll" in parts:
+        return "scroll", {index: 1}
+    if "_bulk" in parts:
+        return "bulk", _bulk_index_bytes(body, index)
+    if "_msearch" in parts:
+        return "search", _msearch_index_counts(body, index)
+    if _SEARCH_PATH_PARTS.intersection(parts):
+        operation = "search"
+    else:
+        operation = "other"
+    return operation, {_index: 1 for _index in index.split(",")}
+
+
+class RateLimiter(object):
+    """Client side rate limiting of the requests, with token buckets.
+
+    Installed into a client (sync or async) with `install`, every request
+    takes tokens from the buckets of the matching `RateLimit` instances.
+    When the tokens aren't available, the request waits until they are
+    (smoothly pacing the requests), or, if that would take longer than
+    `max_wait`, fails fast with `RateLimitExceeded` (not taking any
+    tokens). The bulk helpers (`retrying_bulk` and everything built on it)
+    wait and resend the chunk on `RateLimitExceeded`, so rate limiting
+    lowers the rate of the chunks instead of failing items.
+
+    Usage:
+
+        limiter = RateLimiter(
+            [
+                RateLimit("logs-*", "bulk", rate=5 * 2**20),
+                RateLimit("*", "search", rate=200, burst=50),
+            ]
+        )
+        limiter.install(client)
+        limiter.metrics()
+    """
+
+    def __init__(self, limits, max_wait: float = None):
+        """
+        :param limits: `RateLimit` instances.
+        :param max_wait: Maximum number of seconds a request waits for
+            tokens (0 to fail fast). No limit by default.
+        """
+        self.limits = list(limits)
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+
+    def reserve(self, method: str, url: str, body=None) -> float:
+        """Take the tokens of a request.
+
+        :return: Number of seconds to wait before sending the request.
+        :raise RateLimitExceeded: If the wait would exceed `max_wait`.
+        """
+        operation, tokens_per_index = _request_tokens(method, url, body)
+        with self._lock:
+            now = time.monotonic()
+            matched = []
+            delay = 0.0
+            for limit in self.limits:
+                tokens = limit.tokens_for(operation, tokens_per_index)
+                if not tokens:
+                    continue
+                limit_delay = limit.bucket.delay(tokens, now)
+                if self.max_wait is not None and limit_delay > self.max_wait:
+                    limit.rejected += 1
+                    raise RateLimitExceeded(limit, limit_delay)
+                matched.append((limit, tokens, limit_delay))
+                delay = max(delay, limit_delay)
+            for limit, tokens, limit_delay in matched:
+                limit.bucket.take(tokens, now)
+                limit.requests += 1
+                limit.tokens += tokens
+                if limit_delay:
+                    limit.delayed += 1
+                    limit.waited += limit_delay
+        return delay
+
+    def install(self, client):
+        """Rate limit the requests of a client (sync or async).
+
+        :param client: `AnySearch` (or `AsyncAnySearch`) client instance.
+        :return: The client.
+        """
+        transport = client.transport
+        perform_request = transport.perform_request
+
+        if asyncio.iscoroutinefunction(perform_request):
+
+            async def _perform_request(method, url, *args, **kwargs):
+                delay = self.reserve(method, url, kwargs.get("body"))
+                if delay:
+                    await asyncio.sleep(delay)
+                return await perform_request(method, url, *args, **kwargs)
+
+        else:
+
+            def _perform_request(method, url, *args, **kwargs):
+                delay = self.reserve(method, url, kwargs.get("body"))
+                if delay:
+                    time.sleep(delay)
+                return perform_request(method, url, *args, **kwargs)
+
+        transport.perform_request = _perform_request
+        return client
+
+    def metrics(self) -> dict:
+        """Get the rate limiter metrics.
+
+        :return: Dict with `requests`, `tokens`, `delayed`, `waited`,
+            `rejected` and `available` (tokens) per `pattern:operation`.
+        """
+        with self._lock:
+            now = time.monotonic()
+            metrics = {}
+            for limit in self.limits:
+                limit.bucket._refill(now)
+                metrics[f"{limit.pattern}:{limit.operation}"] = {
+                    "requests": limit.requests,
+                    "tokens": limit.tokens,
+                    "delayed": limit.delayed,
+                    "waited": limit.waited,
+                    "rejected": limit.rejected,
+                    "available": limit.bucket.tokens,
+                }
+        return metrics
+
+
 # Complete the moves implementation.
 # This code is at the end of this module to speed up module loading.
 # Turn this module into a package.
@@ -0,0 +1,67 @@
+"""
+Benchmark decoding successful bulk responses: the JSON serializer vs the
+fast path of `BulkResponseSerializer`.
+
+The fast path only pays off while the items are not accessed (for instance,
+`retrying_bulk` with `yield_ok=False`). The "fast path + items" row shows
+the cost once they are.
+
+Run with the package installed (`pip install -e .`):
+
+    python benchmarks/bench_bulk_response.py [items]
+"""
+
+import json
+import sys
+import timeit
+
+from anysearch import BulkResponseSerializer, search
+
+
+def bulk_response(items: int, head: dict) -> str:
+    """Build a successful bulk response (as sent by the cluster)."""
+    return json.dumps(
+        dict(
+            head,
+            items=[
+                {
+                    "index": {
+                        "_index": "test",
+                        "_id": str(_i),
+                        "_version": 1,
+                        "result": "created",
+                        "_shards": {"total": 2, "successful": 1, "failed": 0},
+                        "_seq_no": _i,
+                        "_primary_term": 1,
+                        "status": 201,
+                    }
+                }
+                for _i in range(items)
+            ],
+        ),
+        separators=(",", ":"),
+    )
+
+
+def main(items: int = 5000, repeat: int = 20):
+    fast = BulkResponseSerializer()
+    for label, head in (
+        ("took, errors", {"took": 30, "errors": False}),
+        ("errors, took", {"errors": False, "took": 30}),
+        ("ingest_took", {"took": 30, "ingest_took": 2, "errors": False}),
+    ):
+        body = bulk_response(items, head)
+        print(f"{items} item response ({label}), {len(body) / 1024:.0f} KB")
+        for name, loads in (
+            ("full decode", search.JSONSerializer().loads),
+            ("fast path", fast.loads),
+            ("fast path + items", lambda s: len(fast.loads(s)["items"])),
+        ):
+            seconds = min(
+                timeit.repeat(lambda: loads(body), number=1, repeat=repeat)
+            )
+            print(f"  {name:<18} {seconds * 1e6:10.1f} us per chunk")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:2]))
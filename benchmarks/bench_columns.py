@@ -0,0 +1,70 @@
+"""
+Benchmark decoding hits into numpy columns: iterating a `Response` (and its
+`Hit` wrappers) vs `hits_to_columns`.
+
+Run with the package installed (`pip install -e .`) and numpy:
+
+    python benchmarks/bench_columns.py [hits]
+"""
+
+import sys
+import time
+
+import numpy
+
+from anysearch import hits_to_columns, search_dsl
+
+FIELDS = ["price", "stock", "shop.name"]
+DTYPES = {"price": "f8", "stock": "i8"}
+
+
+def raw_hits(count: int) -> list:
+    """Build raw hits with 3 fields (one of them nested)."""
+    return [
+        {
+            "_index": "products",
+            "_id": str(_i),
+            "_score": 1.0,
+            "_source": {
+                "price": _i * 0.5,
+                "stock": _i % 100,
+                "shop": {"name": f"shop-{_i % 50}"},
+            },
+        }
+        for _i in range(count)
+    ]
+
+
+def response_columns(hits: list) -> dict:
+    request = search_dsl.Search()
+    response = request._response_class(request, {"hits": {"hits": hits}})
+    price, stock, shop = [], [], []
+    for hit in response:
+        price.append(hit.price)
+        stock.append(hit.stock)
+        shop.append(hit.shop.name)
+    return {
+        "price": numpy.array(price, "f8"),
+        "stock": numpy.array(stock, "i8"),
+        "shop.name": numpy.array(shop, object),
+    }
+
+
+def columns(hits: list) -> dict:
+    return hits_to_columns(hits, FIELDS, dtypes=DTYPES)
+
+
+def main(count: int = 200000):
+    hits = raw_hits(count)
+    print(f"{count} hits, {len(FIELDS)} fields")
+    for name, function in (
+        ("Response/Hit iteration + np.array", response_columns),
+        ("hits_to_columns", columns),
+    ):
+        start = time.perf_counter()
+        function(hits)
+        print(f"  {name:<34} {time.perf_counter() - start:6.2f} s")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,89 @@
+"""
+Benchmark reading large result sets: the hits of a `Response` vs compact
+`HitRecord` instances (`to_records`).
+
+Measured per variant: the memory retained by the decoded response and its
+hit objects, and the time to decode the JSON, build the hits and access 4
+attributes of every hit.
+
+Run with the package installed (`pip install -e .`):
+
+    python benchmarks/bench_records.py [hits]
+"""
+
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from anysearch import hit_record_class, search_dsl, to_records
+
+FIELDS = ["title", "price", "tags", "shop.name"]
+
+
+def response_body(count: int) -> str:
+    """Build a search response with 4 fields (one of them nested)."""
+    return json.dumps(
+        {
+            "hits": {
+                "hits": [
+                    {
+                        "_index": "products",
+                        "_id": str(_i),
+                        "_score": 1.0,
+                        "_source": {
+                            "title": f"Product {_i}",
+                            "price": _i * 0.5,
+                            "tags": ["a", "b"],
+                            "shop": {"name": f"shop-{_i % 50}"},
+                        },
+                    }
+                    for _i in range(count)
+                ]
+            }
+        }
+    )
+
+
+def response_hits(body: str) -> list:
+    request = search_dsl.Search()
+    hits = list(request._response_class(request, json.loads(body)))
+    for hit in hits:
+        hit.title, hit.price, hit.tags, hit.shop.name
+    return hits
+
+
+def records(body: str) -> list:
+    record_class = hit_record_class(FIELDS)
+    hits = to_records(json.loads(body)["hits"]["hits"], record_class)
+    for hit in hits:
+        hit.title, hit.price, hit.tags, hit.shop.name
+    return hits
+
+
+def main(count: int = 10000):
+    body = response_body(count)
+    print(f"{count} hits, {len(FIELDS)} fields, JSON decode included")
+    for name, function in (
+        ("Response.hits", response_hits),
+        ("HitRecord", records),
+    ):
+        gc.collect()
+        start = time.perf_counter()
+        function(body)
+        seconds = time.perf_counter() - start
+        # Traced separately, tracing slows everything down.
+        tracemalloc.start()
+        hits = function(body)
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(
+            f"  {name:<14} {retained / 2**20:5.1f} MB retained, "
+            f"{seconds * 1e3:4.0f} ms"
+        )
+        del hits
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,78 @@
+"""
+Benchmark turning a matrix of float32 vectors into bulk lines: `.tolist()`
+with the JSON serializer vs `vector_actions` (both encodings).
+
+The base64 encoding is Elasticsearch only; run with
+`ANYSEARCH_PREFERRED_BACKEND=Elasticsearch` to include it.
+
+Run with the package installed (`pip install -e .`) and numpy:
+
+    python benchmarks/bench_vectors.py [vectors] [dims]
+"""
+
+import sys
+import time
+
+import numpy
+
+from anysearch import search, vector_actions
+
+
+def tolist_actions(index: str, field: str, vectors):
+    for _i, row in enumerate(vectors):
+        yield {
+            "_index": index,
+            "_id": str(_i),
+            "_source": {field: row.tolist()},
+        }
+
+
+def bulk_lines(actions) -> int:
+    """Serialize actions into bulk lines, returning their size."""
+    serializer = search.JSONSerializer()
+    size = 0
+    for action in actions:
+        meta = {
+            action.get("_op_type", "index"): {
+                _key: action[_key]
+                for _key in ("_index", "_id")
+                if _key in action
+            }
+        }
+        data = serializer.dumps(action["_source"])
+        size += len(serializer.dumps(meta)) + len(data) + 2
+    return size
+
+
+def main(count: int = 20000, dims: int = 384):
+    vectors = numpy.random.default_rng(0).random((count, dims), "f4")
+    ids = [str(_i) for _i in range(count)]
+    print(f"{count} x {dims} float32 vectors, actions to bulk lines")
+    for name, actions in (
+        (".tolist() + serializer", lambda: tolist_actions("i", "v", vectors)),
+        (
+            "encoding='json'",
+            lambda: vector_actions("i", "v", vectors, ids=ids),
+        ),
+        (
+            "encoding='base64'",
+            lambda: vector_actions(
+                "i", "v", vectors, ids=ids, encoding="base64"
+            ),
+        ),
+    ):
+        start = time.perf_counter()
+        try:
+            size = bulk_lines(actions())
+        except ValueError as err:
+            print(f"  {name:<24} skipped: {err}")
+            continue
+        seconds = time.perf_counter() - start
+        print(
+            f"  {name:<24} {count / seconds / 1000:6.1f}k vectors/s, "
+            f"{size / count / 1000:4.1f} kB/doc"
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:3]))
@@ -1,14 +1,73 @@
+import asyncio
+import base64
+import datetime
+import fnmatch
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from importlib import import_module
 from unittest import mock
 
 from anysearch import (
     ELASTICSEARCH,
     OPENSEARCH,
+    AsyncDocumentLoader,
+    AsyncSearchBatch,
+    BatchedResponse,
+    BulkResponseSerializer,
+    BulkRetryQueue,
+    BulkSpool,
+    ByQueryTask,
+    CoalescingBulkWriter,
+    DocumentLoader,
+    DocumentSession,
+    ExpensiveQueryError,
+    LazyDocumentMixin,
+    Param,
+    PreparedSearch,
+    QueryCostWarning,
+    RateLimit,
+    RateLimiter,
+    RateLimitExceeded,
+    ReadProfile,
+    ReadProfileMixin,
+    Reindexer,
+    SearchBatch,
+    SearchPaginator,
+    SearchTemplate,
+    TokenBucket,
+    TrafficClass,
+    TrafficClasses,
+    analyze_search,
+    bootstrap_indices,
+    buckets_to_columns,
+    bulk_load_mode,
+    bulk_vectors,
     check_if_package_is_installed,
+    columns_to_dataframe,
     detect_search_backend,
+    execute_records,
+    fast_date_field,
     get_installed_packages,
+    guard_search,
+    hit_record_class,
+    hits_to_columns,
+    knn_search,
+    parallel_scan,
+    parse_date,
+    retrying_bulk,
+    search,
+    search_dsl,
+    search_to_columns,
+    to_records,
+    vector_actions,
+    vector_field,
 )
 
 __title__ = "test_anysearch"
@@ -565,3 +624,2808 @@ class AnySearchTestCase(unittest.TestCase):
     def test_check_if_package_is_installed(self):
         """Test get_installed_packages."""
         self.assertTrue(check_if_package_is_installed("pytest"))
+
+
+class FakeBulkClient(object):
+    """Stand-in client, which answers `bulk` requests from a script.
+
+    Each scripted response is a list of item statuses (or an exception to
+    raise), consumed one per `bulk` call.
+    """
+
+    def __init__(self, *responses):
+        self.transport = mock.Mock(serializer=search.JSONSerializer())
+        self.responses = list(responses)
+        self.requests = []
+
+    def bulk(self, body, **kwargs):
+        self.requests.append(body)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        items = []
+        for line, status in zip(
+            (_line for _line in body if '"_id"' in _line), response
+        ):
+            op_type = next(iter(json.loads(line)))
+            items.append({op_type: {"status": status}})
+        return {
+            "took": 1,
+            "errors": any(status >= 300 for status in response),
+            "items": items,
+        }
+
+
+class RetryingBulkTestCase(unittest.TestCase):
+    """Test retrying_bulk."""
+
+    def _actions(self, count):
+        return [
+            {"_index": "test", "_id": str(_i), "value": _i}
+            for _i in range(count)
+        ]
+
+    def test_only_failed_items_are_retried(self):
+        client = FakeBulkClient([201, 429, 201, 409], [201])
+        results = list(
+            retrying_bulk(client, self._actions(4), initial_backoff=0)
+        )
+        self.assertEqual(len(client.requests), 2)
+        # Second request contains the rejected item only.
+        self.assertEqual(len(client.requests[1]), 2)
+        self.assertIn('"_id":"1"', client.requests[1][0])
+        self.assertEqual(
+            sorted(ok for ok, _ in results), [False, True, True, True]
+        )
+        failed = [info for ok, info in results if not ok]
+        self.assertEqual(failed[0]["index"]["status"], 409)
+        self.assertEqual(failed[0]["index"]["data"], {"value": 3})
+
+    def test_retried_items_are_merged_into_later_chunks(self):
+        client = FakeBulkClient([429, 201], [201, 201], [201, 201])
+        results = list(
+            retrying_bulk(
+                client, self._actions(5), chunk_size=2, initial_backoff=0
+            )
+        )
+        self.assertEqual(len(client.requests), 3)
+        self.assertIn('"_id":"0"', client.requests[1][0])
+        self.assertIn('"_id":"2"', client.requests[1][2])
+        self.assertTrue(all(ok for ok, _ in results))
+        self.assertEqual(len(results), 5)
+
+    def test_retries_are_limited(self):
+        client = FakeBulkClient([429], [429], [429])
+        results = list(
+            retrying_bulk(
+                client, self._actions(1), max_retries=2, initial_backoff=0
+            )
+        )
+        self.assertEqual(len(client.requests), 3)
+        self.assertEqual(results[0][0], False)
+        self.assertEqual(results[0][1]["index"]["status"], 429)
+
+    def test_writes_to_the_same_document_keep_their_order(self):
+        client = FakeBulkClient([429, 201], [201], [201])
+        actions = [
+            {"_index": "test", "_id": "0", "value": 0},
+            {"_index": "test", "_id": "1", "value": 1},
+            {"_index": "test", "_id": "0", "value": 2},
+        ]
+        results = list(retrying_bulk(client, actions, initial_backoff=0))
+        self.assertEqual(len(client.requests), 3)
+        self.assertEqual(len(client.requests[0]), 4)
+        self.assertEqual(client.requests[1][1], '{"value":0}')
+        self.assertEqual(client.requests[2][1], '{"value":2}')
+        self.assertTrue(all(ok for ok, _ in results))
+
+    def test_whole_chunk_rejection_is_retried(self):
+        client = FakeBulkClient(
+            search.TransportError(429, "too_many_requests", {}), [201, 201]
+        )
+        results = list(
+            retrying_bulk(
+                client, self._actions(2), initial_backoff=0, yield_ok=False
+            )
+        )
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(results, [])
+
+    def test_backoff(self):
+        queue = BulkRetryQueue(initial_backoff=1, max_backoff=5, jitter=False)
+        self.assertEqual(
+            [queue.backoff(_i) for _i in range(1, 6)], [1, 2, 4, 5, 5]
+        )
+        queue.push("a", 2, now=0)
+        queue.push("b", 1, now=0)
+        self.assertEqual(queue.pop_ready(now=1), [(1, "b")])
+        self.assertEqual(queue.next_ready_in(now=1), 1)
+        self.assertEqual(queue.pop_ready(now=2), [(2, "a")])
+        self.assertEqual(len(queue), 0)
+
+
+class BulkResponseSerializerTestCase(unittest.TestCase):
+    """Test BulkResponseSerializer."""
+
+    def setUp(self):
+        self.serializer = BulkResponseSerializer()
+
+    def test_successful_response_items_are_lazy(self):
+        raw = json.dumps(
+            {
+                "took": 3,
+                "errors": False,
+                "items": [{"index": {"_id": "1", "status": 201}}],
+            },
+            separators=(",", ":"),
+        )
+        with mock.patch.object(
+            self.serializer.serializer, "loads", wraps=json.loads
+        ) as loads:
+            response = self.serializer.loads(raw)
+            self.assertEqual(response["took"], 3)
+            self.assertFalse(response["errors"])
+            loads.assert_not_called()
+            self.assertEqual(response["items"][0]["index"]["_id"], "1")
+            self.assertEqual(len(response["items"]), 1)
+            loads.assert_called_once()
+
+    def test_field_order_does_not_matter(self):
+        for raw in (
+            '{"errors":false,"took":3,"items":[{"index":{"status":201}}]}',
+            '{"took": 3, "ingest_took": 1, "errors": false, "items": []}',
+        ):
+            with self.subTest(raw=raw):
+                response = self.serializer.loads(raw)
+                self.assertFalse(response["errors"])
+                self.assertEqual(response["took"], 3)
+                self.assertNotIsInstance(response["items"], list)
+                self.assertEqual(len(response["items"]), raw.count("status"))
+
+    def test_failed_response_is_decoded(self):
+        raw = '{"took":3,"errors":true,"items":[{"index":{"status":429}}]}'
+        response = self.serializer.loads(raw.encode("utf-8"))
+        self.assertTrue(response["errors"])
+        self.assertIsInstance(response["items"], list)
+
+    def test_other_responses(self):
+        self.assertEqual(self.serializer.loads('{"a":1}'), {"a": 1})
+        self.assertEqual(self.serializer.dumps({"a": 1}), '{"a":1}')
+
+    def test_retrying_bulk_skips_items_on_success(self):
+        client = FakeBulkClient()
+        items = mock.MagicMock()
+        client.bulk = mock.Mock(
+            return_value={"took": 1, "errors": False, "items": items}
+        )
+        actions = [{"_index": "test", "_id": "1"}]
+        results = list(retrying_bulk(client, actions, yield_ok=False))
+        self.assertEqual(results, [])
+        self.assertFalse(items.mock_calls)
+
+
+class CoalescingBulkWriterTestCase(unittest.TestCase):
+    """Test CoalescingBulkWriter."""
+
+    def setUp(self):
+        self.sent = []
+
+        def bulk(client, actions, **kwargs):
+            self.sent.append(actions)
+            return iter([])
+
+        self.writer = CoalescingBulkWriter(None, max_actions=10, bulk=bulk)
+
+    def test_latest_full_document_wins(self):
+        with self.writer as writer:
+            writer.add({"_index": "i", "_id": "1", "value": 1})
+            writer.add({"_index": "i", "_id": "1", "value": 2})
+            writer.add({"_index": "i", "_id": "2", "value": 3})
+        self.assertEqual(
+            self.sent,
+            [
+                [
+                    {
+                        "_op_type": "index",
+                        "_index": "i",
+                        "_id": "1",
+                        "_source": {"value": 2},
+                    },
+                    {
+                        "_op_type": "index",
+                        "_index": "i",
+                        "_id": "2",
+                        "_source": {"value": 3},
+                    },
+                ]
+            ],
+        )
+        self.assertEqual(self.writer.coalesced, 1)
+
+    def test_partial_updates_are_merged(self):
+        self.writer.add(
+            {"_index": "i", "_id": "1", "a": {"b": 1, "c": 1}, "d": [1]}
+        )
+        self.writer.add(
+            {
+                "_op_type": "update",
+                "_index": "i",
+                "_id": "1",
+                "doc": {"a": {"c": 2}, "d": [2]},
+            }
+        )
+        self.writer.add(
+            {"_op_type": "update", "_index": "i", "_id": "2", "doc": {"a": 1}}
+        )
+        self.writer.add(
+            {"_op_type": "update", "_index": "i", "_id": "2", "doc": {"b": 1}}
+        )
+        self.writer.flush()
+        first, second = self.sent[0]
+        self.assertEqual(first["_source"], {"a": {"b": 1, "c": 2}, "d": [2]})
+        self.assertEqual(first["_op_type"], "index")
+        self.assertEqual(second["_source"], {"doc": {"a": 1, "b": 1}})
+        self.assertEqual(second["_op_type"], "update")
+
+    def test_delete_supersedes_writes(self):
+        self.writer.add({"_index": "i", "_id": "1", "value": 1})
+        self.writer.add({"_op_type": "delete", "_index": "i", "_id": "1"})
+        self.writer.flush()
+        self.assertEqual(
+            self.sent,
+            [[{"_op_type": "delete", "_index": "i", "_id": "1"}]],
+        )
+
+    def test_routing_is_part_of_the_key(self):
+        self.writer.add({"_index": "i", "_id": "1", "_routing": "a"})
+        self.writer.add({"_index": "i", "_id": "1", "_routing": "b"})
+        self.writer.flush()
+        self.assertEqual(len(self.sent[0]), 2)
+
+    def test_non_mergeable_actions_flush_first(self):
+        self.writer.add({"_op_type": "delete", "_index": "i", "_id": "1"})
+        self.writer.add(
+            {"_op_type": "update", "_index": "i", "_id": "1", "doc": {"a": 1}}
+        )
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(len(self.writer), 1)
+
+    def test_update_after_create_or_other_meta_flushes_first(self):
+        self.writer.add({"_op_type": "create", "_index": "i", "_id": "1"})
+        self.writer.add(
+            {"_op_type": "update", "_index": "i", "_id": "1", "doc": {"a": 1}}
+        )
+        self.assertEqual(len(self.sent), 1)
+        self.writer.add(
+            {
+                "_op_type": "update",
+                "_index": "i",
+                "_id": "1",
+                "doc": {"b": 1},
+                "retry_on_conflict": 3,
+            }
+        )
+        self.writer.flush()
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(self.sent[2][0]["retry_on_conflict"], 3)
+
+    def test_flush_on_size_and_age(self):
+        for _i in range(10):
+            self.writer.add({"_index": "i", "_id": str(_i)})
+        self.assertEqual(len(self.sent), 1)
+        self.writer.max_age = 0
+        self.writer.add({"_index": "i", "_id": "1"})
+        self.assertEqual(len(self.sent), 2)
+
+
+class BulkLoadModeTestCase(unittest.TestCase):
+    """Test bulk_load_mode."""
+
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.connection.indices.get_settings.return_value = {
+            "test-1": {
+                "settings": {
+                    "index.refresh_interval": "5s",
+                    "index.number_of_replicas": "2",
+                }
+            }
+        }
+        patcher = mock.patch.object(
+            search_dsl.Index, "_get_connection", return_value=self.connection
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _put_settings_calls(self):
+        return [
+            kwargs
+            for _, kwargs in (
+                self.connection.indices.put_settings.call_args_list
+            )
+        ]
+
+    def test_settings_are_restored(self):
+        with bulk_load_mode("test", max_num_segments=1) as snapshot:
+            self.assertEqual(snapshot["test-1"]["index.refresh_interval"], "5s")
+        applied, restored = self._put_settings_calls()
+        self.assertEqual(applied["index"], "test-1")
+        self.assertEqual(applied["body"]["index.refresh_interval"], "-1")
+        self.assertEqual(
+            restored["body"],
+            {
+                "index.refresh_interval": "5s",
+                "index.number_of_replicas": "2",
+                "index.translog.flush_threshold_size": None,
+            },
+        )
+        self.connection.indices.refresh.assert_called_once_with(index="test-1")
+        self.connection.indices.forcemerge.assert_called_once_with(
+            index="test-1", max_num_segments=1
+        )
+        self.connection.cluster.health.assert_called_once_with(
+            index="test-1", wait_for_status="green", timeout="30m"
+        )
+
+    def test_settings_are_restored_on_error(self):
+        with self.assertRaises(ValueError):
+            with bulk_load_mode(
+                search_dsl.Index("test"), profile={"refresh_interval": "-1"}
+            ):
+                raise ValueError()
+        applied, restored = self._put_settings_calls()
+        self.assertEqual(applied["body"], {"index.refresh_interval": "-1"})
+        self.assertEqual(restored["body"], {"index.refresh_interval": "5s"})
+        self.connection.indices.refresh.assert_not_called()
+        self.connection.cluster.health.assert_not_called()
+
+    def test_every_index_is_restored(self):
+        self.connection.indices.get_settings.return_value = {
+            _name: {"settings": {"index.refresh_interval": "5s"}}
+            for _name in ("test-1", "test-2", "test-3")
+        }
+        error = search.TransportError(500, "failure", {})
+        self.connection.indices.put_settings.side_effect = [
+            None,
+            error,
+            None,
+            error,
+        ]
+        with self.assertLogs("anysearch", "ERROR"):
+            with self.assertRaises(search.TransportError):
+                with bulk_load_mode("test", profile={"refresh_interval": "-1"}):
+                    pass
+        restored = [_call["index"] for _call in self._put_settings_calls()]
+        self.assertEqual(restored[1:], ["test-1", "test-2", "test-3"])
+        self.connection.indices.refresh.assert_not_called()
+
+        # The error of the load wins.
+        self.connection.indices.put_settings.side_effect = [
+            None,
+            error,
+            None,
+            None,
+        ]
+        with self.assertLogs("anysearch", "ERROR"):
+            with self.assertRaises(ValueError):
+                with bulk_load_mode("test", profile={"refresh_interval": "-1"}):
+                    raise ValueError()
+
+
+class BulkSpoolTestCase(unittest.TestCase):
+    """Test BulkSpool."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def _spool(self, **kwargs):
+        # Spooling every action to disk, unless told otherwise.
+        kwargs.setdefault("max_in_flight", 0)
+        return BulkSpool(self.directory.name, **kwargs)
+
+    def test_drain(self):
+        spool = self._spool()
+        spool.put_many(
+            [
+                {"_index": "i", "_id": "1", "value": 1},
+                {"_op_type": "delete", "_index": "i", "_id": "2"},
+            ]
+        )
+        self.assertEqual(spool.metrics()["depth"], 2)
+        self.assertEqual(spool.metrics()["segments"], 1)
+        client = FakeBulkClient([201, 200])
+        self.assertEqual(spool.drain(client), 2)
+        self.assertEqual(
+            client.requests[0],
+            [
+                '{"index":{"_id":"1","_index":"i"}}',
+                '{"value":1}',
+                '{"delete":{"_id":"2","_index":"i"}}',
+            ],
+        )
+        self.assertEqual(spool.depth, 0)
+        self.assertEqual(spool.oldest_age, 0)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_resume_after_restart(self):
+        spool = self._spool()
+        for _i in range(3):
+            spool.put({"_index": "i", "_id": str(_i)})
+        client = FakeBulkClient(
+            [201, 201], search.ConnectionError("N/A", "down", None)
+        )
+        with self.assertRaises(search.ConnectionError):
+            spool.drain(client, chunk_size=2, max_retries=0)
+
+        # Process died in the middle of writing a record.
+        with open(spool._segments[0].path, "ab") as segment_file:
+            segment_file.write(b'{"index":{"_id":"3"')
+
+        spool = self._spool()
+        self.assertEqual(spool.depth, 1)
+        client = FakeBulkClient([201])
+        self.assertEqual(spool.drain(client), 1)
+        self.assertIn('"_id":"2"', client.requests[0][0])
+
+    def test_unavailable_cluster_keeps_records(self):
+        spool = self._spool()
+        spool.put({"_index": "i", "_id": "1"})
+        client = FakeBulkClient(search.ConnectionError("N/A", "down", None))
+        with self.assertRaises(search.ConnectionError):
+            spool.drain(client, max_retries=0)
+        self.assertEqual(spool.depth, 1)
+
+    def test_throttled_items_keep_records(self):
+        failures = []
+        spool = self._spool(on_failure=failures.append)
+        spool.put_many(
+            [{"_index": "i", "_id": "1"}, {"_index": "i", "_id": "2"}]
+        )
+        client = FakeBulkClient([201, 429], [429])
+        with self.assertRaises(search.TransportError) as err:
+            spool.drain(client, max_retries=1, initial_backoff=0)
+        self.assertEqual(err.exception.status_code, 429)
+        self.assertEqual(failures, [])
+        self.assertEqual(spool._segments[0].offset, 0)
+        self.assertEqual(spool.depth, 2)
+
+    def test_permanent_failures_are_reported(self):
+        failures = []
+        spool = self._spool(on_failure=failures.append)
+        spool.put({"_index": "i", "_id": "1"})
+        spool.drain(FakeBulkClient([400]))
+        self.assertEqual(failures[0]["index"]["status"], 400)
+        self.assertEqual(spool.depth, 0)
+
+    def test_corrupt_and_truncated_records_are_reported(self):
+        failures = []
+        spool = self._spool(on_failure=failures.append)
+        spool.put({"_index": "i", "_id": "1"})
+        with open(spool._active[0].path, "ab") as segment_file:
+            segment_file.write(b'{"index":{"_id"\n{"value":1}\n')
+        spool.put({"_index": "i", "_id": "2"})
+        with open(spool._active[0].path, "ab") as segment_file:
+            segment_file.write(b'{"index":{"_id":"3"}}\n{"value"')
+        client = FakeBulkClient([201, 201])
+        self.assertEqual(spool.drain(client), 2)
+        self.assertEqual(len(client.requests[0]), 4)
+        self.assertEqual(
+            [_info["spool"]["error"] for _info in failures],
+            ["Corrupt spool record"] * 2 + ["Truncated spool record"],
+        )
+        self.assertEqual(
+            failures[-1]["spool"]["data"], '{"index":{"_id":"3"}}\n{"value"'
+        )
+        self.assertEqual(spool.depth, 0)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_rejected_requests_are_reported(self):
+        failures = []
+        spool = self._spool(on_failure=failures.append)
+        spool.put({"_index": "i", "_id": "1"})
+        spool.put({"_index": "i", "_id": "2"})
+        client = FakeBulkClient(
+            search.TransportError(413, "too_large", None), [201]
+        )
+        self.assertEqual(spool.drain(client, chunk_size=1), 2)
+        self.assertEqual(failures[0]["index"]["status"], 413)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(spool.depth, 0)
+
+    def test_background_draining(self):
+        spool = self._spool(segment_max_age=0)
+        client = FakeBulkClient([201])
+        spool.start(client, poll_interval=0.01)
+        spool.put({"_index": "i", "_id": "1"})
+        for _ in range(100):
+            if not spool.depth:
+                break
+            time.sleep(0.01)
+        spool.stop()
+        self.assertEqual(spool.depth, 0)
+        self.assertEqual(len(client.requests), 1)
+
+    def test_drain_after_stop(self):
+        spool = self._spool()
+        spool.start(FakeBulkClient(), poll_interval=0.01)
+        spool.stop()
+        spool.put({"_index": "i", "_id": "1"})
+        self.assertEqual(spool.drain(FakeBulkClient([201])), 1)
+        self.assertEqual(spool.depth, 0)
+
+    def test_actions_are_spooled_once_in_flight_budget_is_exhausted(self):
+        spool = self._spool(max_in_flight=2)
+        spool.put_many(
+            [{"_index": "i", "_id": "1"}, {"_index": "i", "_id": "2"}]
+        )
+        self.assertEqual(os.listdir(self.directory.name), [])
+        self.assertEqual(spool.metrics()["depth"], 2)
+        spool.put({"_index": "i", "_id": "3"})
+        self.assertEqual(spool.metrics()["segments"], 1)
+        client = FakeBulkClient([201, 201], [201])
+        self.assertEqual(spool.drain(client), 3)
+        self.assertEqual(
+            [_line for _request in client.requests for _line in _request],
+            [
+                '{"index":{"_id":"1","_index":"i"}}',
+                "{}",
+                '{"index":{"_id":"2","_index":"i"}}',
+                "{}",
+                '{"index":{"_id":"3","_index":"i"}}',
+                "{}",
+            ],
+        )
+        # Drained, the actions pass through again.
+        spool.put({"_index": "i", "_id": "4"})
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_stop_spills_in_flight_actions(self):
+        spool = self._spool(max_in_flight=1)
+        spool.put({"_index": "i", "_id": "1"})
+        spool.put({"_index": "i", "_id": "2"})
+        spool.stop()
+        spool = self._spool()
+        self.assertEqual(spool.depth, 2)
+        client = FakeBulkClient([201], [201])
+        self.assertEqual(spool.drain(client), 2)
+        # The in-memory action goes first.
+        self.assertIn('"_id":"1"', client.requests[0][0])
+        self.assertIn('"_id":"2"', client.requests[1][0])
+
+    def test_invalid_records_are_rejected_on_their_own(self):
+        failures = []
+        spool = self._spool(on_failure=failures.append)
+        spool.put_many(
+            [
+                {"_index": "i", "_id": "1", "_source": '{"value":'},
+                {"_index": "i", "_id": "2", "_source": '{"a":1}\n{"b":2}'},
+                {"_index": "i", "_id": "3", "value": 3},
+            ]
+        )
+        self.assertEqual(len(failures), 2)
+        self.assertTrue(
+            failures[0]["spool"]["error"].startswith("Invalid spool record")
+        )
+        self.assertEqual(spool.depth, 1)
+        client = FakeBulkClient([201])
+        self.assertEqual(spool.drain(client), 1)
+        self.assertEqual(client.requests[0][1], '{"value":3}')
+
+    def test_start_twice(self):
+        spool = self._spool()
+        spool.start(FakeBulkClient(), poll_interval=0.01)
+        self.addCleanup(spool.stop)
+        with self.assertRaises(RuntimeError):
+            spool.start(FakeBulkClient())
+
+    def test_background_draining_survives_errors(self):
+        spool = self._spool(segment_max_age=0)
+        client = FakeBulkClient(ValueError("corrupt"), [201])
+        with self.assertLogs("anysearch", logging.ERROR):
+            spool.start(client, poll_interval=0.01, max_backoff=0.01)
+            spool.put({"_index": "i", "_id": "1"})
+            for _ in range(100):
+                if not spool.depth:
+                    break
+                time.sleep(0.01)
+            spool.stop()
+        self.assertEqual(spool.depth, 0)
+        self.assertEqual(len(client.requests), 2)
+
+
+class FakeSearchClient(object):
+    """In-memory stand-in for a search cluster.
+
+    Supports just enough of the API (match all searches, sliced scrolls,
+    sliced point in time, bulk index/delete, count) to test the helpers.
+    Hits are sorted by `_id`, which is also returned as the sort value.
+    """
+
+    def __init__(self, documents=None, index="test"):
+        self.transport = mock.Mock(serializer=search.JSONSerializer())
+        self.transport.perform_request.side_effect = self._perform_request
+        self.documents = {index: dict(documents or {})}
+        self.contexts = {}
+        self.requests = []
+        self.scripts = {}
+        self._counter = iter(range(1, 1000000))
+
+    def _hits(self, index, body):
+        if index == "_all" and len(self.documents) == 1:
+            index = next(iter(self.documents))
+        hits = []
+        for _id, source in sorted(self.documents.get(index, {}).items()):
+            if "slice" in body:
+                slice_id, slices = body["slice"]["id"], body["slice"]["max"]
+                if zlib.crc32(_id.encode()) % slices != slice_id:
+                    continue
+            hit = {"_index": index, "_id": _id, "sort": [_id]}
+            hit.update(self._project(source, body))
+            hits.append(hit)
+        return hits
+
+    @staticmethod
+    def _project(source, body):
+        """Apply (top-level) `_source` filtering and `docvalue_fields`."""
+        projection = body.get("_source", True)
+        if isinstance(projection, list):
+            projection = {"includes": projection}
+        if projection is False:
+            projected = {}
+        elif isinstance(projection, dict):
+            includes = projection.get("includes") or list(source)
+            excludes = projection.get("excludes", [])
+            projected = {
+                "_source": {
+                    _key: _value
+                    for _key, _value in source.items()
+                    if any(fnmatch.fnmatchcase(_key, _p) for _p in includes)
+                    and not any(
+                        fnmatch.fnmatchcase(_key, _p) for _p in excludes
+                    )
+                }
+            }
+        else:
+            projected = {"_source": source}
+        fields = {
+            _field: [source[_field]]
+            for _field in body.get("docvalue_fields", [])
+            if _field in source
+        }
+        if fields:
+            projected["fields"] = fields
+        return projected
+
+    def _perform_request(self, method, url, params=None, body=None):
+        self.requests.append((method, url, params, body))
+        if method == "POST":
+            context_id = f"pit-{next(self._counter)}"
+            self.contexts[context_id] = url.split("/")[1]
+            if url.endswith("/_search/point_in_time"):
+                return {"pit_id": context_id}
+            return {"id": context_id}
+        for context_id in body.get("pit_id", [body.get("id")]):
+            self.contexts.pop(context_id)
+        return {}
+
+    def search(self, body=None, index=None, scroll=None, **kwargs):
+        if isinstance(body, str):
+            body = json.loads(body)
+        elif body is None:
+            # Named body parameters (recent Elasticsearch clients).
+            body = dict(kwargs)
+            if "from_" in body:
+                body["from"] = body.pop("from_")
+        if isinstance(index, list):
+            index = ",".join(index)
+        self.requests.append(("search", index, body))
+        if "knn" in body or "knn" in body.get("query", {}):
+            return {"hits": {"hits": self._knn_hits(index, body)}}
+        if "pit" in body:
+            index = self.contexts[body["pit"]["id"]]
+        hits = self._hits(index, body)
+        if "search_after" in body:
+            hits = [
+                _hit for _hit in hits if _hit["sort"] > body["search_after"]
+            ]
+        start, size = body.get("from", 0), body.get("size", 10)
+        hits = hits[start:]
+        response = {"hits": {"hits": hits[:size]}}
+        if scroll:
+            scroll_id = f"scroll-{next(self._counter)}"
+            self.contexts[scroll_id] = (hits[size:], size)
+            response["_scroll_id"] = scroll_id
+        return response
+
+    def _knn_hits(self, index, body):
+        """Exact k-NN (with l2 scores) for both backend syntaxes."""
+        if "knn" in body:
+            field, vector = body["knn"]["field"], body["knn"]["query_vector"]
+        else:
+            ((field, query),) = body["query"]["knn"].items()
+            vector = query["vector"]
+        hits = []
+        for _id, source in self.documents.get(index, {}).items():
+            distance = sum(
+                (_a - _b) ** 2 for _a, _b in zip(source[field], vector)
+            )
+            hits.append(
+                {"_index": index, "_id": _id, "_score": 1 / (1 + distance)}
+            )
+        hits.sort(key=lambda _hit: -_hit["_score"])
+        return hits[: body["size"]]
+
+    def put_script(self, id, body):
+        self.requests.append(("put_script", id, body))
+        self.scripts[id] = body["script"]["source"]
+
+    def _render_template(self, body):
+        if body["id"] not in self.scripts:
+            raise search.NotFoundError(404, "resource_not_found_exception")
+        source = self.scripts[body["id"]]
+        for name, value in body["params"].items():
+            source = source.replace(
+                "{{#toJson}}%s{{/toJson}}" % name, json.dumps(value)
+            )
+        return json.loads(source)
+
+    def search_template(self, body, index=None):
+        self.requests.append(("search_template", index, body))
+        return self.search(body=self._render_template(body), index=index)
+
+    def msearch_template(self, body):
+        self.requests.append(("msearch_template", None, body))
+        responses = []
+        for header, request in zip(body[::2], body[1::2]):
+            try:
+                request = self._render_template(request)
+            except search.NotFoundError as err:
+                responses.append({"error": {"type": err.error}, "status": 404})
+                continue
+            responses.append(self.search(body=request, index=header["index"]))
+        return {"responses": responses}
+
+    def msearch(self, body):
+        self.requests.append(("msearch", None, body))
+        if isinstance(body, str):
+            body = [json.loads(_line) for _line in body.splitlines()]
+        responses = []
+        for header, request in zip(body[::2], body[1::2]):
+            if isinstance(header["index"], list):
+                header["index"] = ",".join(header["index"])
+            if header["index"] not in self.documents:
+                responses.append(
+                    {
+                        "error": {"type": "index_not_found_exception"},
+                        "status": 404,
+                    }
+                )
+                continue
+            responses.append(self.search(body=request, index=header["index"]))
+        return {"responses": responses}
+
+    def mget(self, body, index):
+        self.requests.append(("mget", index, body))
+        documents = self.documents.get(index, {})
+        return {
+            "docs": [
+                (
+                    {
+                        "_index": index,
+                        "_id": _id,
+                        "found": True,
+                        "_source": documents[_id],
+                    }
+                    if _id in documents
+                    else {"_index": index, "_id": _id, "found": False}
+                )
+                for _id in body["ids"]
+            ]
+        }
+
+    def scroll(self, body):
+        hits, size = self.contexts[body["scroll_id"]]
+        self.contexts[body["scroll_id"]] = (hits[size:], size)
+        return {"_scroll_id": body["scroll_id"], "hits": {"hits": hits[:size]}}
+
+    def clear_scroll(self, body, **kwargs):
+        for scroll_id in body["scroll_id"]:
+            self.contexts.pop(scroll_id, None)
+
+    def count(self, index, body=None, **kwargs):
+        return {"count": len(self._hits(index, {}))}
+
+    def bulk(self, body, **kwargs):
+        self.requests.append(("bulk", kwargs, body))
+        items = []
+        lines = iter(body)
+        for line in lines:
+            action = json.loads(line)
+            op_type, meta = next(iter(action.items()))
+            documents = self.documents.setdefault(meta["_index"], {})
+            _id = meta.get("_id") or f"auto-{next(self._counter)}"
+            item = {"_index": meta["_index"], "_id": _id, "status": 200}
+            if op_type == "delete":
+                documents.pop(_id, None)
+            elif op_type == "update":
+                doc = json.loads(next(lines))["doc"]
+                if _id in documents:
+                    documents[_id].update(doc)
+                else:
+                    item = {"_id": _id, "status": 404, "error": "missing"}
+            else:
+                documents[_id] = json.loads(next(lines))
+            if item["status"] == 200:
+                item.update(_version=1, _seq_no=len(self.requests))
+            items.append({op_type: item})
+        errors = any(
+            _item[_op]["status"] >= 300 for _item in items for _op in _item
+        )
+        return {"took": 1, "errors": errors, "items": items}
+
+
+class ParallelScanTestCase(unittest.TestCase):
+    """Test parallel_scan."""
+
+    def setUp(self):
+        self.client = FakeSearchClient(
+            {str(_i).zfill(3): {"value": _i} for _i in range(100)}
+        )
+
+    def _scan(self, backend=ELASTICSEARCH, **kwargs):
+        with mock.patch("anysearch._client_backend", return_value=backend):
+            return list(parallel_scan(self.client, "test", **kwargs))
+
+    def test_point_in_time(self):
+        hits = self._scan(slices=3, size=7)
+        self.assertEqual(
+            sorted(_hit["_source"]["value"] for _hit in hits), list(range(100))
+        )
+        method, url, params, _ = self.client.requests[0]
+        self.assertEqual((method, url), ("POST", "/test/_pit"))
+        self.assertEqual(params, {"keep_alive": "5m"})
+        self.assertEqual(self.client.contexts, {})
+
+    def test_opensearch_point_in_time(self):
+        hits = self._scan(OPENSEARCH, slices=2, size=10, method="pit")
+        self.assertEqual(len(hits), 100)
+        _, url, _, _ = self.client.requests[0]
+        self.assertEqual(url, "/test/_search/point_in_time")
+        self.assertEqual(self.client.contexts, {})
+
+    def test_sliced_scroll(self):
+        hits = self._scan(OPENSEARCH, slices=4, size=9)
+        self.assertEqual(len({_hit["_id"] for _hit in hits}), 100)
+        self.assertFalse(self.client.transport.perform_request.called)
+        self.assertEqual(self.client.contexts, {})
+
+    def test_preserve_order(self):
+        hits = self._scan(slices=3, size=5, preserve_order=True, max_workers=2)
+        slices = [zlib.crc32(_hit["_id"].encode()) % 3 for _hit in hits]
+        self.assertEqual(slices, sorted(slices))
+        for slice_id in range(3):
+            ids = [
+                _hit["_id"]
+                for _hit, _slice_id in zip(hits, slices)
+                if _slice_id == slice_id
+            ]
+            self.assertEqual(ids, sorted(ids))
+
+    def test_contexts_are_released_when_abandoned(self):
+        with mock.patch(
+            "anysearch._client_backend", return_value=ELASTICSEARCH
+        ):
+            hits = parallel_scan(self.client, "test", slices=2, size=1)
+            next(hits)
+            hits.close()
+        self.assertEqual(self.client.contexts, {})
+
+
+class ReindexerTestCase(unittest.TestCase):
+    """Test Reindexer."""
+
+    def setUp(self):
+        self.source = FakeSearchClient(
+            {str(_i).zfill(3): {"value": _i} for _i in range(50)}, "source"
+        )
+        self.target = FakeSearchClient(index="target")
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.checkpoint_path = os.path.join(self.directory.name, "checkpoint")
+
+    def _reindexer(self, **kwargs):
+        kwargs.setdefault("slices", 3)
+        kwargs.setdefault("chunk_size", 4)
+        return Reindexer(
+            self.source,
+            self.target,
+            "source",
+            "target",
+            checkpoint_path=self.checkpoint_path,
+            initial_backoff=0,
+            **kwargs,
+        )
+
+    def test_reindex(self):
+        reports = []
+
+        def transform(action):
+            if action["_source"]["value"] % 10 == 0:
+                return None
+            action["_source"]["double"] = action["_source"]["value"] * 2
+            return action
+
+        progress = self._reindexer(
+            transform=transform, progress_callback=reports.append
+        ).run()
+        self.assertEqual(len(self.target.documents["target"]), 45)
+        self.assertEqual(self.target.documents["target"]["007"]["double"], 14)
+        self.assertEqual((progress.done, progress.total), (50, 50))
+        self.assertEqual(progress.failed, 0)
+        self.assertEqual(progress.eta, 0)
+        self.assertIs(reports[-1], progress)
+        self.assertEqual(self.source.contexts, {})
+
+    def test_resume(self):
+        with mock.patch(
+            "anysearch._client_backend", return_value=ELASTICSEARCH
+        ):
+            self._check_resume()
+        bodies = [_r[2] for _r in self.source.requests if _r[0] == "search"]
+        self.assertTrue(all("pit" in _body for _body in bodies))
+        self.assertEqual(bodies[0]["sort"], [{"_shard_doc": "asc"}])
+
+    def test_resume_with_scroll(self):
+        # Slicing a point in time isn't supported by all OpenSearch versions.
+        with mock.patch("anysearch._client_backend", return_value=OPENSEARCH):
+            self._check_resume()
+        bodies = [_r[2] for _r in self.source.requests if _r[0] == "search"]
+        self.assertFalse(any("pit" in _body for _body in bodies))
+        self.assertEqual(bodies[0]["sort"], [{"_id": "asc"}])
+        self.assertEqual(self.source.contexts, {})
+
+    def test_elasticsearch_scroll_is_not_sorted_by_id(self):
+        with mock.patch(
+            "anysearch._client_backend", return_value=ELASTICSEARCH
+        ), mock.patch("anysearch._open_scan_point_in_time", return_value=None):
+            self._reindexer().run()
+        bodies = [_r[2] for _r in self.source.requests if _r[0] == "search"]
+        self.assertEqual(bodies[0]["sort"], ["_doc"])
+        self.assertEqual(len(self.target.documents["target"]), 50)
+
+    def test_failed_documents_are_not_checkpointed(self):
+        bulk = self.target.bulk
+
+        def failing_bulk(body, **kwargs):
+            response = bulk(body, **kwargs)
+            for item in response["items"]:
+                if item["index"]["_id"] == "007":
+                    item["index"].update(status=400, error={"type": "x"})
+                    response["errors"] = True
+            return response
+
+        self.target.bulk = failing_bulk
+        progress = self._reindexer().run()
+        self.assertEqual(progress.failed, 1)
+        with open(self.checkpoint_path) as checkpoint_file:
+            positions = json.load(checkpoint_file)["positions"]
+        self.assertEqual(list(positions.values()).count(True), 2)
+
+        self.target.bulk = bulk
+        self.target.requests = []
+        self.assertEqual(self._reindexer().run().failed, 0)
+        written = [
+            _line
+            for _request in self.target.requests
+            for _line in _request[2]
+            if '"_id"' in _line
+        ]
+        self.assertIn('"_id":"007"', "".join(written))
+        self.assertLess(len(written), 50)
+
+    def _check_resume(self):
+        bulk = self.target.bulk
+        calls = []
+
+        def failing_bulk(body, **kwargs):
+            calls.append(body)
+            if len(calls) == 5:
+                raise search.TransportError(400, "failure", {})
+            return bulk(body, **kwargs)
+
+        self.target.bulk = failing_bulk
+        with self.assertRaises(search.TransportError):
+            self._reindexer().run()
+        self.assertLess(len(self.target.documents["target"]), 50)
+
+        written = []
+
+        def counting_bulk(body, **kwargs):
+            written.extend(_line for _line in body if '"_id"' in _line)
+            return bulk(body, **kwargs)
+
+        self.target.bulk = counting_bulk
+        progress = self._reindexer().run()
+        self.assertEqual(len(self.target.documents["target"]), 50)
+        self.assertEqual(progress.done, 50)
+        # Checkpointed documents are not reindexed again.
+        self.assertLess(len(written), 50)
+
+    def test_checkpoint_mismatch(self):
+        self._reindexer().run()
+        with self.assertRaises(ValueError):
+            self._reindexer(slices=2).run()
+
+
+class SearchPaginatorTestCase(unittest.TestCase):
+    """Test SearchPaginator."""
+
+    def setUp(self):
+        self.client = FakeSearchClient(
+            {str(_i).zfill(3): {"value": _i} for _i in range(25)}
+        )
+        search_dsl.connections.add_connection("paginator", self.client)
+        self.addCleanup(search_dsl.connections.remove_connection, "paginator")
+        self.search = search_dsl.Search(using="paginator", index="test")
+        backend = mock.patch(
+            "anysearch._client_backend", return_value=OPENSEARCH
+        )
+        self.backend = backend.start()
+        self.addCleanup(backend.stop)
+
+    def _bodies(self):
+        return [
+            _request[2]
+            for _request in self.client.requests
+            if _request[0] == "search"
+        ]
+
+    def test_iteration_uses_search_after(self):
+        paginator = SearchPaginator(self.search, page_size=10)
+        pages = [
+            [_hit.meta.id for _hit in _response] for _response in paginator
+        ]
+        self.assertEqual([len(_page) for _page in pages], [10, 10, 5])
+        self.assertEqual(pages[1][0], "010")
+        bodies = self._bodies()
+        self.assertEqual(
+            bodies[0]["sort"], [{"_score": "desc"}, {"_id": "asc"}]
+        )
+        self.assertEqual(bodies[1]["search_after"], ["009"])
+        self.assertTrue(all(_body["from"] == 0 for _body in bodies))
+
+    def test_deep_page_switches_to_search_after(self):
+        paginator = SearchPaginator(
+            self.search.sort("value"), page_size=5, max_result_window=10
+        )
+        response = paginator.page(2)
+        self.assertEqual(response.hits[0].meta.id, "005")
+        self.assertEqual(self._bodies()[-1]["from"], 5)
+        response = paginator.page(4)
+        self.assertEqual(response.hits[0].meta.id, "015")
+        bodies = self._bodies()
+        # Continues from the cursor of the second page.
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual(bodies[-1]["search_after"], ["014"])
+        self.assertEqual(bodies[-1]["sort"], ["value", {"_id": "asc"}])
+
+    def test_elasticsearch_deep_page_uses_point_in_time(self):
+        # Elasticsearch 8 doesn't allow sorting on `_id`.
+        self.backend.return_value = ELASTICSEARCH
+        with SearchPaginator(
+            self.search.sort("value"), page_size=5, max_result_window=10
+        ) as paginator:
+            self.assertEqual(paginator.page(2).hits[0].meta.id, "005")
+            self.assertEqual(paginator.page(4).hits[0].meta.id, "015")
+        self.assertEqual(self.client.contexts, {})
+        bodies = self._bodies()
+        self.assertEqual(bodies[0]["sort"], ["value"])
+        self.assertNotIn("pit", bodies[0])
+        self.assertTrue(all("pit" in _body for _body in bodies[1:]))
+        self.assertEqual(bodies[-1]["sort"], ["value", {"_shard_doc": "asc"}])
+
+    def test_search_without_index(self):
+        self.backend.return_value = ELASTICSEARCH
+        with SearchPaginator(
+            search_dsl.Search(using="paginator"), page_size=10
+        ) as paginator:
+            self.assertEqual(len(list(paginator.hits())), 25)
+        method, url, _, _ = self.client.requests[0]
+        self.assertEqual((method, url), ("POST", "/_all/_pit"))
+        self.assertEqual(self.client.contexts, {})
+
+    def test_elasticsearch_explicit_tiebreaker(self):
+        self.backend.return_value = ELASTICSEARCH
+        paginator = SearchPaginator(
+            self.search, page_size=10, tiebreaker={"order_id": "asc"}
+        )
+        self.assertEqual(len(list(paginator.hits())), 25)
+        bodies = self._bodies()
+        self.assertFalse(any("pit" in _body for _body in bodies))
+        self.assertEqual(bodies[0]["sort"][-1], {"order_id": "asc"})
+
+    def test_consistent_pagination(self):
+        self.backend.return_value = ELASTICSEARCH
+        with SearchPaginator(
+            self.search, page_size=10, consistent=True
+        ) as paginator:
+            self.assertEqual(len(list(paginator.hits())), 25)
+            self.assertTrue(self.client.contexts)
+        self.assertEqual(self.client.contexts, {})
+        body = self._bodies()[0]
+        self.assertEqual(body["pit"]["keep_alive"], "1m")
+        self.assertEqual(body["sort"][-1], {"_shard_doc": "asc"})
+
+
+class ColumnarExportTestCase(unittest.TestCase):
+    """Test the columnar export helpers."""
+
+    hits = [
+        {
+            "_id": "1",
+            "_score": 1.5,
+            "_source": {"price": 10.5, "stock": 3, "shop": {"name": "a"}},
+            "fields": {"day": ["2024-01-01"]},
+        },
+        {"_id": "2", "_score": 0.5, "_source": {"price": 2, "tags": ["x"]}},
+    ]
+
+    def test_hits_to_columns(self):
+        columns = hits_to_columns(
+            self.hits,
+            ["_id", "_score", "price", "stock", "shop.name", "fields.day"],
+            dtypes={"_score": "f8", "price": "f8", "stock": "i8"},
+            chunk_size=1,
+        )
+        self.assertEqual(list(columns["_id"]), ["1", "2"])
+        self.assertEqual(list(columns["_score"]), [1.5, 0.5])
+        self.assertEqual(list(columns["price"]), [10.5, 2.0])
+        self.assertEqual(list(columns["stock"]), [3, 0])
+        self.assertEqual(list(columns["shop.name"]), ["a", None])
+        self.assertEqual(list(columns["fields.day"]), ["2024-01-01", None])
+
+    def test_hits_to_columns_without_numpy(self):
+        columns = hits_to_columns(
+            self.hits,
+            ["price", "stock", "tags"],
+            dtypes={"price": "f8", "stock": "i8"},
+            use_numpy=False,
+        )
+        self.assertEqual(columns["price"].typecode, "d")
+        # Missing integers are filled with zeros.
+        self.assertEqual(list(columns["stock"]), [3, 0])
+        self.assertEqual(columns["tags"], [None, ["x"]])
+
+    def test_int32_columns_without_numpy(self):
+        columns = hits_to_columns(
+            self.hits, ["stock"], dtypes={"stock": "i4"}, use_numpy=False
+        )
+        self.assertEqual(columns["stock"].typecode, "i")
+        self.assertEqual(columns["stock"].itemsize, 4)
+
+    def test_columns_grow_geometrically(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        hits = [{"_source": {"stock": _i}} for _i in range(1000)]
+        with mock.patch.object(numpy, "empty", wraps=numpy.empty) as empty:
+            columns = hits_to_columns(
+                hits, ["stock"], dtypes={"stock": "i8"}, chunk_size=1
+            )
+        self.assertEqual(list(columns["stock"]), list(range(1000)))
+        # Initial buffer plus one per doubling.
+        self.assertEqual(empty.call_count, 11)
+
+    def test_buckets_to_columns(self):
+        buckets = [
+            {"key": "a", "doc_count": 3, "avg": {"value": 1.0}},
+            {"key": "b", "doc_count": 1, "avg": {"value": None}},
+        ]
+        columns = buckets_to_columns(
+            buckets,
+            ["key", "doc_count", "avg.value"],
+            dtypes={"doc_count": "i8", "avg.value": "f8"},
+            use_numpy=False,
+        )
+        self.assertEqual(columns["key"], ["a", "b"])
+        self.assertEqual(list(columns["doc_count"]), [3, 1])
+        self.assertEqual(columns["avg.value"][0], 1.0)
+        self.assertNotEqual(columns["avg.value"][1], columns["avg.value"][1])
+
+    def test_search_to_columns(self):
+        client = FakeSearchClient(
+            {str(_i).zfill(3): {"value": _i} for _i in range(25)}
+        )
+        search_dsl.connections.add_connection("columns", client)
+        self.addCleanup(search_dsl.connections.remove_connection, "columns")
+        columns = search_to_columns(
+            search_dsl.Search(using="columns", index="test"),
+            ["_id", "value"],
+            dtypes={"value": "i8"},
+            size=10,
+            use_numpy=False,
+        )
+        self.assertEqual(sorted(columns["value"]), list(range(25)))
+        self.assertEqual(len(columns["_id"]), 25)
+
+    def test_search_to_columns_without_index(self):
+        client = FakeSearchClient({"1": {"value": 1}}, index="_all")
+        search_dsl.connections.add_connection("columns", client)
+        self.addCleanup(search_dsl.connections.remove_connection, "columns")
+        columns = search_to_columns(
+            search_dsl.Search(using="columns"), ["value"], use_numpy=False
+        )
+        self.assertEqual(columns["value"], [1])
+
+    def test_columns_to_dataframe(self):
+        try:
+            import pandas  # noqa
+        except ImportError:
+            self.skipTest("pandas is not installed")
+        frame = columns_to_dataframe(
+            hits_to_columns(self.hits, ["_id", "price"], {"price": "f8"})
+        )
+        self.assertEqual(list(frame.columns), ["_id", "price"])
+        self.assertEqual(frame["price"].sum(), 12.5)
+
+
+class HitRecordTestCase(unittest.TestCase):
+    """Test HitRecord."""
+
+    hit = {
+        "_id": "1",
+        "_index": "books",
+        "_score": 2.0,
+        "highlight": {"title": ["<em>Dune</em>"]},
+        "_source": {
+            "title": "Dune",
+            "author": {"name": "Frank Herbert"},
+            "tags": ["sf"],
+            "pages": 412,
+        },
+    }
+
+    def test_projection_record(self):
+        record_class = hit_record_class(["title", "author.name", "tags"])
+        self.assertIs(
+            hit_record_class(["title", "author.name", "tags"]), record_class
+        )
+        record = record_class.from_hit(self.hit)
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertEqual(record.title, "Dune")
+        self.assertEqual(record.author.name, "Frank Herbert")
+        self.assertEqual(list(record.tags), ["sf"])
+        # Not projected, but still accessible.
+        self.assertEqual(record.pages, 412)
+        self.assertEqual(record["pages"], 412)
+        self.assertEqual(record.meta.id, "1")
+        self.assertEqual(record.meta.score, 2.0)
+        self.assertEqual(record.meta.highlight.title, ["<em>Dune</em>"])
+        self.assertEqual(record.to_dict(), self.hit["_source"])
+        with self.assertRaises(AttributeError):
+            record.missing
+        record = record_class.from_hit({"_id": "2", "_source": {}})
+        self.assertIsNone(record.title)
+
+    def test_item_access_is_limited_to_fields(self):
+        record_class = hit_record_class(["title", "meta", "to_dict"])
+        record = record_class.from_hit(
+            {"_id": "1", "_source": {"title": "Dune", "meta": {"a": 1}}}
+        )
+        self.assertEqual(record["title"], "Dune")
+        self.assertEqual(record["meta"], {"a": 1})
+        self.assertEqual(record.meta.id, "1")
+        for name in ("to_dict", "from_hit", "_extra", "__class__"):
+            with self.subTest(name=name), self.assertRaises(KeyError):
+                record[name]
+        with self.assertRaises(KeyError):
+            record_class.from_hit({"_source": {}})["title"]
+
+    def test_document_record(self):
+        class Book(search_dsl.Document):
+            title = search_dsl.Text()
+            pages = search_dsl.Integer()
+
+        record_class = hit_record_class(Book)
+        self.assertEqual(record_class.__name__, "BookRecord")
+        self.assertEqual(set(record_class._fields), {"title", "pages"})
+        record = record_class.from_hit(self.hit)
+        self.assertEqual(record.pages, 412)
+        self.assertEqual(record.author.name, "Frank Herbert")
+
+    def test_execute_records(self):
+        client = FakeSearchClient({"1": {"title": "a", "pages": 1}})
+        search_dsl.connections.add_connection("records", client)
+        self.addCleanup(search_dsl.connections.remove_connection, "records")
+        search = search_dsl.Search(using="records", index="test")
+        records = execute_records(search.source(["title"]))
+        self.assertEqual(type(records[0])._fields, {"title": "_f_title"})
+        self.assertEqual(records[0].title, "a")
+        self.assertEqual(records[0].meta.id, "1")
+        records = to_records(search.execute())
+        self.assertEqual(records[0].pages, 1)
+
+
+class LazyDocumentMixinTestCase(unittest.TestCase):
+    """Test LazyDocumentMixin."""
+
+    def setUp(self):
+        class Article(LazyDocumentMixin, search_dsl.Document):
+            title = search_dsl.Text()
+            published = search_dsl.Date()
+            author = search_dsl.Object(
+                properties={"name": search_dsl.Keyword()}
+            )
+
+            class Index:
+                name = "test"
+
+        self.client = FakeSearchClient(
+            {
+                "1": {
+                    "title": "Lazy",
+                    "published": "2024-01-02T03:04:05",
+                    "author": {"name": "Joe"},
+                }
+            }
+        )
+        search_dsl.connections.add_connection("lazy", self.client)
+        self.addCleanup(search_dsl.connections.remove_connection, "lazy")
+        self.article = Article.search(using="lazy").execute()[0]
+
+    def test_fields_are_deserialized_on_access(self):
+        article = self.article
+        self.assertEqual(article._lazy_fields_, {"published", "author"})
+        self.assertEqual(article._d_["published"], "2024-01-02T03:04:05")
+        self.assertEqual(article.published.year, 2024)
+        self.assertEqual(article._lazy_fields_, {"author"})
+        self.assertIs(article.published, article.published)
+        self.assertEqual(article["author"].name, "Joe")
+        self.assertEqual(article._lazy_fields_, set())
+
+    def test_serialization(self):
+        article = self.article
+        article.author = {"name": "Jane"}
+        self.assertEqual(
+            article.to_dict(),
+            {
+                "title": "Lazy",
+                "published": datetime.datetime(2024, 1, 2, 3, 4, 5),
+                "author": {"name": "Jane"},
+            },
+        )
+        self.assertFalse(article._lazy_fields_)
+
+
+class DateParsingTestCase(unittest.TestCase):
+    """Test the date parsing helpers."""
+
+    values = [
+        "2024-01-02",
+        "2024-01-02T03:04",
+        "2024-01-02T03:04:05",
+        "2024-01-02 03:04:05.123",
+        "2024-01-02T03:04:05.1234567Z",
+        "2024-01-02T03:04:05+00:00",
+        "2024-01-02T03:04:05-05:30",
+        "2024-01-02T03:04:05+0200",
+        "2024-01-02T03:04:05+02",
+        "Jan 2 2024 3:04",
+    ]
+
+    def test_parse_date_matches_dateutil(self):
+        from dateutil import parser
+
+        for value in self.values:
+            with self.subTest(value=value):
+                expected = parser.parse(value)
+                parsed = parse_date(value)
+                self.assertEqual(repr(parsed), repr(expected))
+                self.assertEqual(parsed.utcoffset(), expected.utcoffset())
+        with self.assertRaises(ValueError):
+            parse_date("2024-02-30")
+
+    def test_fast_date_field(self):
+        field = fast_date_field(cache_size=10)
+        self.assertIsInstance(field, search_dsl.Date)
+        self.assertEqual(field.to_dict(), {"type": "date"})
+        value = field.deserialize("2024-01-02T03:04:05Z")
+        self.assertEqual(value.utcoffset(), datetime.timedelta(0))
+        self.assertIs(field.deserialize("2024-01-02T03:04:05Z"), value)
+        self.assertEqual(field._parse.cache_info().hits, 1)
+        self.assertEqual(field.deserialize(0), search_dsl.Date().deserialize(0))
+        with self.assertRaises(search_dsl.ValidationException):
+            field.deserialize("not a date")
+
+    def test_datetime64_columns(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        hits = [
+            {"_source": {"at": "2024-01-02T03:04:05.123+01:00"}},
+            {"_source": {"at": 1704161045123}},
+            {"_source": {}},
+        ]
+        columns = hits_to_columns(hits, ["at"], {"at": "datetime64[ms]"})
+        expected = numpy.datetime64("2024-01-02T02:04:05.123")
+        self.assertEqual(columns["at"][0], expected)
+        self.assertEqual(columns["at"][1], expected)
+        self.assertTrue(numpy.isnat(columns["at"][2]))
+
+
+class PreparedSearchTestCase(unittest.TestCase):
+    """Test PreparedSearch."""
+
+    def setUp(self):
+        self.client = FakeSearchClient(
+            {str(_i).zfill(3): {"value": _i} for _i in range(25)}
+        )
+        search_dsl.connections.add_connection("prepared", self.client)
+        self.addCleanup(search_dsl.connections.remove_connection, "prepared")
+        self.search = (
+            search_dsl.Search(using="prepared", index="test")
+            .query("match", title=Param("title"))
+            .filter("range", created={"gte": Param("since")})
+            .extra(size=Param("size"))
+        )
+
+    def test_render(self):
+        prepared = PreparedSearch(self.search)
+        self.assertEqual(prepared.params, {"title", "since", "size"})
+        since = datetime.datetime(2024, 1, 2)
+        body = prepared.render(title='a "b"', since=since, size=5)
+        expected = self.search.to_dict()
+        expected["query"]["bool"]["must"][0]["match"]["title"] = 'a "b"'
+        expected["query"]["bool"]["filter"][0]["range"]["created"] = {
+            "gte": "2024-01-02T00:00:00"
+        }
+        expected["size"] = 5
+        self.assertEqual(json.loads(body), expected)
+        with self.assertRaises(ValueError):
+            prepared.render(title="a", size=5)
+        with self.assertRaises(ValueError):
+            prepared.render(title="a", since=since, size=5, other=1)
+
+    def test_execute(self):
+        prepared = PreparedSearch(
+            search_dsl.Search(using="prepared", index="test").extra(
+                size=Param("size")
+            )
+        )
+        response = prepared.execute(size=3)
+        self.assertEqual(
+            [_hit.meta.id for _hit in response], ["000", "001", "002"]
+        )
+        self.assertEqual(self.client.requests[-1][2], {"size": 3})
+
+
+class SearchTemplateTestCase(unittest.TestCase):
+    """Test SearchTemplate."""
+
+    def setUp(self):
+        self.client = FakeSearchClient(
+            {str(_i).zfill(3): {"value": _i} for _i in range(25)}
+        )
+        search_dsl.connections.add_connection("template", self.client)
+        self.addCleanup(search_dsl.connections.remove_connection, "template")
+        self.template = SearchTemplate(
+            search_dsl.Search(using="template", index="test").extra(
+                from_=Param("start"), size=Param("size")
+            ),
+            "values",
+        )
+
+    def test_template(self):
+        template = self.template
+        self.assertRegex(template.template_id, r"^values-[0-9a-f]{12}$")
+        self.assertIn('"from":{{#toJson}}start{{/toJson}}', template.source)
+        self.assertIn('"size":{{#toJson}}size{{/toJson}}', template.source)
+        other = SearchTemplate(
+            search_dsl.Search(using="template").extra(size=Param("size")),
+            "values",
+        )
+        self.assertNotEqual(other.template_id, template.template_id)
+
+    def test_execute_registers_template(self):
+        response = self.template.execute(start=2, size=3)
+        self.assertEqual(
+            [_hit.meta.id for _hit in response], ["002", "003", "004"]
+        )
+        self.assertEqual(
+            [_request[0] for _request in self.client.requests],
+            ["put_script", "search_template", "search"],
+        )
+        self.assertEqual(
+            self.client.requests[1][2],
+            {
+                "id": self.template.template_id,
+                "params": {"start": 2, "size": 3},
+            },
+        )
+        # Registered again when missing.
+        self.client.scripts.clear()
+        response = self.template.execute(start=0, size=1)
+        self.assertEqual(len(response.hits), 1)
+        self.assertEqual(len(self.client.scripts), 1)
+
+    def test_missing_index_is_not_retried(self):
+        self.template.register()
+        error = search.NotFoundError(404, "index_not_found_exception")
+        with mock.patch.object(
+            self.client, "search_template", side_effect=error
+        ) as search_template:
+            with self.assertRaises(search.NotFoundError):
+                self.template.execute(start=0, size=1)
+        search_template.assert_called_once()
+        self.assertEqual(
+            [_request[0] for _request in self.client.requests], ["put_script"]
+        )
+
+    def test_msearch(self):
+        self.template.register()
+        self.client.scripts.clear()
+        responses = self.template.msearch(
+            [{"start": 0, "size": 2}, {"start": 24, "size": 2}]
+        )
+        self.assertEqual(
+            [[_hit.meta.id for _hit in _response] for _response in responses],
+            [["000", "001"], ["024"]],
+        )
+        self.assertEqual(
+            [_request[0] for _request in self.client.requests].count(
+                "put_script"
+            ),
+            2,
+        )
+        self.assertEqual(self.template.msearch([]), [])
+
+    def test_msearch_string_error(self):
+        self.template.register()
+        with mock.patch.object(
+            self.client,
+            "msearch_template",
+            return_value={"responses": [{"error": "failure", "status": 500}]},
+        ):
+            (response,) = self.template.msearch([{"start": 0, "size": 1}])
+        self.assertIsInstance(response, search.TransportError)
+        self.assertEqual(response.error, "failure")
+
+
+class FakeAsyncSearchClient(object):
+    """Async stand-in wrapping a `FakeSearchClient`.
+
+    Like the API methods of `AsyncElasticsearch`/`AsyncOpenSearch`, `msearch`
+    and `mget` are regular functions returning coroutines.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.transport = mock.Mock()
+        self.transport.perform_request = self._perform_request
+        self.threads = []
+
+    async def _perform_request(self, method, url, **kwargs):
+        return {}
+
+    async def _call(self, name, kwargs):
+        return getattr(self.client, name)(**kwargs)
+
+    def msearch(self, **kwargs):
+        self.threads.append(threading.current_thread())
+        return self._call("msearch", kwargs)
+
+    def mget(self, **kwargs):
+        self.threads.append(threading.current_thread())
+        return self._call("mget", kwargs)
+
+
+class SearchBatchTestCase(unittest.TestCase):
+    """Test SearchBatch and AsyncSearchBatch."""
+
+    def setUp(self):
+        self.client = FakeSearchClient(
+            {str(_i).zfill(3): {"value": _i} for _i in range(25)}
+        )
+        search_dsl.connections.add_connection("batch", self.client)
+        self.addCleanup(search_dsl.connections.remove_connection, "batch")
+        self.search = search_dsl.Search(using="batch", index="test")
+
+    def _request_types(self):
+        return [_request[0] for _request in self.client.requests]
+
+    def test_batch(self):
+        with SearchBatch() as batch:
+            first = batch.add(self.search.extra(size=1))
+            second = batch.add(self.search.extra(from_=5, size=2))
+            missing = batch.add(self.search.index("missing"))
+            # Not collected without `collect=True`.
+            self.assertEqual(len(self.search.extra(size=3).execute()), 3)
+            self.client.requests = []
+            self.assertEqual(self.client.requests, [])
+            self.assertEqual(first[0].meta.id, "000")
+        self.assertEqual([_hit.meta.id for _hit in second], ["005", "006"])
+        self.assertEqual(len(second.hits), 2)
+        with self.assertRaises(search.TransportError):
+            missing.hits
+        self.assertEqual(self._request_types(), ["msearch", "search", "search"])
+
+    def test_batch_collects_execute(self):
+        execute = search_dsl.Search.execute
+        with SearchBatch(collect=True):
+            first = self.search.extra(size=1).execute()
+            second = self.search.extra(from_=5, size=2).execute()
+            uncached = self.search.extra(size=1).execute(ignore_cache=True)
+            self.assertEqual(self._request_types(), ["search"])
+            self.assertEqual(first[0].meta.id, "000")
+        self.assertEqual([_hit.meta.id for _hit in second], ["005", "006"])
+        self.assertEqual(len(uncached), 1)
+        self.assertEqual(
+            self._request_types(), ["search", "msearch", "search", "search"]
+        )
+        # Outside of the context (and in other threads) searches run as
+        # usual.
+        self.assertEqual(len(self.search.extra(size=3).execute()), 3)
+        with SearchBatch(collect=True), ThreadPoolExecutor(1) as executor:
+            with SearchBatch(collect=True) as inner:
+                self.assertIs(self.search.execute()._batch, inner)
+            response = executor.submit(self.search.execute).result()
+            self.assertNotIsInstance(response, BatchedResponse)
+            self.assertIsInstance(
+                self.search.extra(size=1).execute(), BatchedResponse
+            )
+        self.assertEqual(self._request_types().count("msearch"), 3)
+        # The original is restored once no batch collects.
+        self.assertIs(search_dsl.Search.execute, execute)
+
+    def test_batch_connection_error(self):
+        with SearchBatch() as batch:
+            unknown = batch.add(self.search.using("unknown"))
+            known = batch.add(self.search.extra(size=1))
+        with self.assertRaises(KeyError):
+            unknown.hits
+        with self.assertRaises(KeyError):
+            len(unknown)
+        self.assertEqual(len(known), 1)
+
+    def test_batch_not_sent_on_error(self):
+        execute = search_dsl.Search.execute
+        with self.assertRaises(ZeroDivisionError):
+            with SearchBatch(collect=True) as batch:
+                pending = batch.add(self.search)
+                collected = self.search.execute()
+                1 / 0
+        self.assertEqual(self.client.requests, [])
+        for response in (pending, collected):
+            with self.assertRaises(RuntimeError):
+                response.hits
+        self.assertIs(search_dsl.Search.execute, execute)
+
+    def test_batch_max_size(self):
+        batch = SearchBatch(max_size=2)
+        responses = [batch.add(self.search) for _ in range(3)]
+        self.assertEqual(self._request_types().count("msearch"), 1)
+        self.assertEqual(len(responses[2]), 10)
+        self.assertEqual(self._request_types().count("msearch"), 2)
+
+    def test_async_batch(self):
+        batch = AsyncSearchBatch()
+
+        async def _run():
+            return await asyncio.gather(
+                batch.execute(self.search.extra(size=1)),
+                batch.execute(self.search.extra(from_=24)),
+                batch.execute(self.search.index("missing")),
+                return_exceptions=True,
+            )
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        first, second, missing = loop.run_until_complete(_run())
+        self.assertEqual([_hit.meta.id for _hit in first], ["000"])
+        self.assertEqual([_hit.meta.id for _hit in second], ["024"])
+        self.assertIsInstance(missing, search.TransportError)
+        self.assertEqual(self._request_types().count("msearch"), 1)
+
+    def test_async_batch_with_async_client(self):
+        client = FakeAsyncSearchClient(self.client)
+        batch = AsyncSearchBatch(client=client)
+
+        async def _run():
+            return await asyncio.gather(
+                batch.execute(self.search.extra(size=1)),
+                batch.execute(self.search.index("missing")),
+                return_exceptions=True,
+            )
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        first, missing = loop.run_until_complete(_run())
+        self.assertEqual([_hit.meta.id for _hit in first], ["000"])
+        self.assertIsInstance(missing, search.TransportError)
+        self.assertEqual(client.threads, [threading.current_thread()])
+
+    def test_async_batch_per_connection(self):
+        other = FakeSearchClient({"x": {"value": 1}})
+        search_dsl.connections.add_connection("other", other)
+        self.addCleanup(search_dsl.connections.remove_connection, "other")
+        batch = AsyncSearchBatch()
+
+        async def _run():
+            return await asyncio.gather(
+                batch.execute(self.search.extra(size=1)),
+                batch.execute(self.search.using("other")),
+                batch.execute(self.search.using("unknown")),
+                return_exceptions=True,
+            )
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        first, second, unknown = loop.run_until_complete(_run())
+        self.assertEqual([_hit.meta.id for _hit in first], ["000"])
+        self.assertEqual([_hit.meta.id for _hit in second], ["x"])
+        self.assertIsInstance(unknown, KeyError)
+        self.assertEqual(self._request_types().count("msearch"), 1)
+        self.assertEqual([_r[0] for _r in other.requests].count("msearch"), 1)
+
+
+class DocumentLoaderTestCase(unittest.TestCase):
+    """Test DocumentLoader and AsyncDocumentLoader."""
+
+    def setUp(self):
+        class Item(search_dsl.Document):
+            value = search_dsl.Integer()
+
+            class Index:
+                name = "test"
+
+        self.Item = Item
+        self.client = FakeSearchClient(
+            {str(_i): {"value": _i} for _i in range(10)}
+        )
+        search_dsl.connections.add_connection("loader", self.client)
+        self.addCleanup(search_dsl.connections.remove_connection, "loader")
+
+    def _mgets(self):
+        return [_r for _r in self.client.requests if _r[0] == "mget"]
+
+    def test_loader(self):
+        loader = DocumentLoader(using="loader")
+        futures = [loader.load(self.Item, _id) for _id in (3, "1", 3, 42)]
+        self.assertIs(futures[0], futures[2])
+        self.assertEqual(self.client.requests, [])
+        item = futures[0].result()
+        self.assertEqual(item.value, 3)
+        self.assertIsNone(futures[3].result())
+        self.assertEqual(
+            self._mgets(), [("mget", "test", {"ids": ["3", "1", "42"]})]
+        )
+        self.assertIs(loader.get(self.Item, "3"), item)
+        self.assertEqual(
+            [_item.value for _item in loader.load_many(self.Item, [1, 2])],
+            [1, 2],
+        )
+        self.assertEqual(len(self._mgets()), 2)
+        self.assertEqual(self._mgets()[1][2], {"ids": ["2"]})
+
+    def test_threaded_loader(self):
+        loader = DocumentLoader(using="loader", window=0.05)
+        with ThreadPoolExecutor(4) as executor:
+            items = list(
+                executor.map(lambda _id: loader.get(self.Item, _id), range(4))
+            )
+        self.assertEqual([_item.value for _item in items], [0, 1, 2, 3])
+        self.assertEqual(len(self._mgets()), 1)
+
+    def _fail_once(self):
+        mget = self.client.mget
+        errors = [search.ConnectionError("N/A", "down", None)]
+
+        def _mget(**kwargs):
+            if errors:
+                raise errors.pop()
+            return mget(**kwargs)
+
+        patcher = mock.patch.object(self.client, "mget", side_effect=_mget)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_ids_are_evicted(self):
+        self._fail_once()
+        loader = DocumentLoader(using="loader")
+        future = loader.load(self.Item, 1)
+        with self.assertRaises(search.ConnectionError):
+            future.result()
+        self.assertIsNot(loader.load(self.Item, 1), future)
+        self.assertEqual(loader.get(self.Item, 1).value, 1)
+
+    def test_prime(self):
+        loader = DocumentLoader(using="loader")
+        item = self.Item(meta={"id": 7}, value=70)
+        loader.prime(item)
+        self.assertIs(loader.get(self.Item, "7"), item)
+        self.assertEqual(self._mgets(), [])
+
+    def test_async_loader(self):
+        loader = AsyncDocumentLoader(using="loader", max_batch_size=2)
+
+        async def _run():
+            first = await asyncio.gather(
+                loader.get(self.Item, 1),
+                loader.get(self.Item, 1),
+                loader.get(self.Item, 2),
+                loader.get(self.Item, 3),
+                loader.get(self.Item, 42),
+            )
+            return first, await loader.get_many(self.Item, [2, 1])
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        first, second = loop.run_until_complete(_run())
+        self.assertIs(first[0], first[1])
+        self.assertEqual([_item.value for _item in first[:4]], [1, 1, 2, 3])
+        self.assertIsNone(first[4])
+        self.assertEqual(second, [first[2], first[0]])
+        self.assertEqual(
+            [_r[2]["ids"] for _r in self._mgets()], [["1", "2"], ["3", "42"]]
+        )
+
+    def test_async_failed_ids_are_evicted(self):
+        self._fail_once()
+        loader = AsyncDocumentLoader(using="loader")
+
+        async def _run():
+            with self.assertRaises(search.ConnectionError):
+                await loader.get(self.Item, 1)
+            return await loader.get(self.Item, 1)
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(loop.run_until_complete(_run()).value, 1)
+        self.assertEqual(len(self.client.mget.call_args_list), 2)
+
+    def test_async_loader_with_async_client(self):
+        client = FakeAsyncSearchClient(self.client)
+        loader = AsyncDocumentLoader(client=client, using="loader")
+
+        async def _run():
+            return await loader.get_many(self.Item, [1, 42])
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        item, missing = loop.run_until_complete(_run())
+        self.assertEqual(item.value, 1)
+        self.assertIsNone(missing)
+        self.assertEqual(client.threads, [threading.current_thread()])
+
+    def test_async_loader_close(self):
+        async def _run():
+            async with AsyncDocumentLoader(using="loader") as loader:
+                future = asyncio.ensure_future(loader.get(self.Item, 1))
+                await asyncio.sleep(0)
+                loader._dispatch()
+                self.assertEqual(len(loader._tasks), 1)
+            self.assertEqual(loader._tasks, set())
+            return await future
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(loop.run_until_complete(_run()).value, 1)
+
+
+class DocumentSessionTestCase(unittest.TestCase):
+    """Test DocumentSession."""
+
+    def setUp(self):
+        class Item(search_dsl.Document):
+            value = search_dsl.Integer()
+            name = search_dsl.Keyword()
+
+            class Index:
+                name = "test"
+
+        self.Item = Item
+        self.client = FakeSearchClient({"1": {"value": 1}, "2": {"value": 2}})
+        search_dsl.connections.add_connection("session", self.client)
+        self.addCleanup(search_dsl.connections.remove_connection, "session")
+
+    def _bulks(self):
+        return [_r for _r in self.client.requests if _r[0] == "bulk"]
+
+    def test_commit(self):
+        first = self.Item(value=10, meta={"id": "1"})
+        second = self.Item(value=2, meta={"id": "2"})
+        new = self.Item(value=3)
+        with DocumentSession(using="session", refresh="wait_for") as session:
+            session.save(first)
+            first.value = 11
+            session.save(first)
+            session.update(first, name="first")
+            session.update(second, name="second")
+            session.update(second, value=20)
+            session.save(new)
+            self.assertEqual(len(session), 3)
+            self.assertEqual(self.client.requests, [])
+        ((_, kwargs, body),) = self._bulks()
+        self.assertEqual(kwargs, {"refresh": "wait_for"})
+        self.assertEqual(len(body), 6)
+        documents = self.client.documents["test"]
+        self.assertEqual(documents["1"], {"value": 11, "name": "first"})
+        self.assertEqual(documents["2"], {"value": 20, "name": "second"})
+        self.assertEqual(documents[new.meta.id], {"value": 3})
+        self.assertEqual(first.meta.version, 1)
+        self.assertTrue(new.meta.id.startswith("auto-"))
+
+    def test_delete_and_max_actions(self):
+        session = DocumentSession(using="session", max_actions=2)
+        first = self.Item(value=1, meta={"id": "1"})
+        session.save(first)
+        session.delete(first)
+        self.assertEqual(len(session), 1)
+        session.delete(self.Item(meta={"id": "2"}))
+        self.assertEqual(len(self._bulks()), 1)
+        self.assertEqual(self.client.documents["test"], {})
+
+    def test_update_after_delete(self):
+        from anysearch.search import helpers
+
+        session = DocumentSession(using="session")
+        item = self.Item(meta={"id": "1"})
+        session.delete(item)
+        session.update(item, value=5)
+        ((_, _, body),) = self._bulks()
+        self.assertEqual(
+            [json.loads(_line) for _line in body],
+            [{"delete": {"_id": "1", "_index": "test"}}],
+        )
+        self.assertEqual(len(session), 1)
+        with self.assertRaises(helpers.BulkIndexError):
+            session.commit()
+        self.assertNotIn("1", self.client.documents["test"])
+
+    def test_connections(self):
+        other = FakeSearchClient(index="other")
+        search_dsl.connections.add_connection("other", other)
+        self.addCleanup(search_dsl.connections.remove_connection, "other")
+
+        class SessionItem(search_dsl.Document):
+            value = search_dsl.Integer()
+
+            class Index:
+                name = "test"
+                using = "session"
+
+        class OtherItem(SessionItem):
+            class Index:
+                name = "other"
+                using = "other"
+
+        with DocumentSession() as session:
+            session.save(SessionItem(value=1, meta={"id": "3"}))
+            session.save(OtherItem(value=2, meta={"id": "1"}))
+        self.assertEqual(self.client.documents["test"]["3"], {"value": 1})
+        self.assertEqual(other.documents["other"], {"1": {"value": 2}})
+        self.assertNotIn("other", self.client.documents)
+
+    def test_errors_and_rollback(self):
+        from anysearch.search import helpers
+
+        missing = self.Item(meta={"id": "missing"})
+        with self.assertRaises(helpers.BulkIndexError):
+            with DocumentSession(using="session") as session:
+                session.update(missing, value=1)
+        self.assertEqual(session.errors, [])
+        with self.assertRaises(RuntimeError):
+            with DocumentSession(using="session") as session:
+                session.delete(self.Item(meta={"id": "1"}))
+                raise RuntimeError
+        self.assertEqual(
+            json.loads(self._bulks()[-1][2][0]),
+            {"update": {"_id": "missing", "_index": "test"}},
+        )
+        self.assertIn("1", self.client.documents["test"])
+
+    def test_invalid_document_keeps_operations(self):
+        class NamedItem(search_dsl.Document):
+            value = search_dsl.Integer()
+            name = search_dsl.Keyword(required=True)
+
+            class Index:
+                name = "test"
+
+        session = DocumentSession(using="session")
+        session.save(self.Item(value=1, meta={"id": "1"}))
+        invalid = NamedItem(value=2, meta={"id": "2"})
+        session.save(invalid)
+        session.delete(self.Item(meta={"id": "3"}))
+        with self.assertRaises(search_dsl.ValidationException):
+            session.flush()
+        self.assertEqual(self._bulks(), [])
+        self.assertEqual(len(session), 3)
+        invalid.name = "second"
+        session.flush()
+        self.assertEqual(len(session), 0)
+        self.assertEqual(
+            self.client.documents["test"]["2"], {"value": 2, "name": "second"}
+        )
+
+    def test_unavailable_cluster_keeps_operations(self):
+        session = DocumentSession(using="session", max_retries=0)
+        session.save(self.Item(value=1, meta={"id": "1"}))
+        session.delete(self.Item(meta={"id": "2"}))
+        with mock.patch.object(
+            self.client,
+            "bulk",
+            side_effect=search.ConnectionError("N/A", "down", None),
+        ):
+            with self.assertRaises(search.ConnectionError):
+                session.flush()
+        self.assertEqual(len(session), 2)
+        session.flush()
+        self.assertEqual(len(session), 0)
+        self.assertNotIn("2", self.client.documents["test"])
+
+
+class BootstrapIndicesTestCase(unittest.TestCase):
+    """Test bootstrap_indices."""
+
+    def setUp(self):
+        class Article(search_dsl.Document):
+            title = search_dsl.Text(copy_to="all", norms=False)
+            author = search_dsl.Nested(
+                properties={"name": search_dsl.Keyword()}
+            )
+            source = search_dsl.Object(properties={"url": search_dsl.Keyword()})
+
+            class Index:
+                name = "articles"
+                settings = {"number_of_replicas": 1, "refresh_interval": "5s"}
+
+            class Meta:
+                dynamic = search_dsl.MetaField(False)
+
+        class Comment(search_dsl.Document):
+            body = search_dsl.Text()
+
+            class Index:
+                name = "comments"
+
+        self.documents = [Article, Comment]
+        self.connection = mock.Mock()
+        self.connection.indices.get.return_value = {
+            "articles": {
+                "aliases": {},
+                "mappings": {
+                    # As normalized by the cluster.
+                    "dynamic": "false",
+                    "properties": {
+                        "title": {
+                            "type": "text",
+                            "copy_to": ["all"],
+                            "norms": False,
+                        },
+                        "author": {
+                            "type": "nested",
+                            "properties": {"name": {"type": "text"}},
+                        },
+                        "source": {"properties": {"url": {"type": "keyword"}}},
+                    },
+                },
+                "settings": {
+                    "index.number_of_replicas": "1",
+                    "index.refresh_interval": "1s",
+                },
+            }
+        }
+        search_dsl.connections.add_connection("bootstrap", self.connection)
+        self.addCleanup(search_dsl.connections.remove_connection, "bootstrap")
+
+    def test_bootstrap(self):
+        result = bootstrap_indices(self.documents, using="bootstrap")
+        self.assertEqual(
+            dict(result), {"articles": "updated", "comments": "created"}
+        )
+        indices = self.connection.indices
+        indices.get.assert_called_once_with(
+            index="articles,comments",
+            ignore_unavailable=True,
+            flat_settings=True,
+        )
+        indices.put_settings.assert_called_once_with(
+            index="articles", body={"index.refresh_interval": "5s"}
+        )
+        indices.put_mapping.assert_called_once_with(
+            index="articles",
+            body={
+                "properties": {
+                    "author": {
+                        "type": "nested",
+                        "properties": {"name": {"type": "keyword"}},
+                    }
+                }
+            },
+        )
+        indices.create.assert_called_once_with(
+            index="comments",
+            body={"mappings": {"properties": {"body": {"type": "text"}}}},
+        )
+
+    def test_fingerprint_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = os.path.join(directory, "cache.json")
+            bootstrap_indices(
+                self.documents, using="bootstrap", cache_path=cache_path
+            )
+            self.connection.reset_mock()
+            result = bootstrap_indices(
+                self.documents, using="bootstrap", cache_path=cache_path
+            )
+            self.assertEqual(set(result.values()), {"cached"})
+            self.assertEqual(self.connection.mock_calls, [])
+            bootstrap_indices(
+                self.documents[:1],
+                using="bootstrap",
+                cache_path=cache_path,
+                force=True,
+            )
+            self.connection.indices.get.assert_called_once()
+
+    def test_analysis_change(self):
+        index = search_dsl.Index("articles")
+        index.settings(analysis={"analyzer": {"a": {"tokenizer": "keyword"}}})
+        with self.assertRaises(search_dsl.IllegalOperation):
+            bootstrap_indices([index], using="bootstrap")
+
+
+class AnalyzeSearchTestCase(unittest.TestCase):
+    """Test analyze_search and guard_search."""
+
+    def setUp(self):
+        class Post(search_dsl.Document):
+            title = search_dsl.Text(fields={"raw": search_dsl.Keyword()})
+            body = search_dsl.Text()
+            tag = search_dsl.Keyword()
+
+        self.search = Post.search()
+
+    def _codes(self, request, **kwargs):
+        return [
+            (_issue.severity, _issue.code, _issue.path)
+            for _issue in analyze_search(request, **kwargs)
+        ]
+
+    def test_queries(self):
+        request = (
+            self.search.query("wildcard", tag="*foo")
+            .query("regexp", body={"value": ".*bar"})
+            .query("wildcard", tag="foo*")
+            .filter("script", script={"source": "doc['x'].value > 1"})
+            .filter("terms", tag=[str(_i) for _i in range(2000)])
+            .sort("title", "-tag")
+            .extra(from_=5000)
+        )
+        self.assertEqual(
+            self._codes(request),
+            [
+                ("error", "leading_wildcard", "query.bool.must.0.wildcard"),
+                ("error", "leading_wildcard", "query.bool.must.1.regexp"),
+                ("error", "sort_on_text", "sort.0"),
+                ("warning", "script_query", "query.bool.filter.0.script"),
+                ("warning", "large_terms", "query.bool.filter.1.terms"),
+                ("warning", "deep_pagination", "from"),
+            ],
+        )
+        issue = analyze_search(request)[2]
+        self.assertIn("'title.raw'", issue.suggestion)
+        self.assertEqual(
+            analyze_search(self.search.query("match", body="x")), []
+        )
+
+    def test_aggregations(self):
+        request = self.search
+        request.aggs.bucket("tags", "terms", field="tag").bucket(
+            "titles", "terms", field="title", size=2000
+        ).bucket("days", "date_histogram", field="day", interval="day")
+        self.assertEqual(
+            self._codes(request),
+            [
+                ("error", "agg_on_text", "aggs.tags.aggs.titles"),
+                ("warning", "bucket_explosion", "aggs.tags.aggs.titles"),
+                (
+                    "warning",
+                    "bucket_explosion",
+                    "aggs.tags.aggs.titles.aggs.days",
+                ),
+                ("info", "terms_agg_without_size", "aggs.tags"),
+            ],
+        )
+        self.assertEqual(
+            self._codes({"aggs": {"t": {"terms": {"field": "x", "size": 10}}}}),
+            [],
+        )
+
+    def test_guard(self):
+        request = self.search.query("wildcard", tag="*foo")
+        with self.assertWarns(QueryCostWarning):
+            self.assertIs(guard_search(request), request)
+        with self.assertRaises(ExpensiveQueryError) as context:
+            guard_search(request, mode="raise")
+        self.assertEqual(context.exception.issues[0].code, "leading_wildcard")
+        self.assertIs(guard_search(self.search, mode="raise"), self.search)
+
+
+class ReadProfileTestCase(unittest.TestCase):
+    """Test ReadProfile and ReadProfileMixin."""
+
+    def setUp(self):
+        class Page(ReadProfileMixin, search_dsl.Document):
+            title = search_dsl.Text()
+            html = search_dsl.Text()
+            published = search_dsl.Date()
+            tags = search_dsl.Keyword(multi=True)
+
+            read_profiles = {
+                "list": ReadProfile(
+                    includes=["title"], docvalue_fields=["published", "tags"]
+                ),
+                "lean": ReadProfile(excludes=["html"]),
+            }
+
+            class Index:
+                name = "test"
+
+        self.Page = Page
+        self.client = FakeSearchClient(
+            {
+                "1": {
+                    "title": "One",
+                    "html": "<p>One</p>",
+                    "published": "2024-01-02T00:00:00",
+                    "tags": "a",
+                }
+            }
+        )
+        search_dsl.connections.add_connection("profiles", self.client)
+        self.addCleanup(search_dsl.connections.remove_connection, "profiles")
+
+    def test_profile_search(self):
+        request = self.Page.profile_search("list", using="profiles")
+        body = request.to_dict()
+        self.assertEqual(body["_source"], {"includes": ["title"]})
+        self.assertEqual(body["docvalue_fields"], ["published", "tags"])
+        page = request.execute()[0]
+        self.assertIsInstance(page, self.Page)
+        self.assertIs(type(page), self.Page.profile_class("list"))
+        self.assertNotIn(type(page), self.Page._index._doc_types)
+        self.assertEqual(page.title, "One")
+        self.assertEqual(page.published, datetime.datetime(2024, 1, 2))
+        self.assertEqual(list(page.tags), ["a"])
+        with self.assertRaises(AttributeError):
+            page.html
+        with self.assertRaises(ValueError):
+            page.save()
+        with self.assertRaises(ValueError):
+            page.update(refresh=True)
+
+    def test_excludes(self):
+        request = self.Page.profile_search("lean", using="profiles")
+        self.assertEqual(request.to_dict()["_source"], {"excludes": ["html"]})
+        page = request.execute()[0]
+        self.assertEqual(page.tags, "a")
+        with self.assertRaises(AttributeError):
+            page.html
+        with self.assertRaises(KeyError):
+            self.Page.profile_search("missing")
+        # Documents read without a profile are complete.
+        self.assertEqual(self.Page().html, None)
+
+    def test_patterns(self):
+        self.Page.read_profiles = dict(
+            self.Page.read_profiles,
+            wildcard=ReadProfile(includes=["ti*", "pub*"], excludes=["*ml"]),
+        )
+        request = self.Page.profile_search("wildcard", using="profiles")
+        page = request.execute()[0]
+        self.assertEqual(page.title, "One")
+        with self.assertRaises(AttributeError):
+            page.html
+        with self.assertRaises(AttributeError):
+            page.tags
+        profile = ReadProfile(includes=["author.name"], excludes=["html"])
+        self.assertTrue(profile.loads("author"))
+        self.assertFalse(profile.loads("authors"))
+        self.assertFalse(profile.loads("html"))
+
+
+class KnnSearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeSearchClient(
+            {"a": {"v": [0, 0]}, "b": {"v": [1, 0]}, "c": {"v": [3, 4]}},
+            index="vectors",
+        )
+
+    def test_knn_search(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        result = knn_search(
+            self.client,
+            "vectors",
+            "v",
+            numpy.array([[0, 0], [3, 3.5]]),
+            k=2,
+            batch_size=1,
+        )
+        self.assertEqual(result.ids.tolist(), [["a", "b"], ["c", "b"]])
+        numpy.testing.assert_allclose(
+            result.distances, [[0, 1], [0.5, 16.25**0.5]], rtol=1e-6
+        )
+        msearches = [_r for _r in self.client.requests if _r[0] == "msearch"]
+        self.assertEqual(len(msearches), 2)
+        header, body = map(json.loads, msearches[1][2].splitlines())
+        self.assertEqual(header, {"index": "vectors"})
+        if detect_search_backend() == OPENSEARCH:
+            self.assertEqual(
+                body["query"], {"knn": {"v": {"k": 2, "vector": [3.0, 3.5]}}}
+            )
+        else:
+            self.assertEqual(body["knn"]["query_vector"], [3.0, 3.5])
+            self.assertEqual(body["knn"]["num_candidates"], 3)
+        self.assertIs(body["_source"], False)
+
+    def test_missing_hits_and_errors(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        result = knn_search(self.client, "vectors", "v", [1, 0], k=4)
+        self.assertEqual(result.ids.tolist(), [["b", "a", "c", None]])
+        self.assertTrue(numpy.isnan(result.scores[0, 3]))
+        with self.assertRaises(search.TransportError):
+            knn_search(self.client, "missing", "v", [[1, 0]])
+        with self.assertRaises(ValueError):
+            knn_search(self.client, "vectors", "v", [[numpy.nan, 0]])
+        with self.assertRaises(ValueError):
+            knn_search(self.client, "vectors", "v", [[1, 0]], space="hamming")
+
+    def test_score_distances(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        client = mock.Mock()
+        client.msearch.return_value = {
+            "responses": [
+                {
+                    "hits": {
+                        "hits": [
+                            {"_id": "x", "_score": 2.0},
+                            {"_id": "y", "_score": 0.5},
+                        ]
+                    }
+                }
+            ]
+        }
+        for backend, space, distances in [
+            (ELASTICSEARCH, "cosine", [-2.0, 1.0]),
+            (ELASTICSEARCH, "dot_product", [-3.0, 0.0]),
+            (ELASTICSEARCH, "inner_product", [-1.0, 1.0]),
+            (OPENSEARCH, "cosine", [0.0, 1.5]),
+            (OPENSEARCH, "dot_product", [-1.0, 1.0]),
+            (OPENSEARCH, "l1", [-0.5, 1.0]),
+        ]:
+            with self.subTest(backend=backend, space=space), mock.patch(
+                "anysearch._client_backend", return_value=backend
+            ):
+                result = knn_search(client, "i", "v", [1], k=2, space=space)
+                numpy.testing.assert_allclose(result.distances[0], distances)
+
+    def test_vector_field(self):
+        field = vector_field(3, space="cosine")
+        if detect_search_backend() == OPENSEARCH:
+            self.assertEqual(
+                field.to_dict(),
+                {
+                    "type": "knn_vector",
+                    "dimension": 3,
+                    "method": {"name": "hnsw", "space_type": "cosinesimil"},
+                },
+            )
+        else:
+            self.assertEqual(
+                field.to_dict(),
+                {
+                    "type": "dense_vector",
+                    "dims": 3,
+                    "index": True,
+                    "similarity": "cosine",
+                },
+            )
+
+
+class VectorActionsTestCase(unittest.TestCase):
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        self.vectors = numpy.array([[0.5, 0.1], [1, -2]], dtype=numpy.float64)
+
+    def test_vector_actions(self):
+        import numpy
+
+        actions = list(
+            vector_actions(
+                "vectors",
+                "v",
+                self.vectors,
+                ids=["a", "b"],
+                metadata=[{"at": datetime.date(2024, 1, 2)}, None],
+                chunk_size=1,
+            )
+        )
+        self.assertEqual([_a["_id"] for _a in actions], ["a", "b"])
+        self.assertEqual(
+            json.loads(actions[0]["_source"]),
+            {"v": [0.5, 0.100000001], "at": "2024-01-02"},
+        )
+        # Nine significant digits round-trip float32 values.
+        vectors = numpy.frombuffer(os.urandom(4000), numpy.float32)
+        vectors = vectors[numpy.isfinite(vectors)].reshape(1, -1)
+        (action,) = vector_actions("vectors", "v", vectors)
+        self.assertEqual(
+            numpy.array(json.loads(action["_source"])["v"], numpy.float32)
+            .view(numpy.uint32)
+            .tolist(),
+            vectors.view(numpy.uint32)[0].tolist(),
+        )
+        self.assertEqual(actions[1]["_source"], '{"v":[1e0,-2e0]}')
+        (action,) = vector_actions("vectors", "v", [[1, 2]], op_type="create")
+        self.assertNotIn("_id", action)
+        self.assertEqual(action["_op_type"], "create")
+        self.assertEqual(action["_source"], '{"v":[1,2]}')
+        with self.assertRaises(ValueError):
+            list(vector_actions("vectors", "v", [[float("nan"), 0]]))
+
+    def test_base64(self):
+        import numpy
+
+        actions = vector_actions(
+            "vectors", "v", self.vectors, encoding="base64"
+        )
+        if detect_search_backend() == OPENSEARCH:
+            with self.assertRaises(ValueError):
+                list(actions)
+            return
+        encoded = json.loads(next(actions)["_source"])["v"]
+        self.assertEqual(
+            numpy.frombuffer(base64.b64decode(encoded), ">f4").tolist(),
+            self.vectors[0].astype(numpy.float32).tolist(),
+        )
+
+    def test_bulk_vectors(self):
+        client = FakeSearchClient(index="vectors")
+        results = list(
+            bulk_vectors(client, "vectors", "v", self.vectors, ids=["a", "b"])
+        )
+        self.assertEqual([_ok for _ok, _ in results], [True, True])
+        self.assertEqual(client.documents["vectors"]["b"], {"v": [1.0, -2.0]})
+
+
+class ByQueryTaskTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock()
+        self.statuses = [
+            {
+                "completed": False,
+                "task": {
+                    "running_time_in_nanos": 2 * 10**9,
+                    "status": {
+                        "total": 100,
+                        "updated": 30,
+                        "version_conflicts": 10,
+                        "slices": [{"slice_id": 0, "updated": 30}, None],
+                    },
+                },
+            },
+            {
+                "completed": True,
+                "task": {"running_time_in_nanos": 4 * 10**9, "status": {}},
+                "response": {"total": 100, "updated": 90, "failures": []},
+            },
+        ]
+
+        def perform_request(method, url, params=None, body=None):
+            if url.endswith("_by_query"):
+                return {"task": "node:1"}
+            if method == "GET":
+                return self.statuses.pop(0)
+            return {}
+
+        self.client.transport.perform_request.side_effect = perform_request
+        search_dsl.connections.add_connection("tasks", self.client)
+        self.addCleanup(search_dsl.connections.remove_connection, "tasks")
+
+    def test_update(self):
+        progress = []
+        task = ByQueryTask.update(
+            search_dsl.UpdateByQuery(using="tasks", index="orders")
+            .filter("term", status="pending")
+            .script(source="ctx._source.status = 'expired'"),
+            requests_per_second=50,
+            initial_poll_interval=0,
+            progress_callback=progress.append,
+        )
+        final = task.run()
+        call = self.client.transport.perform_request.call_args_list[0]
+        (method, url), kwargs = call
+        self.assertEqual((method, url), ("POST", "/orders/_update_by_query"))
+        self.assertEqual(
+            kwargs["params"],
+            {
+                "slices": "auto",
+                "conflicts": "proceed",
+                "wait_for_completion": "false",
+                "requests_per_second": 50,
+            },
+        )
+        self.assertIn("script", kwargs["body"])
+        self.assertEqual(task.task_id, "node:1")
+        self.assertEqual(len(progress), 2)
+        self.assertEqual(progress[0].done, 40)
+        self.assertEqual(progress[0].rate, 20.0)
+        self.assertEqual(progress[0].eta, 3.0)
+        self.assertEqual(len(progress[0].slices), 1)
+        self.assertTrue(final.completed)
+        self.assertEqual(final.updated, 90)
+
+        task.rethrottle(None)
+        self.client.transport.perform_request.assert_called_with(
+            "POST",
+            "/_update_by_query/node:1/_rethrottle",
+            params={"requests_per_second": -1},
+            body=None,
+        )
+
+    def test_delete_timeout(self):
+        task = ByQueryTask.delete(
+            search_dsl.Search(using="tasks", index="orders").filter(
+                "term", status="expired"
+            ),
+            slices=4,
+            initial_poll_interval=1,
+        )
+        with self.assertRaises(TimeoutError):
+            task.run(timeout=0)
+        calls = self.client.transport.perform_request.call_args_list
+        self.assertEqual(calls[0][0], ("POST", "/orders/_delete_by_query"))
+        self.assertEqual(calls[0][1]["params"]["slices"], 4)
+        self.assertIn("query", calls[0][1]["body"])
+        self.assertEqual(calls[-1][0], ("POST", "/_tasks/node:1/_cancel"))
+
+    def test_timeout_shorter_than_interval(self):
+        task = ByQueryTask(self.client, "orders", {}, initial_poll_interval=60)
+        self.assertEqual(task.run(timeout=0.01).updated, 90)
+        calls = self.client.transport.perform_request.call_args_list
+        self.assertNotIn(
+            ("POST", "/_tasks/node:1/_cancel"), [_c[0] for _c in calls]
+        )
+
+    def test_error(self):
+        self.statuses[0] = {
+            "completed": True,
+            "error": {"type": "search_phase_execution_exception"},
+        }
+        task = ByQueryTask(self.client, "orders", {}, initial_poll_interval=0)
+        with self.assertRaises(search.TransportError):
+            task.run()
+        with self.assertRaises(ValueError):
+            ByQueryTask(self.client, "orders", operation="reindex")
+
+
+class TrafficClassesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.traffic = TrafficClasses(
+            ["http://node-1:9200", "http://node-2:9200"],
+            {
+                "interactive": TrafficClass(maxsize=25, timeout=2),
+                "batch": TrafficClass(
+                    maxsize=2,
+                    timeout=120,
+                    max_retries=0,
+                    max_concurrency=1,
+                    hosts=["http://node-2:9200"],
+                    selector_class=search.RoundRobinSelector,
+                ),
+            },
+        )
+        self.addCleanup(self.traffic.close)
+
+    def test_separate_pools(self):
+        interactive = self.traffic["interactive"]
+        batch = self.traffic.client("batch")
+        self.assertIs(self.traffic["interactive"], interactive)
+        self.assertIsNot(
+            interactive.transport.connection_pool,
+            batch.transport.connection_pool,
+        )
+        connection, _ = interactive.transport.connection_pool.connections
+        self.assertEqual(connection.pool.pool.maxsize, 25)
+        self.assertEqual(connection.timeout, 2)
+        (connection,) = batch.transport.connection_pool.connections
+        self.assertEqual(connection.host, "http://node-2:9200")
+        self.assertEqual(connection.pool.pool.maxsize, 2)
+        self.assertEqual(connection.timeout, 120)
+        self.assertEqual(batch.transport.max_retries, 0)
+
+    def test_max_concurrency(self):
+        batch = self.traffic["batch"]
+
+        def perform_request(*args, **kwargs):
+            # The only slot is taken while the request is in flight.
+            self.assertFalse(batch.transport.semaphore.acquire(blocking=False))
+            return {}
+
+        with mock.patch.object(
+            search.Transport, "perform_request", side_effect=perform_request
+        ) as patched:
+            batch.transport.perform_request("GET", "/")
+        patched.assert_called_once_with("GET", "/")
+        self.assertTrue(batch.transport.semaphore.acquire(blocking=False))
+        self.assertIs(
+            type(self.traffic["interactive"].transport), search.Transport
+        )
+
+    def test_register(self):
+        self.traffic.register(["interactive"])
+        self.addCleanup(search_dsl.connections.remove_connection, "interactive")
+        self.assertIs(
+            search_dsl.connections.get_connection("interactive"),
+            self.traffic["interactive"],
+        )
+        self.assertEqual(list(self.traffic), ["interactive", "batch"])
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.transport = mock.Mock()
+        self.transport.perform_request.return_value = {}
+        self.client = mock.Mock(transport=self.transport)
+        self.perform_request = self.transport.perform_request
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        now = bucket.updated
+        self.assertEqual(bucket.delay(2, now), 0)
+        bucket.take(2, now)
+        self.assertAlmostEqual(bucket.delay(1, now), 0.1)
+        # Reserved ahead, the balance goes negative.
+        bucket.take(1, now)
+        self.assertAlmostEqual(bucket.delay(1, now), 0.2)
+        self.assertAlmostEqual(bucket.delay(1, now + 0.2), 0)
+
+    def test_larger_than_burst(self):
+        limiter = RateLimiter([RateLimit("*", "bulk", rate=10)], max_wait=0)
+        limiter.install(self.client)
+        body = '{"index":{"_index":"logs-1"}}\n{"message":"hello"}\n'
+        self.client.transport.perform_request("POST", "/_bulk", body=body)
+        with self.assertRaises(RateLimitExceeded) as context:
+            self.client.transport.perform_request("POST", "/_bulk", body=body)
+        # Only waiting for the bucket to be full again.
+        self.assertAlmostEqual(
+            context.exception.retry_after, len(body) / 10, places=2
+        )
+        self.assertEqual(self.perform_request.call_count, 1)
+
+    def test_fail_fast(self):
+        limiter = RateLimiter(
+            [
+                RateLimit("logs-*", "bulk", rate=1000),
+                RateLimit("*", "search", rate=1, burst=2),
+            ],
+            max_wait=0,
+        )
+        limiter.install(self.client)
+        self.client.transport.perform_request("POST", "/logs-1/_search")
+        self.client.transport.perform_request(
+            "POST", "/_msearch", body='{"index":"logs-1"}\n{}\n'
+        )
+        with self.assertRaises(RateLimitExceeded) as context:
+            self.client.transport.perform_request("GET", "/logs-1/_count")
+        self.assertGreater(context.exception.retry_after, 0.9)
+        # Scrolls and other operations aren't limited.
+        self.client.transport.perform_request("POST", "/_search/scroll")
+        self.client.transport.perform_request("GET", "/logs-1/_doc/1")
+        body = "\n".join(
+            [
+                '{"index":{"_index":"logs-1","_id":"1"}}',
+                '{"message":"hello"}',
+                '{"delete":{"_index":"logs-1","_id":"2"}}',
+                '{"index":{"_index":"users","_id":"1"}}',
+                '{"name":"joe"}',
+                "",
+            ]
+        )
+        self.client.transport.perform_request("POST", "/_bulk", body=body)
+        self.assertEqual(self.perform_request.call_count, 5)
+        metrics = limiter.metrics()
+        self.assertEqual(metrics["*:search"]["requests"], 2)
+        self.assertEqual(metrics["*:search"]["rejected"], 1)
+        self.assertEqual(metrics["logs-*:bulk"]["tokens"], 40 + 20 + 41)
+        # Bulk tokens are bytes, not characters.
+        body = '{"index":{"_index":"logs-1"}}\n{"message":"h\u00e9llo"}\n'
+        for sent in (body, body.encode("utf-8"), body.splitlines()):
+            self.client.transport.perform_request("POST", "/_bulk", body=sent)
+        self.assertEqual(
+            limiter.metrics()["logs-*:bulk"]["tokens"],
+            40 + 20 + 41 + 3 * len(body.encode("utf-8")),
+        )
+
+    def test_blocking(self):
+        limiter = RateLimiter([RateLimit("*", "*", rate=10, burst=1)])
+        limiter.install(self.client)
+        with mock.patch("anysearch.time.sleep") as sleep:
+            self.client.transport.perform_request("GET", "/")
+            sleep.assert_not_called()
+            self.client.transport.perform_request("GET", "/")
+        (delay,), _ = sleep.call_args
+        self.assertAlmostEqual(delay, 0.1, places=2)
+        self.assertEqual(limiter.metrics()["*:*"]["delayed"], 1)
+
+    def test_async(self):
+        calls = []
+
+        async def perform_request(method, url, **kwargs):
+            calls.append(url)
+            return {}
+
+        self.client.transport.perform_request = perform_request
+        RateLimiter([RateLimit("*", "*", rate=1000, burst=1)]).install(
+            self.client
+        )
+
+        async def _run():
+            for _ in range(3):
+                await self.client.transport.perform_request("GET", "/")
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(_run())
+        self.assertEqual(calls, ["/", "/", "/"])
+
+    def test_bulk_back_pressure(self):
+        client = FakeSearchClient(index="test")
+        limit = RateLimit("*", "bulk", rate=1)
+        rejections = [RateLimitExceeded(limit, 0.5)]
+        bulk = client.bulk
+
+        def limited_bulk(body, **kwargs):
+            if rejections:
+                raise rejections.pop()
+            return bulk(body, **kwargs)
+
+        client.bulk = limited_bulk
+        actions = [{"_index": "test", "_id": str(_i)} for _i in range(3)]
+        with mock.patch("anysearch.time.sleep") as sleep:
+            results = list(retrying_bulk(client, actions, max_retries=0))
+        sleep.assert_called_once_with(0.5)
+        self.assertEqual([_ok for _ok, _ in results], [True] * 3)
+        self.assertEqual(len(client.documents["test"]), 3)
+
+    def test_bulk_rejected_too_often(self):
+        client = FakeSearchClient(index="test")
+        limit = RateLimit("*", "bulk", rate=1)
+
+        def limited_bulk(body, **kwargs):
+            raise RateLimitExceeded(limit, 0.5)
+
+        client.bulk = limited_bulk
+        actions = [{"_index": "test", "_id": "1"}]
+        with mock.patch("anysearch.time.sleep") as sleep:
+            with self.assertRaises(RateLimitExceeded):
+                list(retrying_bulk(client, actions))
+        self.assertEqual(sleep.call_count, 99)